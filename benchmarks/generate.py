@@ -0,0 +1,146 @@
+#builds megit repositories of a given shape to run the benchmarks against
+#  python benchmarks/generate.py DIRECTORY [--shape NAME] [--files N] [--depth N] ...
+import os
+import sys
+import io
+import random
+import argparse
+import contextlib
+from collections import namedtuple
+
+# Last, so a megit on PYTHONPATH wins: run.py generates with the megit it times
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from megit import base
+from megit import data
+
+#files: number of files in the tree, spread over directories depth levels deep
+#commits: length of the linear history on main, each commit changes changes files
+#merges: number of side branches forked from the same commit and merged into main one by one
+#blob_size: bytes of text per file, large_blobs: number of extra binary files of large_blob_size
+Shape = namedtuple ('Shape', ['files', 'depth', 'commits', 'changes', 'merges',
+                              'blob_size', 'large_blobs', 'large_blob_size'])
+
+SHAPES = {
+    'small': Shape (files=200, depth=2, commits=20, changes=5, merges=3,
+                    blob_size=1024, large_blobs=0, large_blob_size=0),
+    'many-files': Shape (files=10000, depth=2, commits=5, changes=50, merges=0,
+                         blob_size=512, large_blobs=0, large_blob_size=0),
+    'deep': Shape (files=2000, depth=12, commits=10, changes=20, merges=0,
+                   blob_size=512, large_blobs=0, large_blob_size=0),
+    'long-history': Shape (files=200, depth=2, commits=1000, changes=2, merges=0,
+                           blob_size=512, large_blobs=0, large_blob_size=0),
+    'wide-merges': Shape (files=500, depth=2, commits=10, changes=5, merges=100,
+                          blob_size=512, large_blobs=0, large_blob_size=0),
+    'large-blobs': Shape (files=50, depth=1, commits=5, changes=2, merges=0,
+                          blob_size=1024, large_blobs=8, large_blob_size=16 * 1024 * 1024),
+}
+
+LINE_LENGTH = 40
+
+#every file gets its own path, a file in a directory named after the digits of its number
+#so the directories fill evenly and are depth levels deep
+def file_paths (shape):
+    width = max (2, round (shape.files ** (1 / (shape.depth + 1))))
+    paths = []
+    for i in range (shape.files):
+        dirs = []
+        n = i // width
+        for _ in range (shape.depth):
+            dirs.append (f'd{n % width}')
+            n //= width
+        paths.append ('/'.join (dirs + [f'f{i}.txt']))
+    return paths
+
+def _text (rng, size):
+    lines = max (1, size // LINE_LENGTH)
+    return ''.join (f'{n:6} {rng.getrandbits (128):032x}\n' for n in range (lines))
+
+def _write (path, content):
+    os.makedirs (os.path.dirname (path) or '.', exist_ok=True)
+    mode = 'wb' if isinstance (content, bytes) else 'w'
+    with open (path, mode) as f:
+        f.write (content)
+
+#rewrites one line of the file, the first or the last so changes on two branches merge cleanly
+def _change_line (path, rng, last=False):
+    with open (path) as f:
+        lines = f.readlines ()
+    i = len (lines) - 1 if last else 0
+    lines[i] = f'{i:6} {rng.getrandbits (128):032x}\n'
+    _write (path, ''.join (lines))
+
+def _commit_changes (paths, rng, message, count, last=False):
+    changed = rng.sample (paths, min (count, len (paths)))
+    for path in changed:
+        _change_line (path, rng, last)
+    base.add (changed)
+    return base.commit (message)
+
+#makes the repository in directory, which must not exist yet. Besides main (checked out)
+#it has a topic branch that forked from main's parent and changes the same files, so
+#checking it out and merging it have work to do
+def generate (directory, shape, seed=0):
+    rng = random.Random (seed)
+    os.makedirs (directory)
+    cwd = os.getcwd ()
+    os.chdir (directory)
+    try:
+        with data.change_git_dir ('.'), contextlib.redirect_stdout (io.StringIO ()):
+            base.init ()
+            paths = file_paths (shape)
+            for path in paths:
+                _write (path, _text (rng, shape.blob_size))
+            for i in range (shape.large_blobs):
+                _write (f'large/blob{i}.bin', rng.randbytes (shape.large_blob_size))
+            base.add (['.'])
+            base.commit ('initial')
+
+            for i in range (shape.commits):
+                _commit_changes (paths, rng, f'commit {i}', shape.changes)
+
+            # Every side branch forks from the same commit, so main ends up with many merge parents
+            fork = base.get_oid ('main')
+            for i in range (shape.merges):
+                base.create_branch (f'side{i}', fork)
+            for i in range (shape.merges):
+                base.checkout (f'side{i}')
+                _commit_changes (paths[i::shape.merges], rng, f'side {i}', shape.changes)
+                base.checkout ('main')
+                base.merge (base.get_oid (f'side{i}'))
+                if data.get_ref ('MERGE_HEAD').value:
+                    base.commit (f'merge side {i}')
+
+            base.create_branch ('topic', base.get_oid ('main'))
+            base.checkout ('topic')
+            topic_paths = rng.sample (paths, min (shape.changes, len (paths)))
+            _commit_changes (topic_paths, rng, 'topic', shape.changes, last=True)
+            base.checkout ('main')
+            _commit_changes (topic_paths, rng, 'main', shape.changes)
+    finally:
+        os.chdir (cwd)
+
+def shape_from_args (args):
+    shape = SHAPES[args.shape]
+    overrides = {field: getattr (args, field) for field in Shape._fields
+                 if getattr (args, field, None) is not None}
+    return shape._replace (**overrides)
+
+def add_shape_arguments (parser):
+    parser.add_argument ('--shape', choices=sorted (SHAPES), default='small')
+    for field in Shape._fields:
+        parser.add_argument (f'--{field.replace ("_", "-")}', dest=field, type=int,
+                             help=f'overrides the shape\'s {field}')
+
+def main ():
+    parser = argparse.ArgumentParser (description='Generate a megit repository to benchmark')
+    parser.add_argument ('directory')
+    parser.add_argument ('--seed', type=int, default=0)
+    add_shape_arguments (parser)
+    args = parser.parse_args ()
+    shape = shape_from_args (args)
+    generate (args.directory, shape, args.seed)
+    print (f'Generated {args.directory}: {shape._asdict ()}')
+
+if __name__ == '__main__':
+    main ()
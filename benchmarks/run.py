@@ -0,0 +1,245 @@
+#times megit commands on generated repositories and writes the results as json
+#  python benchmarks/run.py [--megit DIR] [--shape NAME ...] [--repeat N] [--output FILE]
+#                           [--compare OLD.json] [--drop-caches]
+#every run is a megit command started in its own process on a fresh copy of the repository,
+#so megit's own caches always start empty, like they do for a user; setting up the copy is not
+#timed. Only the command line is used, so --megit can point at the source of any revision
+#(a git worktree of an older commit, say) and the numbers compare with this one's
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import generate
+
+ROOT = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+
+#runs a megit command from the source tree megit_root in repo, returns how long it took
+def _megit (megit_root, repo, *args):
+    env = dict (os.environ, PYTHONPATH=megit_root)
+    start = time.perf_counter ()
+    subprocess.run ([sys.executable, '-c', 'from megit.cli import main; main ()', *args],
+                    cwd=repo, env=env, check=True, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE, text=True)
+    return time.perf_counter () - start
+
+#each benchmark gets the path of a fresh copy of the repository and returns the arguments of
+#the command to time, and the directory to run it in if not the copy. Any setup runs
+#through megit (the run function) too, so the copy stays in the format of the megit timed
+
+#changes shape.changes files in the working tree, returns their paths
+def _touch (repo, shape, rng):
+    paths = generate.file_paths (shape)
+    paths = rng.sample (paths, min (shape.changes, len (paths)))
+    for path in paths:
+        generate._change_line (f'{repo}/{path}', rng, last=True)
+    return paths
+
+def bench_add (repo, shape, rng, run):
+    return ['add', *_touch (repo, shape, rng)]
+
+def bench_add_all (repo, shape, rng, run):
+    _touch (repo, shape, rng)
+    return ['add', '.']
+
+def bench_write_tree (repo, shape, rng, run):
+    run ('add', *_touch (repo, shape, rng))
+    return ['write-tree']
+
+def bench_commit (repo, shape, rng, run):
+    run ('add', *_touch (repo, shape, rng))
+    return ['commit', '-m', 'benchmark']
+
+def bench_status (repo, shape, rng, run):
+    _touch (repo, shape, rng)
+    return ['status']
+
+def bench_diff (repo, shape, rng, run):
+    _touch (repo, shape, rng)
+    return ['diff']
+
+def bench_show (repo, shape, rng, run):
+    return ['show']
+
+def bench_log (repo, shape, rng, run):
+    return ['log']
+
+def bench_checkout (repo, shape, rng, run):
+    return ['checkout', 'topic']
+
+def bench_merge (repo, shape, rng, run):
+    return ['merge', 'topic']
+
+def bench_merge_base (repo, shape, rng, run):
+    return ['merge-base', 'main', 'topic']
+
+def bench_fetch (repo, shape, rng, run):
+    # Into an empty repository next to it, over the local directory transport
+    clone = f'{repo}-fetch'
+    os.makedirs (clone)
+    run ('init', cwd=clone)
+    return ['fetch', repo], clone
+
+def bench_push (repo, shape, rng, run):
+    origin = f'{repo}-origin'
+    os.makedirs (origin)
+    run ('init', cwd=origin)
+    return ['push', origin, 'main']
+
+BENCHMARKS = {
+    'add': bench_add,
+    'add-all': bench_add_all,
+    'write-tree': bench_write_tree,
+    'commit': bench_commit,
+    'status': bench_status,
+    'diff': bench_diff,
+    'show': bench_show,
+    'log': bench_log,
+    'checkout': bench_checkout,
+    'merge': bench_merge,
+    'merge-base': bench_merge_base,
+    'fetch': bench_fetch,
+    'push': bench_push,
+}
+
+#empties the kernel's page cache so files are read from disk, needs root on Linux
+def _drop_os_caches ():
+    os.sync ()
+    try:
+        with open ('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write ('3\n')
+    except OSError as e:
+        sys.exit (f'Can\'t drop the page cache: {e}')
+
+def _time_once (megit_root, template, work_dir, shape, name, seed, drop_caches):
+    repo = f'{work_dir}/run'
+    shutil.copytree (template, repo)
+    try:
+        def run (*args, cwd=repo):
+            _megit (megit_root, cwd, *args)
+        command = BENCHMARKS[name] (repo, shape, random.Random (seed), run)
+        command, cwd = command if isinstance (command, tuple) else (command, repo)
+        if drop_caches:
+            _drop_os_caches ()
+        return _megit (megit_root, cwd, *command)
+    finally:
+        for path in (repo, f'{repo}-fetch', f'{repo}-origin'):
+            shutil.rmtree (path, ignore_errors=True)
+
+#generates the repository with the megit being timed, in a process of its own like the
+#commands, so it is in that megit's format
+def _generate (megit_root, template, shape, seed):
+    env = dict (os.environ, PYTHONPATH=megit_root)
+    args = [f'--{field.replace ("_", "-")}={value}' for field, value in shape._asdict ().items ()]
+    subprocess.run ([sys.executable, f'{ROOT}/benchmarks/generate.py', template, f'--seed={seed}', *args],
+                    env=env, check=True, stdout=subprocess.DEVNULL)
+
+def run_shape (megit_root, shape_name, shape, names, repeat, work_dir, seed, drop_caches):
+    template = f'{work_dir}/{shape_name}'
+    start = time.perf_counter ()
+    _generate (megit_root, template, shape, seed)
+    print (f'{shape_name}: generated in {time.perf_counter () - start:.2f}s', file=sys.stderr)
+
+    results = {}
+    for name in names:
+        try:
+            times = [_time_once (megit_root, template, work_dir, shape, name, seed + i, drop_caches)
+                     for i in range (repeat)]
+        except subprocess.CalledProcessError as e:
+            # An older revision may not have the command, or a bug in it, the rest still run
+            error = (e.stderr.strip ().splitlines () or [f'exit status {e.returncode}'])[-1]
+            results[name] = {'error': error}
+            print (f'{shape_name:>14} {name:<12} failed: {error}', file=sys.stderr)
+            continue
+        results[name] = {'times': times, 'min': min (times), 'median': statistics.median (times)}
+        print (f'{shape_name:>14} {name:<12} {results[name]["min"]:10.4f}s', file=sys.stderr)
+    shutil.rmtree (template)
+    return {'shape': shape._asdict (), 'benchmarks': results}
+
+#a python that does nothing but start up, the floor under every command's time
+def _startup_time (repeat):
+    times = []
+    for _ in range (repeat):
+        start = time.perf_counter ()
+        subprocess.run ([sys.executable, '-c', 'pass'], check=True)
+        times.append (time.perf_counter () - start)
+    return min (times)
+
+def _megit_revision (megit_root):
+    try:
+        return subprocess.run (['git', 'rev-parse', 'HEAD'], cwd=megit_root, capture_output=True,
+                               text=True, check=True).stdout.strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#prints how the medians of new compare to the ones of old, for the benchmarks both ran
+#without failing
+def compare (old, new):
+    for shape_name, shape_results in new['results'].items ():
+        old_shape = old['results'].get (shape_name)
+        if not old_shape:
+            continue
+        for name, result in shape_results['benchmarks'].items ():
+            old_result = old_shape['benchmarks'].get (name)
+            if 'median' not in result or not old_result or 'median' not in old_result:
+                continue
+            ratio = result['median'] / old_result['median'] if old_result['median'] else float ('inf')
+            print (f'{shape_name:>14} {name:<12} {old_result["median"]:10.4f}s '
+                   f'-> {result["median"]:10.4f}s  x{ratio:.2f}')
+
+def main ():
+    parser = argparse.ArgumentParser (description='Time megit commands on generated repositories')
+    parser.add_argument ('--megit', default=ROOT, help='source tree of the megit to time (default: this one)')
+    parser.add_argument ('--shape', action='append', choices=sorted (generate.SHAPES),
+                         help='shape to run, may be given more than once (default: small)')
+    parser.add_argument ('--benchmark', action='append', choices=list (BENCHMARKS),
+                         help='benchmark to run, may be given more than once (default: all)')
+    parser.add_argument ('--repeat', type=int, default=3)
+    parser.add_argument ('--seed', type=int, default=0)
+    parser.add_argument ('--output', default='benchmark-results.json')
+    parser.add_argument ('--compare', metavar='OLD', help='results file of an earlier run to compare with')
+    parser.add_argument ('--work-dir', help='where repositories are generated (default: a temporary directory)')
+    parser.add_argument ('--drop-caches', action='store_true',
+                         help='empty the OS page cache before every timed command (needs root)')
+    args = parser.parse_args ()
+
+    megit_root = os.path.abspath (args.megit)
+    work_dir = args.work_dir or tempfile.mkdtemp (prefix='megit-bench-')
+    work_dir = os.path.abspath (work_dir)
+    os.makedirs (work_dir, exist_ok=True)
+    names = args.benchmark or list (BENCHMARKS)
+    try:
+        results = {shape_name: run_shape (megit_root, shape_name, generate.SHAPES[shape_name], names,
+                                          args.repeat, work_dir, args.seed, args.drop_caches)
+                   for shape_name in args.shape or ['small']}
+    finally:
+        if not args.work_dir:
+            shutil.rmtree (work_dir, ignore_errors=True)
+
+    report = {
+        'revision': _megit_revision (megit_root),
+        'date': time.strftime ('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version (),
+        'platform': platform.platform (),
+        'repeat': args.repeat,
+        'drop_caches': args.drop_caches,
+        'startup': _startup_time (args.repeat),
+        'results': results,
+    }
+    with open (args.output, 'w') as f:
+        json.dump (report, f, indent=2)
+    print (f'Wrote {args.output}', file=sys.stderr)
+
+    if args.compare:
+        with open (args.compare) as f:
+            compare (json.load (f), report)
+
+if __name__ == '__main__':
+    main ()
@@ -1,58 +1,81 @@
 import os
+import time
 import itertools #iterating
 import operator #Contains function versions of common operators (+, ==) eg operator.add(2, 3) # 5
 import string #for string functions 
+import functools
+import heapq
+import bisect
 
-from collections import deque,namedtuple
+from collections import deque,namedtuple,defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from . import data
 from . import diff
+from . import trace
 
 def init():
     data.init()
     data.update_ref('HEAD', data.RefValue(symbolic=True, value='refs/heads/main')) 
 
 #saves as the directory in object database and returns the tree OID
+#directories still in the index's cache-tree are reused, only the changed ones are rebuilt
+@trace.traced
 def write_tree ():
-    # Index is flat, we need it as a tree of dicts
-    index_as_tree = {}
     with data.get_index () as index:
-        for path, oid in index.items ():
-            path = path.split ('/')
-            dirpath, filename = path[:-1], path[-1]
-
-            current = index_as_tree
-            # Find the dict for the directory of this file
-            for dirname in dirpath:
-                current = current.setdefault (dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive (tree_dict):
-        entries = []
-        for name, value in tree_dict.items ():
-            if type (value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive (value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append ((name, oid, type_))
+        # Sorted, so everything under a directory is one contiguous run we can bisect to
+        paths = sorted (index)
+
+        def write_tree_recursive (prefix):
+            dirname = prefix.rstrip ('/')
+            oid = index.trees.get (dirname)
+            if oid and data.object_exists (oid):
+                return oid
+
+            entries = []
+            names = set ()
+            i = bisect.bisect_left (paths, prefix)
+            while i < len (paths) and paths[i].startswith (prefix):
+                name, sep, _ = paths[i][len (prefix):].partition ('/')
+                # add keeps a file and a directory of the same name out of the index, a tree
+                # with both would not check out
+                assert name not in names, f'{prefix}{name} is both a file and a directory in the index'
+                names.add (name)
+                if sep:
+                    entries.append ((name, write_tree_recursive (f'{prefix}{name}/'), 'tree'))
+                    # Skip the rest of that directory, '0' sorts right after '/'
+                    i = bisect.bisect_left (paths, f'{prefix}{name}0', i)
+                else:
+                    entries.append ((name, index[paths[i]].oid, 'blob'))
+                    i += 1
+
+            tree = ''.join (f'{type_} {oid} {name}\n'
+                            for name, oid, type_
+                            in sorted (entries))
+            oid = data.hash_object (tree.encode (), 'tree')
+            index.trees[dirname] = oid
+            return oid
 
-        tree = ''.join (f'{type_} {oid} {name}\n'
-                        for name, oid, type_
-                        in sorted (entries))
-        return data.hash_object (tree.encode (), 'tree')
+        return write_tree_recursive ('')
 
-    return write_tree_recursive (index_as_tree)
+#fills the cache-tree from a tree we know matches the index
+def _prime_cache_tree (index, tree_oid, dirname=''):
+    index.trees[dirname] = tree_oid
+    for type_, oid, name in _iter_tree_entries (tree_oid):
+        if type_ == 'tree':
+            _prime_cache_tree (index, oid, f'{dirname}/{name}' if dirname else name)
 
 #reads the content of the Tree object which is filenames in each line
 def _iter_tree_entries(oid): 
     if not oid:
         return
-    tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split(' ',2)
-        yield type_, oid, name #yield produces one at a time
+    entries = _tree_cache.get (oid)
+    if entries is None:
+        tree = data.get_object(oid, 'tree')
+        trace.count ('tree.parse', len (tree))
+        entries = [tuple (entry.split(' ',2)) for entry in tree.decode().splitlines()] #(type_, oid, name)
+        _tree_cache.put (oid, entries, len (tree) + CACHE_ENTRY_OVERHEAD)
+    yield from entries #yield produces one at a time
 
 #returns a dictionary with path->oid
 def get_tree(oid, base_path=''): 
@@ -70,50 +93,213 @@ def get_tree(oid, base_path=''):
             assert False, f'Unknown Tree entry {type_}'
     return result
 
-def get_working_tree ():
-    result = {}
-    for root, _, filenames in os.walk ('.'):
+#walks the tree objects side by side and yields (path, oid in each tree) for every file that
+#is not the same in all of them (None where a tree doesn't have it). Subtrees with the same
+#oid everywhere are skipped without being read, so the cost follows the changed directories
+def iter_tree_changes (*oids, base_path=''):
+    blobs = {} #name -> oid in each tree
+    trees = {}
+    for i, oid in enumerate (oids):
+        for type_, entry_oid, name in _iter_tree_entries (oid):
+            assert '/' not in name and name not in ('..', '.')
+            assert type_ in ('blob', 'tree'), f'Unknown Tree entry {type_}'
+            entries = blobs if type_ == 'blob' else trees
+            entries.setdefault (name, [None] * len (oids))[i] = entry_oid
+    for name in sorted (blobs.keys () | trees.keys ()):
+        path = base_path + name
+        if name in blobs and len (set (blobs[name])) > 1:
+            yield (path, *blobs[name])
+        if name in trees and len (set (trees[name])) > 1:
+            yield from iter_tree_changes (*trees[name], base_path=f'{path}/')
+
+#walks the working tree and yields the relative path of every file we track
+def _iter_working_files (dirname='.'):
+    for root, dirnames, filenames in os.walk (dirname):
+        # Don't descend into .megit at all
+        dirnames[:] = [d for d in dirnames
+                       if not is_ignored (os.path.relpath (f'{root}/{d}'))]
         for filename in filenames:
             path = os.path.relpath (f'{root}/{filename}')
             if is_ignored (path) or not os.path.isfile (path):
                 continue
-            with open (path, 'rb') as f:
-                result[path] = data.hash_object (f.read ())
+            yield path
+
+# Files changed this recently may change again within the same mtime tick,
+# so their stat data is not trusted until they are older than this
+RACY_WINDOW_NS = 2 * 10**9
+
+def _index_entry (oid, st):
+    mtime = st.st_mtime_ns
+    if mtime >= time.time_ns () - RACY_WINDOW_NS:
+        mtime = 0 #never matches, the file gets rehashed next time
+    return data.IndexEntry (oid=oid, mtime=mtime, size=st.st_size,
+                            ino=st.st_ino, mode=st.st_mode)
+
+def _stat_matches (entry, st):
+    return (entry.mtime == st.st_mtime_ns and entry.size == st.st_size and
+            entry.ino == st.st_ino and entry.mode == st.st_mode)
+
+# Hashing runs on a pool once there are at least this many files to hash.
+# MEGIT_HASH_POOL picks 'thread' (default) or 'process', MEGIT_HASH_WORKERS the pool size
+PARALLEL_THRESHOLD = int (os.environ.get ('MEGIT_PARALLEL_THRESHOLD', 1000))
+HASH_POOL = os.environ.get ('MEGIT_HASH_POOL', 'thread')
+HASH_WORKERS = int (os.environ.get ('MEGIT_HASH_WORKERS', 0)) or os.cpu_count () or 1
+
+#process pool workers start without our globals, so the git dir is passed along
+def _hash_file_in (git_dir, path, write):
+    data.GIT_DIR = git_dir
+    return data.hash_file (path, write=write)
+
+#hashes many files at once, returns path->oid
+@trace.traced
+def _hash_files (paths, write=True):
+    if len (paths) < PARALLEL_THRESHOLD or HASH_WORKERS < 2:
+        return {path: data.hash_file (path, write=write) for path in paths}
+    if HASH_POOL == 'process':
+        pool = ProcessPoolExecutor (HASH_WORKERS)
+        hash_ = functools.partial (_hash_file_in, data.GIT_DIR, write=write)
+    else:
+        # hashlib, zlib and file reads release the GIL, so threads do run in parallel
+        pool = ThreadPoolExecutor (HASH_WORKERS)
+        hash_ = functools.partial (data.hash_file, write=write)
+    with pool:
+        return dict (zip (paths, pool.map (hash_, paths, chunksize=64)))
+
+#returns path->oid for the working tree, only rehashing files whose stat data differs from the index
+@trace.traced
+def get_working_tree ():
+    result = {}
+    with data.get_index () as index:
+        entries = dict (index.items ())
+        stale = {} #path -> stat of files we have to hash
+        for path in _iter_working_files ():
+            entry = entries.get (path)
+            st = os.stat (path)
+            if entry and _stat_matches (entry, st):
+                result[path] = entry.oid
+            else:
+                stale[path] = st
+        # Only comparing, so nothing is written to the object store
+        for path, oid in _hash_files (list (stale), write=False).items ():
+            result[path] = oid
+            entry = index.get (path)
+            if entry and entry.oid == oid:
+                # Content is the same, refresh the stat data so we skip it next time
+                index[path] = _index_entry (oid, stale[path])
     return result
 
-def _empty_current_directory(): #as name suggests empties the current directory
-#follows bottoms up - inner files first 
-    for root, dirnames, filenames in os.walk('.', topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f'{root}/{filename}') 
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path) #delete the path
-        for dirname in dirnames:
-            path = os.path.relpath(f'{root}/{dirname}')
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path) #tries to delete the directory only works when directory empty
-            except (FileNotFoundError, OSError):
-                pass #except these errors we allow to pass caused by all files not deleted like .megit
+#(path, oid in the tree, oid in the working tree) for every file that differs between them.
+#A directory whose files all match the index has its cache-tree oid as its tree, where that
+#is the tree's own subtree the directory is skipped without reading anything under it
+def iter_working_tree_changes (tree_oid):
+    working = get_working_tree ()
+    with data.get_index () as index:
+        known = dict (index.trees)
+        entries = dict (index.items ())
+    changed = [path for path, entry in entries.items () if working.get (path) != entry.oid]
+    changed.extend (path for path in working if path not in entries)
+    for path in changed:
+        while path:
+            path = path.rpartition ('/')[0]
+            known.pop (path, None)
+
+    files = defaultdict (dict) #directory -> name -> oid of the working files right in it
+    subdirs = defaultdict (set)
+    for path, oid in working.items ():
+        dirname, _, name = path.rpartition ('/')
+        files[dirname][name] = oid
+        while dirname:
+            parent, _, name = dirname.rpartition ('/')
+            if name in subdirs[parent]:
+                break
+            subdirs[parent].add (name)
+            dirname = parent
+
+    def walk (oid, dirname):
+        if oid and known.get (dirname) == oid:
+            return
+        prefix = f'{dirname}/' if dirname else ''
+        names = dict (files.get (dirname, {}))
+        dirs = set (subdirs.get (dirname, ()))
+        for type_, entry_oid, name in _iter_tree_entries (oid):
+            if type_ == 'blob':
+                o_working = names.pop (name, None)
+                if o_working != entry_oid:
+                    yield prefix + name, entry_oid, o_working
+            else:
+                dirs.discard (name)
+                yield from walk (entry_oid, prefix + name)
+        for name in sorted (names):
+            yield prefix + name, None, names[name]
+        for name in sorted (dirs):
+            yield from walk (None, prefix + name)
+
+    yield from walk (tree_oid, '')
+
+#makes the working directory and the index match tree (path->oid),
+#only creating, updating or deleting the paths that actually differ
+#tree_oid, when known, is the tree object for tree and fills the cache-tree
+@trace.traced
+def _checkout_tree (tree, tree_oid=None):
+    current = get_working_tree () #cheap thanks to the stat cache
+    changes = {path: o_target
+               for path, o_current, o_target in diff.compare_trees (current, tree)
+               if o_current != o_target}
+
+    with data.get_index () as index:
+        _write_changes (index, changes)
+
+        # Files that were already right may still be missing or stale in the index
+        for path, oid in tree.items ():
+            entry = index.get (path)
+            if not entry or entry.oid != oid:
+                index[path] = _index_entry (oid, os.stat (path))
+        for path in [path for path in index if path not in tree]:
+            del index[path]
+        if tree_oid:
+            _prime_cache_tree (index, tree_oid)
+
+#writes changes (path->oid, None to delete the file) to the working directory and the index
+def _write_changes (index, changes):
+    # Partial clones get all the blobs they are missing in one batch
+    data.prefetch_objects (changes.values ())
+
+    # Deletions first so a file can take the place of a removed directory
+    for path, oid in changes.items ():
+        if oid:
+            continue
+        if os.path.isfile (path):
+            os.remove (path)
+        index.pop (path, None)
+        try:
+            os.removedirs (os.path.dirname (path)) #drops the parent directories that became empty
+        except OSError:
+            pass
+    for path, oid in changes.items ():
+        if not oid:
+            continue
+        if os.path.dirname (path):
+            os.makedirs (os.path.dirname (path), exist_ok=True)
+        with open (path, 'wb') as f:
+            f.write (data.get_object (oid))
+        index[path] = _index_entry (oid, os.stat (path))
 
 #restores the directory or version from Tree OID passed 
 def read_tree(tree_oid): 
-    _empty_current_directory()
-    for path, oid in get_tree(tree_oid, base_path='./').items():  #the get_tree gives a dict of path->oid mappings for each file 
-        os.makedirs (os.path.dirname(path),exist_ok=True) #we are making directories by extracting the directory name from relative path, exist ok prevents from raising error when same directory name occurs
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid)) #creates the file from its path and writes its content
+    _checkout_tree (get_tree (tree_oid), tree_oid) #the get_tree gives a dict of path->oid mappings for each file 
 
+#writes the merge of the three trees to the working directory and returns the conflicting paths
+#only the paths the merge changes from t_HEAD are touched, directories that are the same in
+#all three trees are never read
+@trace.traced
 def read_tree_merged (t_base, t_HEAD, t_other):
-    _empty_current_directory ()
-    for path, blob in diff.merge_trees (get_tree (t_base), get_tree (t_HEAD), get_tree (t_other)).items ():
-        os.makedirs (f'./{os.path.dirname (path)}', exist_ok=True)
-        with open (path, 'wb') as f:
-            f.write (blob) 
+    merged = diff.merge_tree_changes (iter_tree_changes (t_base, t_HEAD, t_other))
+    with data.get_index () as index:
+        _write_changes (index, merged.tree)
+    return merged.conflicts
 
 #makes the commit object and returns its OID
+@trace.traced
 def commit(message): 
     commit = f'tree {write_tree()}\n' #key value pair
     HEAD = data.get_ref('HEAD').value
@@ -127,9 +313,11 @@ def commit(message):
     commit +=  f'{message}\n'
     oid = data.hash_object(commit.encode(), 'commit') 
     data.update_ref('HEAD',data.RefValue (symbolic=False, value=oid)) 
+    update_commit_graph ([oid])
     return oid
 
 #opens another version that version is our head now
+@trace.traced
 def checkout (name): 
     oid = get_oid (name)
     commit = get_commit (oid)
@@ -145,6 +333,7 @@ def checkout (name):
 def reset (oid):
     data.update_ref ('HEAD', data.RefValue (symbolic=False, value=oid))
 
+@trace.traced
 def merge (other):
     HEAD = data.get_ref ('HEAD').value
     assert HEAD
@@ -163,17 +352,103 @@ def merge (other):
 
     c_base = get_commit (merge_base)
     c_HEAD = get_commit (HEAD)
-    read_tree_merged (c_base.tree, c_HEAD.tree, c_other.tree)
+    conflicts = read_tree_merged (c_base.tree, c_HEAD.tree, c_other.tree)
+    for path in conflicts:
+        print (f'CONFLICT (content): Merge conflict in {path}')
     print ('Merged in working tree\nPlease commit')
 
+# Commits missing from the commit-graph are treated as newer than everything,
+# so they are looked at first and never cut off
+GENERATION_INFINITY = 0xffffffff
+
+def _generation (oid):
+    commit_graph = data.get_commit_graph ()
+    pos = commit_graph.lookup (oid)
+    if pos is None:
+        return GENERATION_INFINITY
+    return commit_graph.generation (pos)
+
+# Flags used while painting history in _paint_down_to_common
+PARENT1, PARENT2, STALE = 1, 2, 4
+
+#walks down from one and twos at the same time, newest generation first, and returns the
+#commits reached from both sides; stops once every commit left in the queue is known to be
+#below a common ancestor already found
+def _paint_down_to_common (one, twos):
+    flags = {}
+    queue = []
+    counter = itertools.count () #keeps the heap stable for commits with the same generation
+    queued = defaultdict (int) #oid -> its entries in the queue
+    nonstale = 0 #queue entries whose commit isn't stale, the walk ends when there are none
+
+    def push (oid, flag):
+        nonlocal nonstale
+        old = flags.get (oid, 0)
+        flags[oid] = old | flag
+        if flag & STALE and not old & STALE:
+            nonstale -= queued[oid] #its entries already queued went stale with it
+        queued[oid] += 1
+        if not flags[oid] & STALE:
+            nonstale += 1
+        heapq.heappush (queue, (-_generation (oid), next (counter), oid))
+
+    push (one, PARENT1)
+    for two in twos:
+        push (two, PARENT2)
+
+    results = []
+    while nonstale:
+        _, _, oid = heapq.heappop (queue)
+        queued[oid] -= 1
+        if not flags[oid] & STALE:
+            nonstale -= 1
+        flag = flags[oid] & (PARENT1 | PARENT2 | STALE)
+        if flag == PARENT1 | PARENT2:
+            if oid not in results:
+                results.append (oid)
+            # Everything below a common ancestor is a worse common ancestor
+            flag |= STALE
+        for parent in _get_parents (oid):
+            if flags.get (parent, 0) & flag == flag:
+                continue
+            push (parent, flag)
+    # A result that got painted stale later is below another result
+    return [oid for oid in results if not flags[oid] & STALE]
+
+#all best common ancestors: common ancestors that are not an ancestor of another one
+@trace.traced
+def get_merge_bases (oid1, oid2):
+    if oid1 == oid2:
+        return [oid1]
+    candidates = _paint_down_to_common (oid1, [oid2])
+    if len (candidates) < 2:
+        return candidates
+    # Criss-cross histories can leave candidates that are ancestors of each other
+    return [oid for oid in candidates
+            if not any (other != oid and is_ancestor_of (other, oid) for other in candidates)]
+
 def get_merge_base (oid1, oid2):
-    parents1 = set (iter_commits_and_parents ({oid1}))
-    for oid in iter_commits_and_parents ({oid2}):
-        if oid in parents1:
-            return oid
+    bases = get_merge_bases (oid1, oid2)
+    return bases[0] if bases else None
   
+#walks down from commit newest generation first and stops as soon as it is below maybe_ancestor
 def is_ancestor_of (commit, maybe_ancestor):
-    return maybe_ancestor in iter_commits_and_parents ({commit}) 
+    min_generation = _generation (maybe_ancestor)
+    if min_generation == GENERATION_INFINITY:
+        min_generation = 0 #unknown, so nothing can be cut off
+    queue = [(-_generation (commit), commit)]
+    visited = {commit}
+    while queue:
+        generation, oid = heapq.heappop (queue)
+        if oid == maybe_ancestor:
+            return True
+        if -generation < min_generation:
+            return False #everything left is older than maybe_ancestor
+        for parent in _get_parents (oid):
+            if parent not in visited:
+                visited.add (parent)
+                heapq.heappush (queue, (-_generation (parent), parent))
+    return False
 
 #gives name to OID, creates a ref and stores in object database, in the file the content is OID
 def create_tag (name, oid): 
@@ -200,10 +475,33 @@ def get_branch_name():
 
 Commit = namedtuple('Commit',['tree', 'parents', 'message']) #its like a shorter version of class
 
+# Objects never change, so parsed commits and trees are cached by oid and never invalidated.
+# Sizes are in bytes of the raw objects, MEGIT_OBJECT_CACHE_SIZE overrides them
+CACHE_SIZE = int (os.environ.get ('MEGIT_OBJECT_CACHE_SIZE', 32 * 1024 * 1024))
+CACHE_ENTRY_OVERHEAD = 200 #rough size of the python objects around each entry
+_commit_cache = data.LRUCache (CACHE_SIZE // 4)
+_tree_cache = data.LRUCache (CACHE_SIZE - CACHE_SIZE // 4)
+
+#hit and miss counters of the parsed object caches, to size them for long running callers
+def cache_stats ():
+    return {'commits': _commit_cache.stats (), 'trees': _tree_cache.stats ()}
+
 #commit object OID is passed, Commit as a tuple is returned with (message, parent, oid)
+#the same Commit is handed out to every caller, don't modify it
+#shallow commits (see data.get_shallow) come back without parents, as root commits
 def get_commit(oid):
+    parsed = _read_commit (oid)
+    if oid in data.get_shallow ():
+        return parsed._replace (parents=[])
+    return parsed
+
+def _read_commit (oid):
+    cached = _commit_cache.get (oid)
+    if cached is not None:
+        return cached
     parents = [] #the first commit does not have a parent so
     commit = data.get_object(oid, 'commit').decode()
+    trace.count ('commit.parse', len (commit))
     lines = iter(commit.splitlines()) #convert lines splitted into iterable
     for line in itertools.takewhile (operator.truth, lines): #iterate till empty line
         key, value = line.split(' ', 1)
@@ -215,7 +513,32 @@ def get_commit(oid):
             raise ValueError(f'Unknown field {key}')
 
     message = '\n'.join (lines) 
-    return Commit (tree=tree, parents=parents, message=message) 
+    parsed = Commit (tree=tree, parents=parents, message=message) 
+    _commit_cache.put (oid, parsed, len (commit) + CACHE_ENTRY_OVERHEAD)
+    return parsed
+
+#adds the commits reachable from tips to the commit-graph, only walking the ones it doesn't have yet
+@trace.traced
+def update_commit_graph (tips):
+    def read_commit (oid):
+        commit = get_commit (oid)
+        return commit.tree, commit.parents
+    data.update_commit_graph (tips, read_commit)
+
+#parents and tree of a commit, from the commit-graph when it knows the commit
+def _get_parents (oid):
+    commit_graph = data.get_commit_graph ()
+    pos = commit_graph.lookup (oid)
+    if pos is not None:
+        return commit_graph.parent_oids (pos)
+    return get_commit (oid).parents
+
+def _get_commit_tree (oid):
+    commit_graph = data.get_commit_graph ()
+    pos = commit_graph.lookup (oid)
+    if pos is not None:
+        return commit_graph.tree (pos)
+    return get_commit (oid).tree
 
 #for git log - walks through a commit history
 #prev commit is parent
@@ -228,11 +551,11 @@ def iter_commits_and_parents(oids): #HEAD is passed as [HEAD] then refs added
             continue
         visited.add(oid)
         yield oid
-        commit = get_commit(oid)
+        parents = _get_parents (oid)
         # Return first parent next
-        oids.extendleft (commit.parents[:1])
+        oids.extendleft (parents[:1])
         # Return other parents later
-        oids.extend (commit.parents[1:])
+        oids.extend (parents[1:])
 
 def iter_objects_in_commits (oids):
     # N.B. Must yield the oid before acccessing it (to allow caller to fetch it
@@ -250,9 +573,175 @@ def iter_objects_in_commits (oids):
                     yield oid
     for oid in iter_commits_and_parents (oids):
         yield oid
-        commit = get_commit (oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree (commit.tree)
+        tree = _get_commit_tree (oid)
+        if tree not in visited:
+            yield from iter_objects_in_tree (tree)
+
+#objects reachable from tips that exists(oid) says are missing, in an order where every
+#object comes after the ones it points to, so a transfer cut short never leaves holes.
+#stops at commits that exist, having a commit means having its whole history
+#with depth, the commits within depth of tips are walked whether they exist or not, so the
+#peer can deepen a shallow history, and only the ones it does not have are sent
+#with blobs=False only commits and trees are walked (partial clone)
+@trace.traced
+def iter_missing_objects (tips, exists, depth=None, blobs=True):
+    visited = set ()
+    stop = exists
+    if depth:
+        within = get_commits_within (tips, depth)
+        stop = lambda oid: oid not in within
+
+    # Parents before children (iterative post-order)
+    commits = []
+    for tip in tips:
+        stack = [(tip, False)]
+        while stack:
+            oid, done = stack.pop ()
+            if done:
+                commits.append (oid)
+                continue
+            if not oid or oid in visited or stop (oid):
+                continue
+            visited.add (oid)
+            stack.append ((oid, True))
+            stack.extend ((parent, False) for parent in _get_parents (oid))
+
+    # A tree we have is complete, so only missing trees are opened
+    def iter_tree (oid):
+        visited.add (oid)
+        for type_, entry_oid, _ in _iter_tree_entries (oid):
+            if entry_oid in visited or (type_ != 'tree' and not blobs) or exists (entry_oid):
+                continue
+            if type_ == 'tree':
+                yield from iter_tree (entry_oid)
+            else:
+                visited.add (entry_oid)
+                yield entry_oid
+        yield oid
+
+    for oid in commits:
+        if exists (oid):
+            continue
+        tree = _get_commit_tree (oid)
+        if tree not in visited and not exists (tree):
+            yield from iter_tree (tree)
+        yield oid
+
+#commits at most depth steps down from tips, the tips being the first step
+def get_commits_within (tips, depth):
+    within = set ()
+    level = [oid for oid in tips if oid]
+    for _ in range (depth):
+        level = [oid for oid in set (level) if oid not in within]
+        within.update (level)
+        level = [parent for oid in level for parent in _get_parents (oid)]
+    return within
+
+#where the history sent to a peer is cut: the commits at depth and any of the sent
+#commits that are shallow here already
+def get_shallow_cut (tips, depth, oids):
+    cut = data.get_shallow () & set (oids)
+    if depth:
+        within = get_commits_within (tips, depth)
+        cut |= {oid for oid in within
+                if any (parent not in within for parent in _get_parents (oid))}
+    return cut
+
+#after a fetch: commits from candidates (and the ones that were shallow already) whose
+#parents we do not all have become the shallow ones
+def update_shallow (candidates):
+    shallow = {oid for oid in data.get_shallow () | set (candidates)
+               if not all (data.object_exists (parent) for parent in _read_commit (oid).parents)}
+    data.set_shallow (shallow)
+
+#for a peer that has the commits haves, returns exists(oid) telling which of the objects
+#reachable from tips it already has: every commit below the haves we know of and everything in the
+#trees of the ones the new commits sit on. Walks newest generation first like
+#_paint_down_to_common and stops once only commits the peer has are left.
+#shallow are the peer's shallow commits, it does not have what is below them
+@trace.traced
+def peer_has (tips, haves, shallow=()):
+    shallow = set (shallow)
+    HAVE = 1
+    flags = {}
+    queue = []
+    counter = itertools.count ()
+    queued = defaultdict (int) #oid -> its entries in the queue
+    unmarked = 0 #queue entries for commits the peer may not have, the walk ends when there are none
+
+    def push (oid, flag):
+        nonlocal unmarked
+        if flag and flags.get (oid) == 0:
+            unmarked -= queued[oid] #its entries already queued are had now
+        flags[oid] = flag
+        queued[oid] += 1
+        if not flag:
+            unmarked += 1
+        heapq.heappush (queue, (-_generation (oid), next (counter), oid))
+
+    for oid in haves:
+        if data.object_exists (oid):
+            push (oid, HAVE)
+    for oid in tips:
+        if oid not in flags:
+            push (oid, 0)
+
+    new = []
+    while unmarked:
+        _, _, oid = heapq.heappop (queue)
+        queued[oid] -= 1
+        flag = flags[oid]
+        if not flag:
+            unmarked -= 1
+            new.append (oid)
+        elif oid in shallow:
+            continue
+        for parent in _get_parents (oid):
+            # A parent only ever goes from new to had, never back
+            if parent not in flags or flag > flags[parent]:
+                push (parent, flag)
+
+    have_commits = {oid for oid, flag in flags.items () if flag}
+    have_objects = set ()
+    def add_tree (oid):
+        have_objects.add (oid)
+        for type_, entry_oid, _ in _iter_tree_entries (oid):
+            if entry_oid not in have_objects:
+                if type_ == 'tree':
+                    add_tree (entry_oid)
+                else:
+                    have_objects.add (entry_oid)
+    for oid in new:
+        if flags[oid]:
+            continue
+        for parent in _get_parents (oid):
+            if parent in have_commits and _get_commit_tree (parent) not in have_objects:
+                add_tree (_get_commit_tree (parent))
+
+    return lambda oid: oid in have_commits or oid in have_objects
+
+GC_GRACE = 14 * 24 * 60 * 60 #unreachable objects younger than this (seconds) are kept
+
+#everything reachable from the refs (HEAD and MERGE_HEAD among them) and the index.
+#blobs a partial clone doesn't have are yielded too but never fetched, nothing reads them
+@trace.traced
+def iter_reachable_objects ():
+    yield from iter_objects_in_commits ({ref.value for _, ref in data.iter_refs ()})
+    with data.get_index () as index:
+        oids = [entry.oid for entry in index.values ()]
+        oids.extend (index.trees.values ())
+    yield from oids
+
+#returns (objects packed, objects pruned, bytes reclaimed), see data.gc
+@trace.traced
+def gc (grace=GC_GRACE):
+    result = data.gc (set (iter_reachable_objects ()), grace)
+    # Pruned commits may still be in the commit-graph, it is written again from the refs
+    data.remove_commit_graph ()
+    update_commit_graph (ref.value for _, ref in data.iter_refs ())
+    return result
+
+MIN_ABBREV = 4 #shortest abbreviated oid we try to resolve
 
 #on passing the ref name it gives its OID
 def get_oid(name): 
@@ -268,35 +757,43 @@ def get_oid(name):
     ]
 
     for ref in refs_to_try:
-        ref_val = data.get_ref(ref, deref=False)
-        if ref_val and ref_val.value:
-            return ref_val.value
+        if data.get_ref(ref, deref=False).value:
+            return data.get_ref(ref).value #follow symbolic refs like HEAD to the commit
 
     # Name is a raw SHA1
     is_hex = all(c in string.hexdigits for c in name)
     if len(name) == 40 and is_hex:
         return name
 
+    # Or an abbreviated one, as long as only one object starts with it
+    if MIN_ABBREV <= len(name) < 40 and is_hex:
+        found = data.find_objects (name.lower ())
+        if len (found) > 1:
+            raise ValueError(f'error: short object ID {name} is ambiguous')
+        if found:
+            return found[0]
+
     raise ValueError(f'error: {name} is not a valid reference or object ID')
 
 
+@trace.traced
 def add (filenames):
+    to_hash = {} #path -> stat of files whose content may have changed
+    added = [] #every file given or found, changed or not
 
     def add_file (filename):
         # Normalize path
         filename = os.path.relpath (filename)
-        with open (filename, 'rb') as f:
-            oid = data.hash_object (f.read ())
-        index[filename] = oid
+        added.append (filename)
+        st = os.stat (filename)
+        entry = index.get (filename)
+        if entry and _stat_matches (entry, st):
+            return
+        to_hash[filename] = st
 
     def add_directory (dirname):
-        for root, _, filenames in os.walk (dirname):
-            for filename in filenames:
-                # Normalize path
-                path = os.path.relpath (f'{root}/{filename}')
-                if is_ignored (path) or not os.path.isfile (path):
-                    continue
-                add_file (path)
+        for path in _iter_working_files (dirname):
+            add_file (path)
 
     with data.get_index () as index:
         for name in filenames:
@@ -304,6 +801,31 @@ def add (filenames):
                 add_file (name)
             elif os.path.isdir (name):
                 add_directory (name)
+        _drop_replaced_entries (index, added)
+        for path, oid in _hash_files (list (to_hash)).items ():
+            index[path] = _index_entry (oid, to_hash[path])
+
+#a file that replaced a directory of the same name, or a directory that replaced a file,
+#leaves entries behind that a tree can't hold next to it: drops the entries under each of
+#paths and the ones for their parent directories
+def _drop_replaced_entries (index, paths):
+    if not paths:
+        return
+    indexed = sorted (index)
+    indexed_set = set (indexed)
+    for path in paths:
+        parent = path.rpartition ('/')[0]
+        while parent:
+            if parent in indexed_set:
+                del index[parent]
+                indexed_set.discard (parent)
+            parent = parent.rpartition ('/')[0]
+        i = bisect.bisect_left (indexed, f'{path}/')
+        while i < len (indexed) and indexed[i].startswith (f'{path}/'):
+            if indexed[i] in indexed_set:
+                del index[indexed[i]]
+                indexed_set.discard (indexed[i])
+            i += 1
 
 def is_ignored(path):
     return os.path.normpath(path).startswith('.megit') 
\ No newline at end of file
@@ -9,18 +9,35 @@ from . import base #. means same folder
 from . import data 
 from . import remote
 from . import diff
+from . import server
+from . import trace
 
 def main():
     with data.change_git_dir ('.'):
         args = parse_args() #whatever is written in terminal is passed to args
-        args.func(args) #what ever is returned above eg init that function is called 
+        if args.trace_json:
+            trace.enable (args.trace_json)
+        elif args.trace:
+            trace.enable ()
+        with trace.span (f'megit {args.command}'):
+            args.func(args) #what ever is returned above eg init that function is called 
+
+#argparse turns a ValueError from a type into "invalid value", which would hide why the name
+#didn't resolve (say an ambiguous short oid), an ArgumentTypeError keeps the message
+def _oid (name):
+    try:
+        return base.get_oid (name)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError (str (e))
 
 def parse_args():
     parser = argparse.ArgumentParser() #main top level like megit
+    parser.add_argument ('--trace', action='store_true', help='print where the time went (also MEGIT_TRACE=1)')
+    parser.add_argument ('--trace-json', metavar='FILE', help='write a Chrome trace-event file (also MEGIT_TRACE=FILE)')
     commands = parser.add_subparsers(dest='command') #parser says it will be subparsers subcommands whose name will be stored in args.command
     commands.required = True #a subcommand is necesaary
 
-    oid = base.get_oid #(assigning function to oid) so whenever we do oid("name") it gives us the oid
+    oid = _oid #so whenever we do oid("name") it gives us the oid
 
     init_parser = commands.add_parser('init')
     init_parser.set_defaults(func=init) # If “init” is used, attach your init() function
@@ -99,10 +116,20 @@ def parse_args():
     merge_base_parser.set_defaults (func=merge_base)
     merge_base_parser.add_argument ('commit1', type=oid)
     merge_base_parser.add_argument ('commit2', type=oid)
+    merge_base_parser.add_argument ('--all', action='store_true') #print every best merge base
 
     fetch_parser = commands.add_parser ('fetch')
     fetch_parser.set_defaults (func=fetch)
     fetch_parser.add_argument ('remote')
+    fetch_parser.add_argument ('--depth', type=int, help='fetch only this many commits of each branch')
+    fetch_parser.add_argument ('--filter', choices=['blob:none'], help='leave blobs out until they are needed')
+
+    clone_parser = commands.add_parser ('clone')
+    clone_parser.set_defaults (func=clone)
+    clone_parser.add_argument ('remote')
+    clone_parser.add_argument ('directory', nargs='?')
+    clone_parser.add_argument ('--depth', type=int, help='fetch only this many commits of each branch')
+    clone_parser.add_argument ('--filter', choices=['blob:none'], help='leave blobs out until they are needed')
 
     push_parser = commands.add_parser ('push')
     push_parser.set_defaults (func=push)
@@ -113,6 +140,33 @@ def parse_args():
     add_parser.set_defaults (func=add)
     add_parser.add_argument ('files', nargs='+')
 
+    migrate_objects_parser = commands.add_parser ('migrate-objects')
+    migrate_objects_parser.set_defaults (func=migrate_objects)
+
+    repack_parser = commands.add_parser ('repack')
+    repack_parser.set_defaults (func=repack)
+
+    serve_parser = commands.add_parser ('serve')
+    serve_parser.set_defaults (func=serve)
+    serve_parser.add_argument ('root', nargs='?', default='.') #repositories are served from under this directory
+    serve_parser.add_argument ('--host', default='localhost')
+    serve_parser.add_argument ('--port', type=int, default=server.DEFAULT_PORT)
+    serve_parser.add_argument ('--unix', help='listen on this unix socket instead of TCP')
+
+    pack_refs_parser = commands.add_parser ('pack-refs')
+    pack_refs_parser.set_defaults (func=pack_refs)
+
+    commit_graph_parser = commands.add_parser ('commit-graph')
+    commit_graph_parser.set_defaults (func=commit_graph)
+
+    fsck_parser = commands.add_parser ('fsck')
+    fsck_parser.set_defaults (func=fsck)
+
+    gc_parser = commands.add_parser ('gc')
+    gc_parser.set_defaults (func=gc)
+    gc_parser.add_argument ('--prune', type=float, default=base.GC_GRACE / 86400,
+                            help='prune unreachable objects older than this many days')
+
     return parser.parse_args() #calls argparse’s method, not this function 
 
 def init(args):
@@ -120,9 +174,7 @@ def init(args):
     print (f'Initialized empty megit repository in {os.getcwd()}/{data.GIT_DIR}') #current working directory.
 
 def hash_object(args): #type ?
-    with open (args.file, 'rb') as f: 
-        print (data.hash_object(f.read(), type_=args.type)) #reads the file bytess 
-        #the oid is returned and printed 
+    print (data.hash_file(args.file, type_=args.type)) #streams the file, the oid is returned and printed 
 
 def cat_file(args):
     sys.stdout.flush () # It writes them out.
@@ -159,16 +211,16 @@ def show(args): #commit oid passed to print
     if commit.parents:
         parent_tree = base.get_commit(commit.parents[0]).tree
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(base.get_tree (parent_tree), base.get_tree (commit.tree))
     sys.stdout.flush ()
-    sys.stdout.buffer.write (result)
+    for chunk in diff.iter_diff_changes (base.iter_tree_changes (parent_tree, commit.tree)):
+        sys.stdout.buffer.write (chunk) #hunks go out as soon as they are ready
 
 def _diff (args):
     tree = args.commit and base.get_commit (args.commit).tree
 
-    result = diff.diff_trees (base.get_tree (tree), base.get_working_tree ())
     sys.stdout.flush ()
-    sys.stdout.buffer.write (result)
+    for chunk in diff.iter_diff_changes (base.iter_working_tree_changes (tree)):
+        sys.stdout.buffer.write (chunk)
 
 def checkout (args):
     base.checkout (args.commit)
@@ -206,6 +258,7 @@ def k (args):
         f.write(dot)
 
     # Generate PNG using Graphviz
+    trace.count ('subprocess')
     subprocess.run(["dot", "-Tpng", "graph.dot", "-o", "graph.png"])
 
     # Open image in default viewer based on OS
@@ -215,8 +268,10 @@ def k (args):
         if system == "Windows":
             os.startfile("graph.png")  # Windows native
         elif system == "Darwin":
+            trace.count ('subprocess')
             subprocess.run(["open", "graph.png"])  # macOS
         elif system == "Linux":
+            trace.count ('subprocess')
             subprocess.run(["xdg-open", "graph.png"])  # Linux desktop
         else:
             print("Graph generated: graph.png (please open it manually)")
@@ -237,8 +292,7 @@ def status(args):
 
     print ('\nChanges to be committed:\n')
     HEAD_tree = HEAD and base.get_commit (HEAD).tree
-    for path, action in diff.iter_changed_files (base.get_tree (HEAD_tree),
-                                                 base.get_working_tree ()):
+    for path, action in diff.iter_change_actions (base.iter_working_tree_changes (HEAD_tree)):
         print (f'{action:>12}: {path}')
 
 def reset (args):
@@ -248,13 +302,51 @@ def merge (args):
     base.merge (args.commit)
 
 def merge_base (args):
-    print (base.get_merge_base (args.commit1, args.commit2))
+    if args.all:
+        for oid in base.get_merge_bases (args.commit1, args.commit2):
+            print (oid)
+    else:
+        print (base.get_merge_base (args.commit1, args.commit2))
 
 def fetch (args):
-    remote.fetch (args.remote)
+    remote.fetch (args.remote, args.depth, args.filter)
+
+def clone (args):
+    directory = remote.clone (args.remote, args.directory, args.depth, args.filter)
+    print (f'Cloned {args.remote} into {directory}')
 
 def push (args):
     remote.push (args.remote, f'refs/heads/{args.branch}')
 
 def add (args):
-    base.add (args.files)
\ No newline at end of file
+    base.add (args.files)
+
+def migrate_objects (args):
+    print (f'Migrated {data.migrate_objects ()} objects')
+
+def repack (args):
+    print (f'Packed {data.repack ()} objects')
+
+def serve (args):
+    where = args.unix or f'{args.host}:{args.port}'
+    print (f'Serving {os.path.abspath (args.root)} on {where}')
+    server.serve (args.root, args.host, args.port, args.unix)
+
+def pack_refs (args):
+    print (f'Packed {data.pack_refs ()} refs')
+
+def commit_graph (args):
+    #adds everything reachable from any ref to the commit-graph
+    base.update_commit_graph (ref.value for _, ref in data.iter_refs ())
+    print (f'{len (data.get_commit_graph ())} commits in commit-graph')
+
+def fsck (args):
+    problems = data.fsck ()
+    for problem in problems:
+        print (problem)
+    if problems:
+        sys.exit (1)
+
+def gc (args):
+    packed, pruned, reclaimed = base.gc (args.prune * 86400)
+    print (f'Packed {packed} objects, pruned {pruned}, reclaimed {reclaimed} bytes')
@@ -3,12 +3,24 @@ import os #standard module it provides functions to interact with the underlying
 import hashlib # built‑in library for cryptographic hashes.
 import shutil
 import json 
+import zlib #objects are stored compressed on disk
+import mmap
+import struct
+import time
+import posixpath
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableMapping
 from contextlib import contextmanager
 
+from . import pack
+from . import graph
+from . import trace
+
 GIT_DIR = None #the directory name which is made to store all repo data locally 
 
+CHUNK_SIZE = 64 * 1024 #files are hashed in pieces of this size so big ones never sit in memory
+
 @contextmanager
 def change_git_dir (new_dir):
     global GIT_DIR
@@ -20,8 +32,14 @@ def change_git_dir (new_dir):
 def init(): #makes our .megit and objects directory for storage the object database
     os.makedirs (GIT_DIR) #command to make a directory 
     os.makedirs (f'{GIT_DIR}/objects')
+    _mark_migrated ()
     
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
+
+# Raw ref contents read so far in this process, (git dir, ref) -> value or None if missing.
+# Our own writes keep it up to date, refs are not expected to change under us mid-command
+_refs = {}
+_packed_refs = {} #git dir -> {ref: oid} as read from packed-refs
     
 #Updates or creates a reference file with the given OID (or symbolic value).
 def update_ref (ref, value, deref=True): #ref:name value:named tuple
@@ -34,36 +52,100 @@ def update_ref (ref, value, deref=True): #ref:name value:named tuple
 
     ref_path = f'{GIT_DIR}/{ref}'
     os.makedirs (os.path.dirname(ref_path), exist_ok = True)
-    with open (ref_path, 'w') as f:
+    # Written aside and renamed so readers never see a half written ref
+    fd, tmp_path = _mkstemp (dir=os.path.dirname (ref_path), prefix='tmp_ref_')
+    with os.fdopen (fd, 'w') as f:
         f.write (value) 
+    os.replace (tmp_path, ref_path)
+    _refs[(GIT_DIR, ref)] = value
+    trace.count ('ref.update')
 
 def get_ref (ref, deref=True):  #returns the oid to the reference name passed
+    trace.count ('ref.resolve')
     return _get_ref_internal (ref, deref)[1] #value
 
 def delete_ref (ref, deref=True):
     ref = _get_ref_internal (ref, deref)[0]
-    os.remove (f'{GIT_DIR}/{ref}')
+    packed = _get_packed_refs ()
+    if ref in packed:
+        packed = dict (packed)
+        del packed[ref]
+        _write_packed_refs (packed)
+    if os.path.isfile (f'{GIT_DIR}/{ref}'):
+        os.remove (f'{GIT_DIR}/{ref}')
+    _refs[(GIT_DIR, ref)] = None
 
 #Returns the actual reference path and a RefValue namedtuple
 def _get_ref_internal (ref,deref):
-    ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open (ref_path) as f:
-            value =  f.read().strip() #either oid or symbolic ref which points to another ref: refs/heads/main
+    ref = posixpath.normpath (ref) #refs/remote//main is the same ref, and the same cache entry, as refs/remote/main
+    value = _read_ref (ref) #either oid or symbolic ref which points to another ref: refs/heads/main
     symbolic = bool (value) and value.startswith ('ref:')
     if symbolic:
         value = value.split (':', 1)[1].strip ()
         if deref:
             return _get_ref_internal (value, deref=True)
     return ref, RefValue (symbolic=symbolic, value=value)
+
+#a loose ref file wins over the same ref in packed-refs
+def _read_ref (ref):
+    key = (GIT_DIR, ref)
+    if key not in _refs:
+        ref_path = f'{GIT_DIR}/{ref}'
+        trace.count ('ref.read')
+        if os.path.isfile (ref_path):
+            with open (ref_path) as f:
+                _refs[key] = f.read ().strip ()
+        else:
+            _refs[key] = _get_packed_refs ().get (ref)
+    return _refs[key]
+
+#  packed-refs holds one '<oid> <ref>' line per ref, sorted by ref
+def _get_packed_refs ():
+    if GIT_DIR not in _packed_refs:
+        packed = {}
+        if os.path.isfile (f'{GIT_DIR}/packed-refs'):
+            with open (f'{GIT_DIR}/packed-refs') as f:
+                for line in f:
+                    oid, ref = line.split ()
+                    packed[ref] = oid
+        _packed_refs[GIT_DIR] = packed
+    return _packed_refs[GIT_DIR]
+
+def _write_packed_refs (packed):
+    fd, tmp_path = _mkstemp (dir=GIT_DIR, prefix='tmp_ref_')
+    with os.fdopen (fd, 'w') as f:
+        f.writelines (f'{packed[ref]} {ref}\n' for ref in sorted (packed))
+    os.replace (tmp_path, f'{GIT_DIR}/packed-refs')
+    _packed_refs[GIT_DIR] = packed
+
+def _iter_loose_refs ():
+    for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
+        root = os.path.relpath(root, GIT_DIR) #os.path.relpath('/a/b/c/d', '/a/b')  →  'c/d'
+        yield from (f'{root}/{name}' for name in filenames if not name.startswith ('tmp_ref_'))
+
+#moves every loose ref under refs/ into packed-refs, returns how many were moved
+@trace.traced
+def pack_refs ():
+    packed = dict (_get_packed_refs ())
+    loose = []
+    for refname in _iter_loose_refs ():
+        value = _read_ref (refname)
+        if not value or value.startswith ('ref:'):
+            continue #symbolic refs stay loose
+        packed[refname] = value
+        loose.append (refname)
+    _write_packed_refs (packed)
+    # Values do not change, so the cached ones stay right
+    for refname in loose:
+        os.remove (f'{GIT_DIR}/{refname}')
+    return len (loose)
         
 #Iterates over all refs in the repository, yielding each one with its value.
 def iter_refs (prefix='', deref=True): 
     refs = ['HEAD', 'MERGE_HEAD']
-    for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
-        root = os.path.relpath(root, GIT_DIR) #os.path.relpath('/a/b/c/d', '/a/b')  →  'c/d'
-        refs.extend(f'{root}/{name}' for name in filenames)
+    refs.extend (_iter_loose_refs ())
+    loose = set (refs)
+    refs.extend (ref for ref in _get_packed_refs () if ref not in loose)
     for refname in refs:
         if not refname.startswith(prefix):#skip all refs which not match the prefix(filter)
             continue
@@ -71,46 +153,738 @@ def iter_refs (prefix='', deref=True):
         if ref.value:
             yield refname, ref
 
-@contextmanager
-def get_index ():
-    index = {}
-    if os.path.isfile (f'{GIT_DIR}/index'):
-        with open (f'{GIT_DIR}/index') as f:
-            index = json.load (f)
+#least recently used cache bounded by the total size of its entries
+class LRUCache:
+
+    def __init__ (self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict () #key -> (value, size), oldest first
+
+    def __len__ (self):
+        return len (self._entries)
+
+    def get (self, key):
+        found = self._entries.get (key)
+        if found is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end (key)
+        self.hits += 1
+        return found[0]
+
+    def put (self, key, value, size):
+        if size > self.max_size:
+            return
+        old = self._entries.pop (key, None)
+        if old:
+            self.size -= old[1]
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted) = self._entries.popitem (last=False)
+            self.size -= evicted
+
+    def stats (self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len (self._entries), 'size': self.size}
+
+#one index entry: the blob oid plus the stat data of the file when it was hashed
+IndexEntry = namedtuple('IndexEntry', ['oid', 'mtime', 'size', 'ino', 'mode'])
+
+#  Index file layout (entries and trees sorted by path, so lookups are a binary search):
+#    'MIND' version entry_count tree_count
+#    entry_count * (20 byte oid, mtime, size, ino, mode, path offset, path length)
+#    tree_count * (20 byte tree oid, path offset, path length)
+#    paths, utf-8, offsets are from the start of the paths
+#    sha1 of everything above
+INDEX_SIGNATURE = b'MIND'
+INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct ('>4sIII')
+_INDEX_ENTRY = struct.Struct ('>20sqQQIII')
+_INDEX_TREE = struct.Struct ('>20sII')
+_INDEX_PATH = struct.Struct ('>II') #the last two fields of an entry
+
+#the index: path -> IndexEntry, plus the cache-tree, the tree oid of every directory
+#whose entries have not changed since it was last written ('' is the root)
+#entries are read straight from the mapped file until the index is first modified
+class Index (MutableMapping):
+
+    def __init__ (self, map_=None):
+        self._map = map_
+        self._entries = None #path -> IndexEntry, only built once something changes
+        self.trees = {}
+        self.dirty = False
+        self._count = 0
+        if map_ is None:
+            self._entries = {}
+        else:
+            assert len (map_) >= _INDEX_HEADER.size + 20, 'Corrupt index'
+            signature, version, self._count, tree_count = _INDEX_HEADER.unpack_from (map_, 0)
+            assert signature == INDEX_SIGNATURE and version == INDEX_VERSION, 'Unknown index format'
+            trees_start = _INDEX_HEADER.size + _INDEX_ENTRY.size * self._count
+            self._paths_start = trees_start + _INDEX_TREE.size * tree_count
+            # Paths are stored in record order, so the last record's path ends them. Checking
+            # the size is enough to catch a cut short file, verify() hashes the whole of it
+            assert len (map_) >= self._paths_start + 20, 'Corrupt index'
+            if tree_count:
+                _, offset, length = _INDEX_TREE.unpack_from (map_, self._paths_start - _INDEX_TREE.size)
+            elif self._count:
+                offset, length = _INDEX_PATH.unpack_from (map_, trees_start - _INDEX_PATH.size)
+            else:
+                offset = length = 0
+            assert len (map_) == self._paths_start + offset + length + 20, 'Corrupt index'
+            for i in range (tree_count):
+                oid, offset, length = _INDEX_TREE.unpack_from (map_, trees_start + _INDEX_TREE.size * i)
+                self.trees[self._path (offset, length).decode ()] = oid.hex ()
+        self._saved_trees = dict (self.trees)
+
+    #checks the sha1 trailer, for fsck
+    def verify (self):
+        if self._map is not None:
+            assert hashlib.sha1 (self._map[:-20]).digest () == self._map[-20:], 'Corrupt index'
+
+    def _path (self, offset, length):
+        start = self._paths_start + offset
+        return self._map[start:start + length]
 
-    yield index
+    def _entry_path (self, i):
+        start = _INDEX_HEADER.size + _INDEX_ENTRY.size * (i + 1) - _INDEX_PATH.size
+        return self._path (*_INDEX_PATH.unpack_from (self._map, start))
 
-    with open (f'{GIT_DIR}/index', 'w') as f:
-        json.dump (index, f)
+    def _read_entry (self, i):
+        oid, mtime, size, ino, mode, offset, length = _INDEX_ENTRY.unpack_from (
+            self._map, _INDEX_HEADER.size + _INDEX_ENTRY.size * i)
+        return (self._path (offset, length).decode (),
+                IndexEntry (oid.hex (), mtime, size, ino, mode))
 
-def hash_object(data, type_='blob'): #hashes the file name or dir it uses the sha1 hash this is the name by which we store so that it is unique
+    #utf-8 keeps the code point order, so the bytes are sorted like the paths
+    def _find (self, path):
+        path = path.encode ()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._entry_path (mid)
+            if found < path:
+                lo = mid + 1
+            elif found > path:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _load (self):
+        if self._entries is None:
+            self._entries = dict (self._read_entry (i) for i in range (self._count))
+        return self._entries
+
+    def __getitem__ (self, path):
+        if self._entries is not None:
+            return self._entries[path]
+        i = self._find (path)
+        if i is None:
+            raise KeyError (path)
+        return self._read_entry (i)[1]
+
+    def __iter__ (self):
+        if self._entries is not None:
+            return iter (self._entries)
+        return (self._entry_path (i).decode () for i in range (self._count))
+
+    def __len__ (self):
+        if self._entries is not None:
+            return len (self._entries)
+        return self._count
+
+    #in one pass over the file instead of a lookup per path
+    def items (self):
+        if self._entries is not None:
+            return self._entries.items ()
+        return [self._read_entry (i) for i in range (self._count)]
+
+    def __setitem__ (self, path, entry):
+        entries = self._load ()
+        old = entries.get (path)
+        if old == entry:
+            return
+        if old is None or old.oid != entry.oid: #only the stat data changing keeps the trees valid
+            self._invalidate (path)
+        entries[path] = entry
+        self.dirty = True
+
+    def __delitem__ (self, path):
+        del self._load ()[path]
+        self._invalidate (path)
+        self.dirty = True
+
+    #forgets the cached trees of every directory on the way to path
+    def _invalidate (self, path):
+        while path:
+            path = path.rpartition ('/')[0]
+            self.trees.pop (path, None)
+
+    def modified (self):
+        return self.dirty or self.trees != self._saved_trees
+
+    def write (self, path):
+        paths = bytearray ()
+        def add_path (name):
+            name = name.encode ()
+            paths.extend (name)
+            return len (paths) - len (name), len (name)
+
+        entries = sorted (self.items ())
+        trees = sorted (self.trees.items ())
+        out = bytearray (_INDEX_HEADER.pack (INDEX_SIGNATURE, INDEX_VERSION, len (entries), len (trees)))
+        for name, entry in entries:
+            out += _INDEX_ENTRY.pack (bytes.fromhex (entry.oid), entry.mtime, entry.size,
+                                      entry.ino, entry.mode, *add_path (name))
+        for name, oid in trees:
+            out += _INDEX_TREE.pack (bytes.fromhex (oid), *add_path (name))
+        out += paths
+        out += hashlib.sha1 (out).digest ()
+
+        # A crash halfway leaves the old index in place
+        fd, tmp_path = _mkstemp (dir=GIT_DIR, prefix='tmp_index_')
+        with os.fdopen (fd, 'wb') as f:
+            f.write (out)
+        os.replace (tmp_path, path)
+        trace.count ('index.save', len (out))
+
+    def close (self):
+        if self._map is not None:
+            self._map.close ()
+            self._map = None
+
+#reads an index written as json by older versions, it gets converted on the next write
+def _read_json_index (saved):
+    if saved.get ('version') != 2:
+        # Oldest index: just path -> entry, without the cache-tree
+        saved = {'entries': saved, 'trees': {}}
+    index = Index ()
+    for path, entry in saved['entries'].items ():
+        if isinstance (entry, str):
+            # Old index without stat data, it will be rehashed once
+            entry = [entry, 0, 0, 0, 0]
+        index._entries[path] = IndexEntry (*entry)
+    index.trees = saved['trees']
+    index.dirty = True
+    return index
+
+#yields the index, it is only written back if it was modified
+@contextmanager
+def get_index ():
+    path = f'{GIT_DIR}/index'
+    index = Index ()
+    if os.path.isfile (path) and os.path.getsize (path):
+        trace.count ('index.load', os.path.getsize (path))
+        with open (path, 'rb') as f:
+            if f.read (1) == b'{':
+                f.seek (0)
+                index = _read_json_index (json.load (f))
+            else:
+                index = Index (mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ))
+    try:
+        yield index
+        if index.modified ():
+            index.write (path)
+    finally:
+        index.close ()
+
+def hash_object(data, type_='blob', write=True): #hashes the file name or dir it uses the sha1 hash this is the name by which we store so that it is unique
     obj = type_.encode()+b'\x00'+data
     oid = hashlib.sha1(obj).hexdigest() #coverts to hash then to hexdecimal string
-    with open(f'{GIT_DIR}/objects/{oid}','wb') as out: #binary mode open file or create file to this path (it creates the file with oid in .megit/objects)
-        out.write(obj)
+    if write and not object_exists (oid): #write=False only computes the oid, used when comparing with the working tree
+        _write_object (oid, obj)
     return oid 
-    #after opening close closed itself to prevent leaks
+
+#same as hash_object but reads the file in chunks instead of all at once
+def hash_file (path, type_='blob', write=True):
+    header = type_.encode () + b'\x00'
+    sha = hashlib.sha1 (header)
+    with open (path, 'rb') as f:
+        for chunk in iter (lambda: f.read (CHUNK_SIZE), b''):
+            sha.update (chunk)
+    oid = sha.hexdigest ()
+    if write and not object_exists (oid):
+        oid = _stream_object (path, header)
+    return oid
+
+#compresses the file into a temp file and renames it into place, returns the oid of what was written
+def _stream_object (path, header):
+    fd, tmp_path = _mkstemp (dir=f'{GIT_DIR}/objects', prefix='tmp_obj_')
+    try:
+        sha = hashlib.sha1 (header)
+        compressor = zlib.compressobj ()
+        with os.fdopen (fd, 'wb') as out, open (path, 'rb') as f:
+            out.write (compressor.compress (header))
+            for chunk in iter (lambda: f.read (CHUNK_SIZE), b''):
+                # Hash again while writing, in case the file changed since the first pass
+                sha.update (chunk)
+                out.write (compressor.compress (chunk))
+            out.write (compressor.flush ())
+            trace.count ('object.write', f.tell ())
+        oid = sha.hexdigest ()
+        _install_object (tmp_path, _object_path (oid))
+    except BaseException:
+        os.remove (tmp_path)
+        raise
+    return oid
+
+#like tempfile.mkstemp, but the file is created 0666 less the umask rather than 0600,
+#so what we rename into place is readable by others the way a plain open() would make it
+def _mkstemp (dir, prefix):
+    while True:
+        path = f'{dir}/{prefix}{os.urandom (6).hex ()}'
+        try:
+            return os.open (path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+        except FileExistsError:
+            continue
+
+#atomically moves a finished temp file to its object path
+def _install_object (tmp_path, path):
+    os.makedirs (os.path.dirname (path), exist_ok=True)
+    try:
+        os.replace (tmp_path, path)
+    except FileNotFoundError:
+        # A gc may have removed the directory as empty in the meantime
+        os.makedirs (os.path.dirname (path), exist_ok=True)
+        os.replace (tmp_path, path)
+
+#objects live in objects/ab/cdef... so no single directory gets too big
+def _object_path (oid, git_dir=None):
+    return f'{git_dir or GIT_DIR}/objects/{oid[:2]}/{oid[2:]}'
+
+#old repositories kept every object uncompressed directly in objects/
+def _legacy_object_path (oid, git_dir=None):
+    return f'{git_dir or GIT_DIR}/objects/{oid}'
+
+def _write_object (oid, obj, git_dir=None):
+    fd, tmp_path = _mkstemp (dir=f'{git_dir or GIT_DIR}/objects', prefix='tmp_obj_')
+    with os.fdopen (fd, 'wb') as out: #binary mode, written to a temp file so a crash never leaves half an object
+        out.write (zlib.compress (obj))
+    trace.count ('object.write', len (obj))
+    _install_object (tmp_path, _object_path (oid, git_dir))
+
+_packs = {} #git dir -> list of open packs, so the indexes are only mapped once per process
+
+#forgets what is cached about refs, packs and the commit-graph, for long running
+#processes (megit serve) whose repositories may be changed by others in between
+def drop_caches ():
+    _refs.clear ()
+    _packed_refs.clear ()
+    _packs.clear ()
+    _commit_graphs.clear ()
+    _shallow.clear ()
+    _promisors.clear ()
+
+def _get_packs (git_dir=None, reload=False):
+    git_dir = git_dir or GIT_DIR
+    if reload or git_dir not in _packs:
+        pack_dir = f'{git_dir}/objects/pack'
+        names = sorted (os.listdir (pack_dir)) if os.path.isdir (pack_dir) else []
+        _packs[git_dir] = [pack.Pack (f'{pack_dir}/{name[:-4]}')
+                           for name in names if name.endswith ('.idx')]
+    return _packs[git_dir]
+
+def _read_packed (oid, git_dir=None):
+    for p in _get_packs (git_dir):
+        found = p.read (oid)
+        if found:
+            type_, content = found
+            return type_.encode () + b'\x00' + content
+    return None
+
+#returns the raw object (type header + content), whichever layout it is stored in
+def _read_object (oid, git_dir=None):
+    obj = _read_local_object (oid, git_dir)
+    if obj is None and git_dir is None and get_promisor ():
+        # Partial clone, the remote it came from has the object
+        prefetch_objects ([oid])
+        obj = _read_local_object (oid)
+    if obj is None:
+        raise FileNotFoundError (f'Missing object {oid}')
+    trace.count ('object.read', len (obj))
+    return obj
+
+def _read_local_object (oid, git_dir=None):
+    obj = _read_packed (oid, git_dir)
+    if obj is not None:
+        return obj
+    try:
+        with open (_object_path (oid, git_dir), 'rb') as f:
+            return zlib.decompress (f.read ())
+    except FileNotFoundError:
+        pass
+    try:
+        with open (_legacy_object_path (oid, git_dir), 'rb') as f:
+            return f.read ()
+    except FileNotFoundError:
+        # Someone may have packed it while we were running
+        _get_packs (git_dir, reload=True)
+        return _read_packed (oid, git_dir)
+
+#the remote a partial clone was made from, blobs we don't have are fetched from it when needed
+def get_promisor ():
+    if GIT_DIR not in _promisors:
+        promisor = None
+        if os.path.isfile (f'{GIT_DIR}/promisor'):
+            with open (f'{GIT_DIR}/promisor') as f:
+                promisor = f.read ().strip ()
+        _promisors[GIT_DIR] = promisor
+    return _promisors[GIT_DIR]
+
+def set_promisor (remote_path):
+    with open (f'{GIT_DIR}/promisor', 'w') as f:
+        f.write (remote_path)
+    _promisors[GIT_DIR] = remote_path
+
+#in a partial clone, fetches all of oids we don't have in one go instead of one at a time
+#as they get read. Objects the promisor doesn't have either (working tree files) are skipped
+def prefetch_objects (oids):
+    promisor = get_promisor ()
+    if not promisor:
+        return
+    missing = sorted ({oid for oid in oids if oid and not object_exists (oid)})
+    if missing:
+        from . import remote #remote is built on top of data, so only imported when needed
+        trace.count ('object.promised')
+        remote.fetch_promised (promisor, missing)
 
 def get_object(oid, expected='blob'): #gives the file contents by passing its oid
-    with open (f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read() 
-        type_, _ , content = obj.partition(b'\x00')
-        type_ = type_.decode()
-        if expected is not None:
-            assert type_==expected, f'expected {expected} got {type_}'
-        return content 
-
-def object_exists (oid):
-    return os.path.isfile (f'{GIT_DIR}/objects/{oid}')
-
-def fetch_object_if_missing (oid, remote_git_dir):
-    if object_exists (oid):
+    obj = _read_object (oid)
+    type_, _ , content = obj.partition(b'\x00')
+    type_ = type_.decode()
+    if expected is not None:
+        assert type_==expected, f'expected {expected} got {type_}'
+    return content 
+
+_commit_graphs = {} #git dir -> loaded commit-graph
+
+def get_commit_graph ():
+    if GIT_DIR not in _commit_graphs:
+        _commit_graphs[GIT_DIR] = graph.CommitGraph (f'{GIT_DIR}/objects/info/commit-graphs')
+    return _commit_graphs[GIT_DIR]
+
+#read_commit(oid) returns (tree, parents) for commits that are not in the graph yet
+@trace.traced
+def update_commit_graph (tips, read_commit):
+    graph.update (f'{GIT_DIR}/objects/info/commit-graphs', tips, read_commit)
+    _commit_graphs.pop (GIT_DIR, None)
+
+_shallow = {} #git dir -> frozenset of the shallow commits
+_promisors = {} #git dir -> promisor remote or None
+
+#commits whose parents were left out by a shallow fetch, they are treated as root commits
+def get_shallow ():
+    if GIT_DIR not in _shallow:
+        oids = frozenset ()
+        if os.path.isfile (f'{GIT_DIR}/shallow'):
+            with open (f'{GIT_DIR}/shallow') as f:
+                oids = frozenset (f.read ().split ())
+        _shallow[GIT_DIR] = oids
+    return _shallow[GIT_DIR]
+
+def set_shallow (oids):
+    oids = frozenset (oids)
+    if oids == get_shallow ():
         return
-    remote_git_dir += '/.megit'
-    shutil.copy (f'{remote_git_dir}/objects/{oid}',
-                 f'{GIT_DIR}/objects/{oid}')
-    
-def push_object (oid, remote_git_dir):
-    remote_git_dir += '/.megit'
-    shutil.copy (f'{GIT_DIR}/objects/{oid}',
-                 f'{remote_git_dir}/objects/{oid}')
\ No newline at end of file
+    if oids:
+        fd, tmp_path = _mkstemp (dir=GIT_DIR, prefix='tmp_shallow_')
+        with os.fdopen (fd, 'w') as f:
+            f.writelines (f'{oid}\n' for oid in sorted (oids))
+        os.replace (tmp_path, f'{GIT_DIR}/shallow')
+    elif os.path.isfile (f'{GIT_DIR}/shallow'):
+        os.remove (f'{GIT_DIR}/shallow')
+    _shallow[GIT_DIR] = oids
+    # The graph has the commits at the old cut without parents, it gets rebuilt from scratch
+    remove_commit_graph ()
+
+def remove_commit_graph ():
+    graph.remove (f'{GIT_DIR}/objects/info/commit-graphs')
+    _commit_graphs.pop (GIT_DIR, None)
+
+def object_exists (oid, git_dir=None):
+    return (any (oid in p for p in _get_packs (git_dir)) or
+            os.path.isfile (_object_path (oid, git_dir)) or
+            os.path.isfile (_legacy_object_path (oid, git_dir)))
+
+#returns the oids of the objects starting with the hex prefix, at most limit of them
+#packs are binary searched and a loose object can only be in one fan-out directory
+def find_objects (prefix, limit=2):
+    found = set ()
+    for p in _get_packs ():
+        found.update (p.find_prefix (prefix, limit))
+    objects_dir = f'{GIT_DIR}/objects'
+    if os.path.isdir (f'{objects_dir}/{prefix[:2]}'):
+        found.update (prefix[:2] + rest for rest in os.listdir (f'{objects_dir}/{prefix[:2]}')
+                      if len (rest) == 38 and rest.startswith (prefix[2:]))
+    # Old flat layout, only listed until the objects are migrated
+    if not os.path.exists (f'{objects_dir}/{MIGRATED_MARKER}'):
+        found.update (name for name in os.listdir (objects_dir)
+                      if len (name) == 40 and name.startswith (prefix))
+    return sorted (found)[:limit]
+
+def fetch_object (oid, remote_git_dir):
+    _transfer_object (oid, f'{remote_git_dir}/.megit', GIT_DIR)
+
+#sends many objects to the remote at once, as a single pack
+@trace.traced
+def push_objects (oids, remote_git_dir):
+    dst_git_dir = f'{remote_git_dir}/.megit'
+    if pack.write_pack (f'{dst_git_dir}/objects/pack', oids, _split_object):
+        _get_packs (dst_git_dir, reload=True)
+
+def _transfer_object (oid, src_git_dir, dst_git_dir):
+    src_path = _object_path (oid, src_git_dir)
+    if os.path.isfile (src_path):
+        # Already compressed, share the file as is
+        _link_or_copy (src_path, _object_path (oid, dst_git_dir))
+    else:
+        _write_object (oid, _read_object (oid, src_git_dir), dst_git_dir)
+
+#hardlinks src to dst, object files and packs never change once written so repositories
+#can share them; copies instead across filesystems or where links are not supported
+def _link_or_copy (src, dst):
+    os.makedirs (os.path.dirname (dst), exist_ok=True)
+    try:
+        os.link (src, dst)
+        return
+    except FileExistsError:
+        return #same content, nothing to do
+    except OSError:
+        pass
+    fd, tmp_path = _mkstemp (dir=os.path.dirname (dst), prefix='tmp_obj_')
+    with os.fdopen (fd, 'wb') as out, open (src, 'rb') as f:
+        shutil.copyfileobj (f, out)
+    os.replace (tmp_path, dst)
+
+def _link_pack (src_path, dst_path):
+    # Pack first, readers only see it once the index exists
+    _link_or_copy (f'{src_path}.pack', f'{dst_path}.pack')
+    _link_or_copy (f'{src_path}.idx', f'{dst_path}.idx')
+
+#fetches objects from a repository on this machine. Whole packs holding any of them are
+#linked in, as links they take no extra space, the rest are linked as loose objects.
+#A pack also brings objects that were not asked for, so shallow repositories, where having
+#a commit does not mean having all of its history, pass whole_packs=False
+@trace.traced
+def fetch_objects (oids, remote_git_dir, whole_packs=True):
+    src_git_dir = f'{remote_git_dir}/.megit'
+    remaining = list (oids)
+    linked = False
+    for p in _get_packs (src_git_dir) if whole_packs else []:
+        if any (oid in p for oid in remaining):
+            _link_pack (p.path, f'{GIT_DIR}/objects/pack/{os.path.basename (p.path)}')
+            linked = True
+            remaining = [oid for oid in remaining if oid not in p]
+    if linked:
+        _get_packs (reload=True)
+    for oid in remaining:
+        fetch_object (oid, remote_git_dir)
+
+#links all objects, packs and commit-graph layers of a repository on this machine into ours,
+#a shallow repository's cut comes along with them
+@trace.traced
+def link_objects (remote_git_dir):
+    src_git_dir = f'{remote_git_dir}/.megit'
+    for p in _get_packs (src_git_dir):
+        _link_pack (p.path, f'{GIT_DIR}/objects/pack/{os.path.basename (p.path)}')
+    for oid in _iter_loose_objects (src_git_dir):
+        fetch_object (oid, remote_git_dir)
+    with change_git_dir (remote_git_dir):
+        shallow = get_shallow ()
+    set_shallow (shallow)
+
+    src_graph = graph.CommitGraph (f'{src_git_dir}/objects/info/commit-graphs')
+    if src_graph.chain:
+        graph_dir = f'{GIT_DIR}/objects/info/commit-graphs'
+        for name in src_graph.chain:
+            _link_or_copy (f'{src_graph.dir}/graph-{name}.graph', f'{graph_dir}/graph-{name}.graph')
+        # The chain file does get rewritten, so it is copied
+        fd, tmp_path = _mkstemp (dir=graph_dir, prefix='tmp_obj_')
+        with os.fdopen (fd, 'w') as f:
+            f.write ('\n'.join (src_graph.chain) + '\n')
+        os.replace (tmp_path, f'{graph_dir}/commit-graph-chain')
+
+    _get_packs (reload=True)
+    _commit_graphs.pop (GIT_DIR, None)
+
+#rewrites every flat uncompressed object into the fan-out layout, returns how many were moved
+@trace.traced
+def migrate_objects ():
+    migrated = 0
+    objects_dir = f'{GIT_DIR}/objects'
+    for name in os.listdir (objects_dir):
+        path = f'{objects_dir}/{name}'
+        if len (name) != 40 or not os.path.isfile (path):
+            continue
+        with open (path, 'rb') as f:
+            obj = f.read ()
+        _write_object (name, obj)
+        os.remove (path)
+        migrated += 1
+    _mark_migrated ()
+    return migrated
+
+#present in repositories whose objects are all in the fan-out layout: made by init, or
+#migrated. Older repositories may still have flat objects in objects/
+MIGRATED_MARKER = 'info/fan-out'
+
+def _mark_migrated ():
+    path = f'{GIT_DIR}/objects/{MIGRATED_MARKER}'
+    os.makedirs (os.path.dirname (path), exist_ok=True)
+    open (path, 'w').close ()
+
+#yields the oids of all loose objects, in both layouts
+def _iter_loose_objects (git_dir=None):
+    objects_dir = f'{git_dir or GIT_DIR}/objects'
+    for name in os.listdir (objects_dir):
+        path = f'{objects_dir}/{name}'
+        if len (name) == 2 and os.path.isdir (path):
+            for rest in os.listdir (path):
+                if len (rest) == 38:
+                    yield name + rest
+        elif len (name) == 40 and os.path.isfile (path):
+            yield name
+
+#returns the bytes freed, see _remove_file
+def _remove_loose_object (oid):
+    freed = 0
+    for path in (_object_path (oid), _legacy_object_path (oid)):
+        if os.path.isfile (path):
+            freed += _remove_file (path)
+    return freed
+
+#removes path and returns its size, or 0 when another hard link keeps the data on disk
+def _remove_file (path):
+    st = os.stat (path)
+    os.remove (path)
+    return st.st_size if st.st_nlink == 1 else 0
+
+def _split_object (oid):
+    type_, _, content = _read_object (oid).partition (b'\x00')
+    return type_.decode (), content
+
+#writes the objects as a pack to an open file, returns how many went in
+@trace.traced
+def write_pack_to (f, oids):
+    entries, _ = pack.write_pack_to (f, oids, _split_object)
+    return len (entries)
+
+#opens a temporary file in the pack directory to receive a pack into, see install_pack
+def new_pack_file ():
+    pack_dir = f'{GIT_DIR}/objects/pack'
+    os.makedirs (pack_dir, exist_ok=True)
+    fd, tmp_path = _mkstemp (dir=pack_dir, prefix='tmp_pack_')
+    return os.fdopen (fd, 'wb'), tmp_path
+
+#checks and indexes a received pack, after which its objects can be read
+@trace.traced
+def install_pack (tmp_path):
+    try:
+        path = pack.index_pack (tmp_path)
+    except Exception:
+        os.remove (tmp_path)
+        raise
+    _get_packs (reload=True)
+    return path
+
+#checks the sha1 trailers of the repository's binary files, which readers skip for speed.
+#returns a message for every damaged one
+def fsck ():
+    problems = []
+    pack_dir = f'{GIT_DIR}/objects/pack'
+    names = sorted (os.listdir (pack_dir)) if os.path.isdir (pack_dir) else []
+    for name in names:
+        if name.endswith ('.idx'):
+            try:
+                pack.Pack (f'{pack_dir}/{name[:-4]}').verify ()
+            except AssertionError as e:
+                problems.append (str (e))
+    try:
+        graph.CommitGraph (f'{GIT_DIR}/objects/info/commit-graphs').verify ()
+    except AssertionError as e:
+        problems.append (str (e))
+    try:
+        with get_index () as index:
+            index.verify ()
+    except AssertionError as e:
+        problems.append (str (e))
+    return problems
+
+#moves all loose objects into a single new pack, returns how many were packed
+@trace.traced
+def repack ():
+    oids = sorted (set (_iter_loose_objects ()))
+    if not oids:
+        return 0
+    path = pack.write_pack (f'{GIT_DIR}/objects/pack', oids, _split_object)
+    if not path:
+        return 0
+    _get_packs (reload=True)
+    packed = pack.Pack (path)
+    for oid in packed:
+        _remove_loose_object (oid)
+    _remove_empty_fanout_dirs ()
+    return len (packed)
+
+#packs the reachable loose objects, together with what is reachable in packs older than
+#grace seconds, into one pack and deletes the rest: those packs, and loose objects that are
+#unreachable and older than grace. Anything newer is left alone since another process may be
+#about to point a ref at it. Stale tmp_ files are removed too.
+#returns (objects packed, objects pruned, bytes reclaimed)
+@trace.traced
+def gc (reachable, grace):
+    objects_dir = f'{GIT_DIR}/objects'
+    cutoff = time.time () - grace
+
+    loose = set (_iter_loose_objects ())
+    old_packs = [p for p in _get_packs () if os.stat (f'{p.path}.pack').st_mtime < cutoff]
+    candidates = loose.union (*(set (p) for p in old_packs))
+    keep = sorted (candidates & reachable)
+    path = pack.write_pack (f'{objects_dir}/pack', keep, _split_object) if keep else None
+    pruned = candidates.difference (keep)
+
+    # The new pack's size is not subtracted, this is what went away
+    reclaimed = 0
+    for p in old_packs:
+        if not path or os.path.basename (p.path) != os.path.basename (path): #may be rewritten as is
+            # Index first, readers only look for packs that have one
+            reclaimed += _remove_file (f'{p.path}.idx')
+            reclaimed += _remove_file (f'{p.path}.pack')
+    for oid in loose:
+        if oid in reachable:
+            reclaimed += _remove_loose_object (oid) #it is in the new pack
+        elif _loose_mtime (oid) < cutoff:
+            reclaimed += _remove_loose_object (oid)
+        else:
+            pruned.discard (oid)
+    _remove_empty_fanout_dirs ()
+    _get_packs (reload=True)
+    pruned = {oid for oid in pruned if not object_exists (oid)} #some had another copy left
+
+    for dirpath, _, names in os.walk (GIT_DIR):
+        for name in names:
+            path = f'{dirpath}/{name}'
+            if name.startswith ('tmp_') and os.stat (path).st_mtime < cutoff:
+                os.remove (path)
+    return len (keep), len (pruned), reclaimed
+
+def _loose_mtime (oid):
+    for path in (_object_path (oid), _legacy_object_path (oid)):
+        if os.path.isfile (path):
+            return os.stat (path).st_mtime
+    return 0
+
+#objects/xx directories left empty once their objects went into a pack
+def _remove_empty_fanout_dirs ():
+    objects_dir = f'{GIT_DIR}/objects'
+    for name in os.listdir (objects_dir):
+        if len (name) == 2:
+            try:
+                os.rmdir (f'{objects_dir}/{name}')
+            except OSError:
+                pass #not empty (or not a directory)
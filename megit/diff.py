@@ -1,9 +1,9 @@
-import subprocess 
+import os
 
-from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
+from collections import defaultdict, namedtuple
 
 from . import data
+from . import trace
 
 #This is a generator function that compares multiple "trees"
 def compare_trees (*trees): #*trees means the function can accept any number of positional arguments, and it collects them into a tuple named trees.
@@ -23,57 +23,445 @@ def compare_trees (*trees): #*trees means the function can accept any number of
 #   'a.txt': ['abc', None],  # only in tree1
 #   'b.txt': [None, 'def']   # only in tree2
 # }
-def iter_changed_files (t_from, t_to):
-    for path, o_from, o_to in compare_trees (t_from, t_to):
-        if o_from != o_to:
-            action = ('new file' if not o_from else
-                      'deleted' if not o_to else
-                      'modified')
-            yield path, action
-
-def diff_trees (t_from, t_to):
-    output = b''
-    for path, o_from, o_to in compare_trees (t_from, t_to):
-        if o_from != o_to:
-            output += diff_blobs (o_from, o_to, path)
-    return output 
-
-def diff_blobs (o_from, o_to, path='blob'):
-    with Temp () as f_from, Temp () as f_to:
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write (data.get_object (oid))
-                f.flush ()
-
-        with subprocess.Popen (
-            ['diff', '--unified', '--show-c-function',
-             '--label', f'a/{path}', f_from.name,
-             '--label', f'b/{path}', f_to.name],
-            stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
-
-        return output
+
+@trace.traced
+def iter_change_actions (changes):
+    for path, o_from, o_to in changes:
+        action = ('new file' if not o_from else
+                  'deleted' if not o_to else
+                  'modified')
+        yield path, action
+
+CONTEXT = 3 #lines of context around each hunk, like diff --unified
+BINARY_CHECK_SIZE = 8000 #a NUL byte in this many leading bytes means the blob is binary
+MAX_EDIT_COST = 256 #past this many edits we settle for a good split instead of the minimal one
+
+#yields the diff of every (path, o_from, o_to) change piece by piece so callers can stream it
+#out, each is diffed as soon as it comes in
+@trace.traced
+def iter_diff_changes (changes):
+    if data.get_promisor ():
+        # Partial clones get all the blobs they are missing in one batch
+        changes = list (changes)
+        data.prefetch_objects (oid for _, o_from, o_to in changes for oid in (o_from, o_to))
+    for path, o_from, o_to in changes:
+        yield from iter_diff_blobs (o_from, o_to, path)
+
+#unified diff in the same format as diff --unified --show-c-function, one hunk at a time.
+#The changes are a minimal edit script as long as it takes no more than MAX_EDIT_COST edits,
+#past that the search settles for a good split and the script can be longer. Even when both
+#are minimal they are not always the same lines GNU diff picks: where several minimal scripts
+#exist the two can choose differently, and GNU diff has its own cost limit. So the output
+#applies the same way but is not guaranteed to be byte for byte what diff -u prints
+def iter_diff_blobs (o_from, o_to, path='blob'):
+    # A missing side diffs like an empty file
+    c_from = _get_blob (o_from, path) if o_from else b''
+    c_to = _get_blob (o_to, path) if o_to else b''
+    if c_from == c_to:
+        return
+    if _is_binary (c_from) or _is_binary (c_to):
+        yield f'Binary files a/{path} and b/{path} differ\n'.encode ()
+        return
+
+    trace.count ('diff.blobs', len (c_from) + len (c_to))
+    a = _split_lines (c_from)
+    b = _split_lines (c_to)
+    header = f'--- a/{path}\n+++ b/{path}\n'.encode ()
+    function_search = [0, None] #(searched up to, last function line found) so we never scan a line twice
+    for group in _group_opcodes (_opcodes (a, b)):
+        if header:
+            yield header
+            header = None
+        yield _format_hunk (a, b, group, function_search)
+
+def _is_binary (content):
+    return b'\x00' in content[:BINARY_CHECK_SIZE]
+
+#splits into lines that keep their newline, the last one may not have one
+def _split_lines (content):
+    lines = content.split (b'\n')
+    last = lines.pop ()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append (last)
+    return lines
+
+#Myers' O(ND) diff in linear space, returns the (i, j) index pairs of lines that match
+#a and b are lists of line ids so comparing two lines is a cheap int compare
+def _matching_lines (a, b):
+    matches = []
+    # Explicit stack instead of recursion: ('range', alo, ahi, blo, bhi) or ('match', i, j, n)
+    stack = [('range', 0, len (a), 0, len (b))]
+    while stack:
+        item = stack.pop ()
+        if item[0] == 'match':
+            _, i, j, n = item
+            matches.extend ((i + k, j + k) for k in range (n))
+            continue
+        _, alo, ahi, blo, bhi = item
+        # Common prefix and suffix never need the expensive search
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append ((alo, blo))
+            alo += 1
+            blo += 1
+        suffix = 0
+        while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+            suffix += 1
+        ahi -= suffix
+        bhi -= suffix
+        stack.append (('match', ahi, bhi, suffix))
+        if alo == ahi or blo == bhi:
+            continue
+        split = _middle_snake (a, alo, ahi, b, blo, bhi)
+        if split:
+            x, y = split
+            stack.append (('range', x, ahi, y, bhi))
+            stack.append (('range', alo, x, blo, y))
+    return matches
+
+#finds where the forward and backward searches meet, which splits the problem in two halves
+def _middle_snake (a, alo, ahi, b, blo, bhi):
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    size = 2 * max_d + 2
+    forward = [-1] * size
+    backward = [-1] * size
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = n - m
+    odd = delta % 2 != 0
+    # Diagonals that ran off the edge are skipped from then on
+    k1start = k1end = k2start = k2end = 0
+    furthest = None #forward point that got the furthest, used when the search gets too expensive
+    for d in range (max_d):
+        if d > MAX_EDIT_COST and furthest:
+            return furthest
+        for k1 in range (-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+            if x1 <= n and y1 <= m and (not furthest or x1 + y1 > furthest[0] - alo + furthest[1] - blo):
+                furthest = alo + x1, blo + y1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif odd:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < size and backward[k2_offset] != -1:
+                    if x1 >= n - backward[k2_offset]:
+                        return alo + x1, blo + y1
+        for k2 in range (-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not odd:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < size and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return alo + x1, blo + y1
+    # Nothing in common
+    return None
+
+#turns matching lines into ('equal' | 'change', i1, i2, j1, j2) runs covering both sides
+def _opcodes (a, b):
+    # Compare small ints instead of byte strings
+    ids = {}
+    a = [ids.setdefault (line, len (ids)) for line in a]
+    b = [ids.setdefault (line, len (ids)) for line in b]
+
+    # changed flags with a 0 on both ends so the shifting below never has to check bounds
+    changed_a = [0] * (len (a) + 2)
+    changed_b = [0] * (len (b) + 2)
+    for i in range (len (a)):
+        changed_a[i + 1] = 1
+    for j in range (len (b)):
+        changed_b[j + 1] = 1
+    for i, j in _matching_lines (a, b):
+        changed_a[i + 1] = 0
+        changed_b[j + 1] = 0
+    _shift_boundaries (changed_a, changed_b, a)
+    _shift_boundaries (changed_b, changed_a, b)
+
+    opcodes = []
+    i = j = 0
+    while i < len (a) or j < len (b):
+        i1, j1 = i, j
+        if i < len (a) and j < len (b) and not changed_a[i + 1] and not changed_b[j + 1]:
+            while i < len (a) and j < len (b) and not changed_a[i + 1] and not changed_b[j + 1]:
+                i += 1
+                j += 1
+            opcodes.append (('equal', i1, i, j1, j))
+        else:
+            while i < len (a) and changed_a[i + 1]:
+                i += 1
+            while j < len (b) and changed_b[j + 1]:
+                j += 1
+            opcodes.append (('change', i1, i, j1, j))
+    return opcodes
+
+#like GNU diff: when a run of changes could also sit on a neighbouring identical line,
+#slide it to merge with other changes and otherwise as far down as it goes
+def _shift_boundaries (changed, other_changed, lines):
+    # Both flag lists are offset by one, equivs (the line ids) are not
+    def equiv (i):
+        return lines[i - 1]
+
+    i = j = 1
+    i_end = len (lines) + 1
+    while True:
+        # Find the next run of changes and the matching point in the other file
+        while i < i_end and not changed[i]:
+            while other_changed[j]:
+                j += 1
+            j += 1
+            i += 1
+        if i == i_end:
+            break
+        start = i
+        i += 1
+        while changed[i]:
+            i += 1
+        while other_changed[j]:
+            j += 1
+
+        while True:
+            runlength = i - start
+            # Move the run back while the line before it matches its last line
+            while start > 1 and equiv (start - 1) == equiv (i - 1):
+                start -= 1
+                changed[start] = 1
+                i -= 1
+                changed[i] = 0
+                while changed[start - 1]:
+                    start -= 1
+                j -= 1
+                while other_changed[j]:
+                    j -= 1
+            # Where the run last lined up with a change in the other file
+            corresponding = i if other_changed[j - 1] else i_end
+            # Then forward while its first line matches the line after it
+            while i != i_end and equiv (start) == equiv (i):
+                changed[start] = 0
+                start += 1
+                changed[i] = 1
+                i += 1
+                while changed[i]:
+                    i += 1
+                j += 1
+                while other_changed[j]:
+                    j += 1
+                    corresponding = i
+            if runlength == i - start:
+                break
+
+        # Prefer ending next to a change in the other file if we passed one
+        while corresponding < i:
+            start -= 1
+            changed[start] = 1
+            i -= 1
+            changed[i] = 0
+            j -= 1
+            while other_changed[j]:
+                j -= 1
+
+#splits the opcodes into hunks, changes closer than 2*CONTEXT lines share a hunk
+def _group_opcodes (opcodes):
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'change':
+            group.append ((tag, i1, i2, j1, j2))
+            continue
+        if not group:
+            # Leading context
+            group.append ((tag, max (i1, i2 - CONTEXT), i2, max (j1, j2 - CONTEXT), j2))
+            continue
+        if i2 - i1 > 2 * CONTEXT:
+            group.append ((tag, i1, i1 + CONTEXT, j1, j1 + CONTEXT))
+            if any (op[0] == 'change' for op in group):
+                yield group
+            group = [(tag, i2 - CONTEXT, i2, j2 - CONTEXT, j2)]
+        else:
+            group.append ((tag, i1, i2, j1, j2))
+    if any (op[0] == 'change' for op in group):
+        # Trailing context
+        if group[-1][0] == 'equal':
+            tag, i1, i2, j1, j2 = group[-1]
+            group[-1] = (tag, i1, min (i2, i1 + CONTEXT), j1, min (j2, j1 + CONTEXT))
+        yield group
+
+def _format_range (start, count):
+    if count == 1:
+        return f'{start + 1}'
+    if count == 0:
+        return f'{start},0'
+    return f'{start + 1},{count}'
+
+def _format_hunk (a, b, group, function_search):
+    i1, j1 = group[0][1], group[0][3]
+    i2, j2 = group[-1][2], group[-1][4]
+    out = [f'@@ -{_format_range (i1, i2 - i1)} +{_format_range (j1, j2 - j1)} @@'.encode ()]
+    function = _find_function (a, i1, function_search)
+    if function:
+        out.append (b' ' + function)
+    out.append (b'\n')
+    for tag, i1, i2, j1, j2 in group:
+        if tag == 'equal':
+            _format_lines (out, b' ', a[i1:i2])
+        else:
+            _format_lines (out, b'-', a[i1:i2])
+            _format_lines (out, b'+', b[j1:j2])
+    return b''.join (out)
+
+def _format_lines (out, prefix, lines):
+    for line in lines:
+        out.append (prefix)
+        out.append (line)
+        if not line.endswith (b'\n'):
+            out.append (b'\n\\ No newline at end of file\n')
+
+#like --show-c-function: the closest line above the hunk that starts with a letter, $ or _
+def _find_function (a, start, function_search):
+    searched, found = function_search
+    for i in range (start - 1, searched - 1, -1):
+        line = a[i]
+        if line[:1].isalpha () or line[:1] in (b'$', b'_'):
+            found = line
+            break
+    function_search[:] = [max (start, searched), found]
+    if found is None:
+        return None
+    return found.rstrip (b'\n')[:40].rstrip ()
+
+#working tree files are hashed without being stored, so read those from disk
+#(a partial clone may also be missing the blob, then the file only counts if it matches)
+def _get_blob (oid, path):
+    if not data.object_exists (oid) and os.path.isfile (path):
+        with open (path, 'rb') as f:
+            content = f.read ()
+        if data.hash_object (content, write=False) == oid:
+            return content
+    return data.get_object (oid)
     
-def merge_trees (t_base, t_HEAD, t_other):
+#tree is the merged path->oid, conflicts the paths that got conflict markers
+MergeResult = namedtuple ('MergeResult', ['tree', 'conflicts'])
+
+#merges (path, o_base, o_HEAD, o_other) changes, like base.iter_tree_changes yields them.
+#the tree of the result only has the paths where the merge differs from HEAD, None where
+#the file is deleted
+@trace.traced
+def merge_tree_changes (changes):
     tree = {}
-    for path,o_base, o_HEAD, o_other in compare_trees (t_base, t_HEAD, t_other):
-        tree[path] = merge_blobs (o_base, o_HEAD, o_other)
-    return tree
-
-def merge_blobs (o_base, o_HEAD, o_other):
-    with Temp () as f_base, Temp () as f_HEAD, Temp () as f_other:
-        for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
-            if oid:
-                f.write (data.get_object (oid))
-                f.flush ()
-
-        with subprocess.Popen (
-            ['diff3', '-m',
-             '-L', 'HEAD', f_HEAD.name,
-             '-L', 'BASE', f_base.name,
-             '-L', 'MERGE_HEAD', f_other.name,
-            ], stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
-            assert proc.returncode in (0, 1)
-        return output
+    conflicts = []
+    to_merge = []
+    for path, o_base, o_HEAD, o_other in changes:
+        # Most paths are the same on both sides or changed on one side only,
+        # the oids alone tell us the answer without reading anything
+        if o_HEAD == o_other or o_other == o_base:
+            continue #HEAD already has it
+        if o_HEAD == o_base:
+            tree[path] = o_other
+        else:
+            to_merge.append ((path, o_base, o_HEAD, o_other))
+
+    data.prefetch_objects (oid for _, *oids in to_merge for oid in oids)
+    for path, o_base, o_HEAD, o_other in to_merge:
+        merged, conflicted = _merge_blobs (o_base, o_HEAD, o_other)
+        tree[path] = data.hash_object (merged)
+        if conflicted:
+            conflicts.append (path)
+    return MergeResult (tree=tree, conflicts=conflicts)
+
+#returns (merged content, whether it has conflicts), in the format of diff3 -m
+def _merge_blobs (o_base, o_HEAD, o_other):
+    base, HEAD, other = (data.get_object (oid) if oid else b''
+                         for oid in (o_base, o_HEAD, o_other))
+    if _is_binary (base) or _is_binary (HEAD) or _is_binary (other):
+        # Can't merge binary files line by line, keep ours
+        return HEAD, True
+    trace.count ('merge.blobs', len (base) + len (HEAD) + len (other))
+    lines, conflicted = _merge_lines (_split_lines (base), _split_lines (HEAD), _split_lines (other))
+    return b''.join (lines), conflicted
+
+#three way merge of lists of lines: changes from both sides are applied to base,
+#where they overlap and differ the region is bracketed with conflict markers
+def _merge_lines (base, HEAD, other):
+    sides = (HEAD, other)
+    hunks = [] #(base start, base end, side, side start, side end) of every change
+    for side, lines in enumerate (sides):
+        for tag, i1, i2, j1, j2 in _opcodes (base, lines):
+            if tag == 'change':
+                hunks.append ((i1, i2, side, j1, j2))
+    hunks.sort ()
+
+    out = []
+    conflicted = False
+    pos = 0 #base lines before this are already written
+    offsets = [0, 0] #side line number minus base line number, outside of changes
+    k = 0
+    while k < len (hunks):
+        # Group hunks that overlap or touch in base into one region
+        lo, hi = hunks[k][0], hunks[k][1]
+        region = []
+        while k < len (hunks) and hunks[k][0] <= hi:
+            hi = max (hi, hunks[k][1])
+            region.append (hunks[k])
+            k += 1
+        out.extend (base[pos:lo])
+        pos = hi
+
+        # What each side has in place of base[lo:hi]
+        changed = []
+        for side, lines in enumerate (sides):
+            side_hunks = [h for h in region if h[2] == side]
+            if side_hunks:
+                first, last = side_hunks[0], side_hunks[-1]
+                changed.append (lines[first[3] - (first[0] - lo):last[4] + (hi - last[1])])
+                offsets[side] = last[4] - last[1]
+            else:
+                changed.append (lines[lo + offsets[side]:hi + offsets[side]])
+
+        ours, theirs = changed
+        if not any (h[2] == 1 for h in region) or ours == theirs:
+            out.extend (ours)
+        elif not any (h[2] == 0 for h in region):
+            out.extend (theirs)
+        else:
+            conflicted = True
+            out.append (b'<<<<<<< HEAD\n')
+            out.extend (_terminated (ours))
+            out.append (b'||||||| BASE\n')
+            out.extend (_terminated (base[lo:hi]))
+            out.append (b'=======\n')
+            out.extend (_terminated (theirs))
+            out.append (b'>>>>>>> MERGE_HEAD\n')
+    out.extend (base[pos:])
+    return out, conflicted
 
+#conflict markers must start on their own line
+def _terminated (lines):
+    if lines and not lines[-1].endswith (b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
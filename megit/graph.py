@@ -0,0 +1,271 @@
+#commit-graph: every commit's tree, parents and generation number in compact mmap'd files,
+#so walking history never has to read and parse commit objects
+import os
+import mmap
+import struct
+import hashlib
+
+SIGNATURE = b'MCGR'
+VERSION = 1
+
+NO_PARENT = 0xffffffff
+EXTRA_EDGES = 0x80000000 #flag on the second parent: the rest of the parents are in the extra edge list
+LAST_EDGE = 0x80000000 #flag on the last entry of a commit in the extra edge list
+
+# Layers holding at most MERGE_FACTOR times as many commits as the new one are merged into it,
+# which keeps the chain short (logarithmic in the number of commits)
+MERGE_FACTOR = 2
+
+#  Commits are stored in a chain of layers, oldest first, listed in commit-graph-chain.
+#  A commit's position is its index in its layer plus the number of commits in the layers below,
+#  parents are stored as positions so they may point into lower layers.
+#
+#  Layer layout:
+#    'MCGR' version count base_count extra_count
+#    fanout: 256 counts like the pack index
+#    count * 20 byte oids, sorted
+#    count * (20 byte tree, parent1, parent2, generation)
+#    extra_count * parent positions for commits with more than two parents
+#    sha1 of everything above
+
+_HEADER = struct.Struct ('>4sIIII')
+_FANOUT_START = _HEADER.size
+_OIDS_START = _FANOUT_START + 256 * 4
+_ENTRY = struct.Struct ('>20sIII')
+
+
+class _Layer:
+
+    def __init__ (self, path):
+        self.path = path
+        with open (path, 'rb') as f:
+            assert os.fstat (f.fileno ()).st_size >= _OIDS_START + 20, f'{path} is not a commit-graph'
+            self._map = mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+        signature, version, self.count, self.base, extra_count = _HEADER.unpack_from (self._map, 0)
+        assert signature == SIGNATURE and version == VERSION, f'{path} is not a commit-graph'
+        self._fanout = struct.unpack_from ('>256I', self._map, _FANOUT_START)
+        self._entries_start = _OIDS_START + 20 * self.count
+        self._extra_start = self._entries_start + _ENTRY.size * self.count
+        assert len (self._map) == self._extra_start + 4 * extra_count + 20, f'Truncated commit-graph {path}'
+
+    #checks the sha1 trailer, which opening the layer skips, for fsck
+    def verify (self):
+        assert hashlib.sha1 (self._map[:-20]).digest () == self._map[-20:], f'Corrupt commit-graph {self.path}'
+
+    def find (self, oid):
+        lo = self._fanout[oid[0] - 1] if oid[0] else 0
+        hi = self._fanout[oid[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _OIDS_START + 20 * mid
+            found = self._map[start:start + 20]
+            if found < oid:
+                lo = mid + 1
+            elif found > oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def oid (self, i):
+        start = _OIDS_START + 20 * i
+        return self._map[start:start + 20]
+
+    def entry (self, i):
+        return _ENTRY.unpack_from (self._map, self._entries_start + _ENTRY.size * i)
+
+    def extra_edges (self, start):
+        edges = []
+        while True:
+            edge, = struct.unpack_from ('>I', self._map, self._extra_start + 4 * start)
+            edges.append (edge & ~LAST_EDGE)
+            if edge & LAST_EDGE:
+                return edges
+            start += 1
+
+
+#read-only view of all layers of a repository's commit-graph
+class CommitGraph:
+
+    def __init__ (self, graph_dir):
+        self.dir = graph_dir
+        self._layers = []
+        self.chain = []
+        chain_path = f'{graph_dir}/commit-graph-chain'
+        if os.path.isfile (chain_path):
+            with open (chain_path) as f:
+                self.chain = f.read ().split ()
+        for name in self.chain:
+            self._layers.append (_Layer (f'{graph_dir}/graph-{name}.graph'))
+
+    def __len__ (self):
+        return sum (layer.count for layer in self._layers)
+
+    def verify (self):
+        for layer in self._layers:
+            layer.verify ()
+
+    #returns the position of the commit or None when it is not in the graph
+    def lookup (self, oid):
+        oid = bytes.fromhex (oid)
+        for layer in self._layers:
+            i = layer.find (oid)
+            if i is not None:
+                return layer.base + i
+        return None
+
+    def _locate (self, pos):
+        for layer in reversed (self._layers):
+            if pos >= layer.base:
+                return layer, pos - layer.base
+        raise IndexError (pos)
+
+    def oid (self, pos):
+        layer, i = self._locate (pos)
+        return layer.oid (i).hex ()
+
+    def tree (self, pos):
+        layer, i = self._locate (pos)
+        return layer.entry (i)[0].hex ()
+
+    def generation (self, pos):
+        layer, i = self._locate (pos)
+        return layer.entry (i)[3]
+
+    #returns the positions of the parents
+    def parents (self, pos):
+        layer, i = self._locate (pos)
+        _, parent1, parent2, _ = layer.entry (i)
+        if parent1 == NO_PARENT:
+            return []
+        if parent2 == NO_PARENT:
+            return [parent1]
+        if parent2 & EXTRA_EDGES:
+            return [parent1] + layer.extra_edges (parent2 & ~EXTRA_EDGES)
+        return [parent1, parent2]
+
+    def parent_oids (self, pos):
+        return [self.oid (parent) for parent in self.parents (pos)]
+
+
+#adds every commit reachable from tips that is not in the graph yet, as a new layer
+#read_commit(oid) must return (tree, parents); returns False if some commit could not be read
+def update (graph_dir, tips, read_commit):
+    graph = CommitGraph (graph_dir)
+
+    # Walk down from the tips until we reach commits the graph already knows
+    new = {} #oid -> (tree, parents)
+    stack = [oid for oid in tips if oid]
+    while stack:
+        oid = stack.pop ()
+        if oid in new or graph.lookup (oid) is not None:
+            continue
+        try:
+            new[oid] = read_commit (oid)
+        except FileNotFoundError:
+            return False
+        stack.extend (new[oid][1])
+    if not new:
+        return True
+
+    # Merge the top layers into the new one while they are not much bigger than it
+    layers = list (graph.chain)
+    kept = len (layers)
+    commits = dict (new)
+    while kept and graph._layers[kept - 1].count <= MERGE_FACTOR * len (commits):
+        kept -= 1
+        layer = graph._layers[kept]
+        for i in range (layer.count):
+            pos = layer.base + i
+            commits[graph.oid (pos)] = (graph.tree (pos), graph.parent_oids (pos))
+    base = graph._layers[kept - 1].base + graph._layers[kept - 1].count if kept else 0
+
+    name = _write_layer (graph_dir, commits, base, graph)
+    chain = layers[:kept] + [name]
+    tmp_path = f'{graph_dir}/commit-graph-chain.tmp'
+    with open (tmp_path, 'w') as f:
+        f.write ('\n'.join (chain) + '\n')
+    os.replace (tmp_path, f'{graph_dir}/commit-graph-chain')
+    for old in layers[kept:]:
+        if old != name:
+            os.remove (f'{graph_dir}/graph-{old}.graph')
+    return True
+
+#drops the whole commit-graph, for when commits it has recorded changed their parents
+def remove (graph_dir):
+    graph = CommitGraph (graph_dir)
+    if graph.chain:
+        os.remove (f'{graph_dir}/commit-graph-chain')
+    for name in graph.chain:
+        os.remove (f'{graph_dir}/graph-{name}.graph')
+
+def _write_layer (graph_dir, commits, base, graph):
+    oids = sorted (commits)
+    local = {oid: base + i for i, oid in enumerate (oids)}
+
+    def position (oid):
+        pos = local.get (oid)
+        if pos is None:
+            pos = graph.lookup (oid)
+        return pos
+
+    def generation (oid):
+        pos = graph.lookup (oid)
+        if pos is not None and pos < base:
+            return graph.generation (pos)
+        return generations[oid]
+
+    # Generation = 1 + the highest parent generation, parents first (iterative post-order)
+    generations = {}
+    for oid in oids:
+        stack = [oid]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop ()
+                continue
+            pending = [p for p in commits[top][1]
+                       if p in commits and p not in generations]
+            if pending:
+                stack.extend (pending)
+                continue
+            generations[top] = 1 + max ((generation (p) for p in commits[top][1]), default=0)
+            stack.pop ()
+
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int (oid[:2], 16)] += 1
+    total = 0
+    for i in range (256):
+        total += fanout[i]
+        fanout[i] = total
+
+    entries = bytearray ()
+    extra = []
+    for oid in oids:
+        tree, parents = commits[oid]
+        positions = [position (p) for p in parents]
+        parent1 = positions[0] if positions else NO_PARENT
+        if len (positions) <= 2:
+            parent2 = positions[1] if len (positions) == 2 else NO_PARENT
+        else:
+            parent2 = EXTRA_EDGES | len (extra)
+            extra.extend (positions[1:-1])
+            extra.append (positions[-1] | LAST_EDGE)
+        entries += _ENTRY.pack (bytes.fromhex (tree), parent1, parent2, generations[oid])
+
+    out = bytearray (_HEADER.pack (SIGNATURE, VERSION, len (oids), base, len (extra)))
+    out += struct.pack ('>256I', *fanout)
+    for oid in oids:
+        out += bytes.fromhex (oid)
+    out += entries
+    out += struct.pack (f'>{len (extra)}I', *extra)
+    name = hashlib.sha1 (out).hexdigest ()
+    out += bytes.fromhex (name)
+
+    os.makedirs (graph_dir, exist_ok=True)
+    tmp_path = f'{graph_dir}/graph-{name}.tmp'
+    with open (tmp_path, 'wb') as f:
+        f.write (out)
+    os.replace (tmp_path, f'{graph_dir}/graph-{name}.graph')
+    return name
@@ -0,0 +1,479 @@
+#packfiles: many objects in one file, similar objects stored as deltas against each other
+import os
+import mmap #lets us read the index and pack without loading them into memory
+import struct #packing numbers into fixed width bytes
+import hashlib
+import zlib
+import tempfile
+
+PACK_SIGNATURE = b'MPAK'
+IDX_SIGNATURE = b'MIDX'
+VERSION = 1
+
+# Type codes used inside the pack, delta entries point at a base by oid
+TYPE_CODES = {'commit': 1, 'tree': 2, 'blob': 3, 'tag': 4}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items ()}
+DELTA = 7
+
+DELTA_WINDOW = 10 #how many previous objects of the same type we keep as possible bases
+DELTA_MAX_ATTEMPTS = 4 #how many of them we actually build a delta against, per object
+DELTA_MAX_DEPTH = 10 #longest chain of deltas a reader has to follow
+DELTA_MIN_SIZE = 64 #smaller objects are not worth it
+DELTA_MAX_SIZE = 1024 * 1024 #bigger objects are too slow to delta in python
+BLOCK = 16 #size of the chunks we look for in the base when building a delta
+# Bases up to this size are indexed at every offset, so the target can be scanned a whole
+# block at a time. Bigger ones only at block boundaries, with the target scanned byte by byte
+FULL_INDEX_SIZE = 64 * 1024
+
+#  Pack layout:
+#    'MPAK' version count
+#    entries: type byte, varint size, [20 byte base oid if delta], zlib data
+#    sha1 of everything above
+#
+#  Index layout (sorted by oid, found by binary search):
+#    'MIDX' version
+#    fanout: 256 counts, fanout[b] = number of oids whose first byte <= b
+#    count * 20 byte oids
+#    count * 8 byte offsets into the pack
+#    pack sha1, idx sha1
+
+_FANOUT_START = 8
+_OIDS_START = _FANOUT_START + 256 * 4
+
+
+def _encode_varint (n):
+    out = bytearray ()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append (byte | 0x80)
+        else:
+            out.append (byte)
+            return bytes (out)
+
+def _decode_varint (buf, pos):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+
+#where each block of base starts, see FULL_INDEX_SIZE. Building it is most of the cost of
+#a delta, so it is made once per base and reused for every target tried against it
+def index_blocks (base):
+    step = 1 if len (base) <= FULL_INDEX_SIZE else BLOCK
+    # Backwards so the first offset of a repeated block wins
+    return {base[offset:offset + BLOCK]: offset
+            for offset in range (len (base) - BLOCK, -1, -step)}, step
+
+#a few blocks of target spread over it, looked up in base with bytes.find, tell cheaply
+#whether a delta against base has any chance before we index it
+SIMILARITY_PROBES = 8
+
+def _shares_blocks (base, target):
+    step = max (BLOCK, len (target) // SIMILARITY_PROBES)
+    return any (base.find (target[pos:pos + BLOCK]) >= 0
+                for pos in range (0, len (target) - BLOCK + 1, step))
+
+#length of the common run of a[i:] and b[j:], compared a chunk at a time
+def _match_length (a, i, b, j):
+    size = 0
+    limit = min (len (a) - i, len (b) - j)
+    chunk = 64
+    while size < limit:
+        n = min (chunk, limit - size)
+        if a[i + size:i + size + n] == b[j + size:j + size + n]:
+            size += n
+            chunk *= 2
+        elif n > 8:
+            chunk = n // 8
+        else:
+            while size < limit and a[i + size] == b[j + size]:
+                size += 1
+            break
+    return size
+
+#a delta is the sizes of base and target followed by copy/insert instructions
+#copy:   1oooosss + offset and size bytes (only the ones flagged are present)
+#insert: 0nnnnnnn + n literal bytes
+#blocks is index_blocks (base), passed in when the caller already has it
+def create_delta (base, target, blocks=None):
+    out = bytearray (_encode_varint (len (base)) + _encode_varint (len (target)))
+    blocks, step = blocks or index_blocks (base)
+    # With every offset of base indexed a match is found from any block inside it,
+    # so we only need to look every BLOCK bytes and then grow it backwards
+    stride = BLOCK if step == 1 else 1
+
+    pending = bytearray ()
+    def flush_insert ():
+        for start in range (0, len (pending), 127):
+            chunk = pending[start:start + 127]
+            out.append (len (chunk))
+            out.extend (chunk)
+        pending.clear ()
+
+    pos = 0
+    while pos < len (target):
+        offset = blocks.get (target[pos:pos + BLOCK])
+        if offset is None:
+            pending += target[pos:pos + stride]
+            pos += stride
+            continue
+        # Grow the match backwards into what we were about to insert, then forwards
+        back = 0
+        while back < len (pending) and back < offset and target[pos - back - 1] == base[offset - back - 1]:
+            back += 1
+        if back:
+            del pending[-back:]
+            pos -= back
+            offset -= back
+        size = _match_length (target, pos, base, offset)
+        flush_insert ()
+        pos += size
+        while size:
+            chunk = min (size, 0xffffff)
+            _encode_copy (out, offset, chunk)
+            offset += chunk
+            size -= chunk
+    flush_insert ()
+    return bytes (out)
+
+def _encode_copy (out, offset, size):
+    op = 0x80
+    args = bytearray ()
+    for i in range (4):
+        byte = (offset >> (8 * i)) & 0xff
+        if byte:
+            op |= 1 << i
+            args.append (byte)
+    for i in range (3):
+        byte = (size >> (8 * i)) & 0xff
+        if byte:
+            op |= 1 << (4 + i)
+            args.append (byte)
+    out.append (op)
+    out.extend (args)
+
+def apply_delta (base, delta):
+    base_size, pos = _decode_varint (delta, 0)
+    target_size, pos = _decode_varint (delta, pos)
+    assert base_size == len (base), 'delta base does not match'
+    out = bytearray ()
+    while pos < len (delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range (4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range (3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        else:
+            out += delta[pos:pos + op]
+            pos += op
+    assert len (out) == target_size, 'delta produced the wrong size'
+    return bytes (out)
+
+
+#writes the given objects into one pack in pack_dir and returns the pack path (without extension)
+#read_object(oid) must return (type_, content), objects of unknown types are left out
+def write_pack (pack_dir, oids, read_object):
+    os.makedirs (pack_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp (dir=pack_dir, prefix='tmp_pack_')
+    with os.fdopen (fd, 'wb') as f:
+        entries, pack_sha = write_pack_to (f, oids, read_object)
+    if not entries:
+        os.remove (tmp_path)
+        return None
+    return _install_pack (tmp_path, entries, pack_sha)
+
+#writes the pack to an open file, returns the (oid, offset) of every entry and the pack sha1
+def write_pack_to (f, oids, read_object):
+    # First pass collects types and sizes so similar objects can be put next to each other.
+    # Contents that may become deltas are kept so they are only read once, bigger ones
+    # are read again when they are written
+    objects = []
+    contents = {}
+    for oid in oids:
+        type_, content = read_object (oid)
+        if type_ in TYPE_CODES:
+            objects.append ((type_, len (content), oid))
+            if len (content) <= DELTA_MAX_SIZE:
+                contents[oid] = content
+    # Same type together, biggest first, so smaller versions get written as deltas of bigger ones
+    objects.sort (key=lambda o: (o[0], -o[1]))
+
+    entries = []
+    sha = hashlib.sha1 ()
+    def write (chunk):
+        sha.update (chunk)
+        f.write (chunk)
+
+    write (PACK_SIGNATURE + struct.pack ('>II', VERSION, len (objects)))
+    offset = 12
+    window = [] #_Candidate of recent objects of the same type
+    for type_, _, oid in objects:
+        content = contents.pop (oid, None)
+        if content is None:
+            _, content = read_object (oid)
+        if window and window[-1].type_ != type_:
+            window = []
+
+        base_oid, delta, depth = _find_delta (content, window)
+        if delta is not None:
+            header = bytes ([DELTA]) + _encode_varint (len (delta)) + bytes.fromhex (base_oid)
+            payload = delta
+        else:
+            header = bytes ([TYPE_CODES[type_]]) + _encode_varint (len (content))
+            payload = content
+        entry = header + zlib.compress (payload)
+        write (entry)
+        entries.append ((bytes.fromhex (oid), offset))
+        offset += len (entry)
+
+        if DELTA_MIN_SIZE <= len (content) <= DELTA_MAX_SIZE:
+            window.append (_Candidate (oid, content, depth, type_))
+            del window[:-DELTA_WINDOW]
+    pack_sha = sha.digest ()
+    f.write (pack_sha)
+    return entries, pack_sha
+
+#checks and indexes a pack written somewhere else (tmp_path must be in the pack directory),
+#then moves it into place and returns its path (without extension)
+def index_pack (tmp_path):
+    pack_data = _map (tmp_path)
+    try:
+        assert len (pack_data) >= 32 and pack_data[:4] == PACK_SIGNATURE, f'{tmp_path} is not a pack'
+        _, count = struct.unpack_from ('>II', pack_data, 4)
+        pack_sha = pack_data[-20:]
+        assert hashlib.sha1 (pack_data[:-20]).digest () == pack_sha, 'Corrupt pack'
+
+        offsets = {} #oid -> offset of the entries seen so far, delta bases come before their deltas
+        def read (offset):
+            code = pack_data[offset]
+            size, pos = _decode_varint (pack_data, offset + 1)
+            if code != DELTA:
+                content, end = _inflate_at (pack_data, pos, size)
+                return TYPE_NAMES[code], content, end
+            base_oid = pack_data[pos:pos + 20]
+            payload, end = _inflate_at (pack_data, pos + 20, size)
+            assert base_oid in offsets, f'Missing delta base {base_oid.hex ()}'
+            type_, base_content, _ = read (offsets[base_oid])
+            return type_, apply_delta (base_content, payload), end
+
+        entries = []
+        offset = 12
+        for _ in range (count):
+            type_, content, end = read (offset)
+            oid = hashlib.sha1 (type_.encode () + b'\x00' + content).digest ()
+            offsets[oid] = offset
+            entries.append ((oid, offset))
+            offset = end
+        assert offset == len (pack_data) - 20, 'Corrupt pack'
+    finally:
+        pack_data.close ()
+    return _install_pack (tmp_path, entries, pack_sha)
+
+def _install_pack (tmp_path, entries, pack_sha):
+    # Pack goes in first, readers only see it once the index exists
+    path = f'{os.path.dirname (tmp_path)}/pack-{pack_sha.hex ()}'
+    os.chmod (tmp_path, 0o444)
+    os.replace (tmp_path, f'{path}.pack')
+    _write_index (f'{path}.idx', entries, pack_sha)
+    return path
+
+#a possible delta base, its block index is only built once it is tried
+class _Candidate:
+
+    def __init__ (self, oid, content, depth, type_):
+        self.oid = oid
+        self.content = content
+        self.depth = depth
+        self.type_ = type_
+        self._blocks = None
+
+    def blocks (self):
+        if self._blocks is None:
+            self._blocks = index_blocks (self.content)
+        return self._blocks
+
+def _find_delta (content, window):
+    if not DELTA_MIN_SIZE <= len (content) <= DELTA_MAX_SIZE:
+        return None, None, 0
+    best = None, None, 0
+    # Only keep a delta if it saves at least half the object
+    best_size = len (content) // 2
+    attempts = 0
+    for candidate in reversed (window):
+        base = candidate.content
+        # Whatever the target has beyond the base's size has to be inserted, so a base
+        # that much smaller can't beat what we have
+        if (candidate.depth >= DELTA_MAX_DEPTH or len (base) > 2 * len (content) or
+                len (content) - len (base) >= best_size or not _shares_blocks (base, content)):
+            continue
+        delta = create_delta (base, content, candidate.blocks ())
+        if len (delta) < best_size:
+            best = candidate.oid, delta, candidate.depth + 1
+            best_size = len (delta)
+        attempts += 1
+        if attempts == DELTA_MAX_ATTEMPTS:
+            break
+    return best
+
+def _write_index (path, entries, pack_sha):
+    entries.sort ()
+    fanout = [0] * 256
+    for oid, _ in entries:
+        fanout[oid[0]] += 1
+    total = 0
+    for i in range (256):
+        total += fanout[i]
+        fanout[i] = total
+
+    idx = bytearray (IDX_SIGNATURE + struct.pack ('>I', VERSION))
+    idx += struct.pack ('>256I', *fanout)
+    for oid, _ in entries:
+        idx += oid
+    for _, offset in entries:
+        idx += struct.pack ('>Q', offset)
+    idx += pack_sha
+    idx += hashlib.sha1 (idx).digest ()
+
+    tmp_path = f'{path}.tmp'
+    with open (tmp_path, 'wb') as f:
+        f.write (idx)
+    os.replace (tmp_path, path)
+
+
+def _map (path):
+    with open (path, 'rb') as f:
+        assert os.fstat (f.fileno ()).st_size, f'{path} is empty' #mmap can't map nothing
+        return mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+
+#a pack on disk, looked up through its memory mapped index
+class Pack:
+
+    def __init__ (self, path):
+        self.path = path
+        self._idx = _map (f'{path}.idx')
+        assert (len (self._idx) >= _OIDS_START + 40 and self._idx[:4] == IDX_SIGNATURE and
+                struct.unpack_from ('>I', self._idx, 4)[0] == VERSION), f'{path}.idx is not a pack index'
+        self._fanout = struct.unpack_from ('>256I', self._idx, _FANOUT_START)
+        self._count = self._fanout[255]
+        self._offsets_start = _OIDS_START + 20 * self._count
+        # Only the size is checked here, hashing the whole file on every open would cost more
+        # than the lookups it serves. verify() checks the trailers
+        assert len (self._idx) == self._offsets_start + 8 * self._count + 40, f'Truncated pack index {path}.idx'
+        self._pack = None #mapped on first read
+
+    def __len__ (self):
+        return self._count
+
+    def __contains__ (self, oid):
+        return self._find (bytes.fromhex (oid)) is not None
+
+    def oid (self, i):
+        start = _OIDS_START + 20 * i
+        return self._idx[start:start + 20].hex ()
+
+    def __iter__ (self):
+        return (self.oid (i) for i in range (self._count))
+
+    #binary search inside the slice of the index the fanout table points us at
+    def _find (self, oid):
+        lo = self._fanout[oid[0] - 1] if oid[0] else 0
+        hi = self._fanout[oid[0]]
+        idx = self._idx
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _OIDS_START + 20 * mid
+            found = idx[start:start + 20]
+            if found < oid:
+                lo = mid + 1
+            elif found > oid:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    #returns the oids starting with the hex prefix, at most limit of them
+    def find_prefix (self, prefix, limit=2):
+        # Padded to whole bytes, the first oid >= key is the first one with the prefix
+        key = bytes.fromhex (prefix + '0' * (len (prefix) % 2))
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        end = hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _OIDS_START + 20 * mid
+            if self._idx[start:start + 20] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < end and len (found) < limit:
+            oid = self.oid (lo)
+            if not oid.startswith (prefix):
+                break
+            found.append (oid)
+            lo += 1
+        return found
+
+    #checks the sha1 trailers of the index and the pack, for fsck
+    def verify (self):
+        assert hashlib.sha1 (self._idx[:-20]).digest () == self._idx[-20:], f'Corrupt pack index {self.path}.idx'
+        pack_data = _map (f'{self.path}.pack')
+        try:
+            assert pack_data[-20:] == self._idx[-40:-20], f'{self.path}.pack does not match its index'
+            assert hashlib.sha1 (pack_data[:-20]).digest () == pack_data[-20:], f'Corrupt pack {self.path}.pack'
+        finally:
+            pack_data.close ()
+
+    #returns (type_, content) or None if the object is not in this pack
+    def read (self, oid):
+        i = self._find (bytes.fromhex (oid))
+        if i is None:
+            return None
+        offset, = struct.unpack_from ('>Q', self._idx, self._offsets_start + 8 * i)
+        return self._read_at (offset)
+
+    def _read_at (self, offset):
+        if self._pack is None:
+            self._pack = _map (f'{self.path}.pack')
+            # The index records the sha1 trailer of its pack, a cut short pack has lost it
+            assert self._pack[-20:] == self._idx[-40:-20], f'{self.path}.pack does not match its index'
+        code = self._pack[offset]
+        size, pos = _decode_varint (self._pack, offset + 1)
+        if code == DELTA:
+            base_oid = self._pack[pos:pos + 20].hex ()
+            payload = self._inflate (pos + 20, size)
+            base = self.read (base_oid)
+            assert base, f'Missing delta base {base_oid}'
+            type_, base_content = base
+            return type_, apply_delta (base_content, payload)
+        return TYPE_NAMES[code], self._inflate (pos, size)
+
+    def _inflate (self, pos, size):
+        return _inflate_at (self._pack, pos, size)[0]
+
+#inflates the zlib stream at pos, returns the content and where the stream ended
+def _inflate_at (buf, pos, size):
+    decompressor = zlib.decompressobj ()
+    out = bytearray ()
+    chunk = max (size, 4096)
+    while not decompressor.eof:
+        data = buf[pos:pos + chunk]
+        assert data, 'Truncated pack'
+        out += decompressor.decompress (data)
+        pos += len (data)
+    assert len (out) == size, 'Corrupt pack entry'
+    return bytes (out), pos - len (decompressor.unused_data)
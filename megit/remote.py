@@ -1,49 +1,236 @@
 import os
+import asyncio
+import tempfile
+import urllib.parse
+
 from . import base
 from . import data
+from . import server
+from . import trace
 
 REMOTE_REFS_BASE = 'refs/heads/'
 LOCAL_REFS_BASE = 'refs/remote/'
 
-def fetch (remote_path):
-    # Get refs from server
-    refs = _get_remote_refs (remote_path, REMOTE_REFS_BASE)
+# Remotes are a directory, or a megit serve at megit://host:port/path
+# or megit+unix:///path/to/socket?repo=path
+URL_SCHEMES = ('megit://', 'megit+unix://')
 
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits (refs.values ()):
-        data.fetch_object_if_missing (oid, remote_path)
+GET_OBJECTS_BATCH = 10000 #oids per get-objects request, about 430KB of json
+
+#with depth, only the last depth commits of each branch are fetched (or the history we
+#have is deepened to that), the commits where it ends are recorded as shallow.
+#filter_='blob:none' fetches commits and trees only, the remote is recorded as the promisor
+#and blobs are fetched from it as they are needed (partial clone)
+@trace.traced
+def fetch (remote_path, depth=None, filter_=None):
+    if not remote_path.startswith (URL_SCHEMES):
+        remote_path = os.path.abspath (remote_path)
+    # Later fetches from the promisor stay blobless
+    blobs = filter_ != 'blob:none' and data.get_promisor () != remote_path
+    if remote_path.startswith (URL_SCHEMES):
+        with trace.span ('remote.fetch_from_server'):
+            refs, cut = asyncio.run (_fetch_from_server (remote_path, depth, blobs))
+    else:
+        refs, cut = _fetch_from_directory (remote_path, depth, blobs)
+    base.update_shallow (cut)
+    if not blobs and not data.get_promisor ():
+        data.set_promisor (remote_path)
 
     # Update local refs to match server
     for remote_name, value in refs.items ():
         refname = os.path.relpath (remote_name, REMOTE_REFS_BASE)
-        data.update_ref (f'{LOCAL_REFS_BASE}/{refname}',
+        data.update_ref (f'{LOCAL_REFS_BASE}{refname}',
                          data.RefValue (symbolic=False, value=value))
-        
+
+    base.update_commit_graph (refs.values ())
+
+@trace.traced
+def _fetch_from_directory (remote_path, depth, blobs):
+    # Get refs from server
+    refs = _get_remote_refs (remote_path, REMOTE_REFS_BASE)
+
+    # Walk the server's history down to the commits we already have
+    local_git_dir = data.GIT_DIR
+    with data.change_git_dir (remote_path):
+        missing = list (base.iter_missing_objects (
+            refs.values (), lambda oid: data.object_exists (oid, local_git_dir), depth, blobs))
+        cut = base.get_shallow_cut (refs.values (), depth, missing)
+
+    # Fetch only those, linked rather than copied where possible
+    data.fetch_objects (missing, remote_path, whole_packs=not depth and not data.get_shallow ())
+    return refs, cut
+
+async def _fetch_from_server (url, depth, blobs):
+    connection = await _Connection.open (url)
+    async with connection:
+        refs = (await connection.request ('ls-refs', prefix=REMOTE_REFS_BASE))['refs']
+        wants = sorted ({oid for oid in refs.values ()
+                         if depth or not data.object_exists (oid)}) #deepening asks for all of them
+        if not wants:
+            return refs, []
+        # Our refs tell the server where our history meets its own
+        haves = sorted ({ref.value for _, ref in data.iter_refs ()})
+        reply = await connection.request ('fetch', wants=wants, haves=haves, depth=depth,
+                                          shallow=sorted (data.get_shallow ()),
+                                          filter=None if blobs else 'blob:none')
+        if reply['objects']:
+            await connection.receive_pack ()
+    return refs, reply['shallow']
+
+#makes a new repository in directory (named after the remote by default) with everything
+#from the remote, and checks out its main branch (or the first one there is)
+@trace.traced
+def clone (remote_path, directory=None, depth=None, filter_=None):
+    if not remote_path.startswith (URL_SCHEMES):
+        remote_path = os.path.abspath (remote_path)
+    if not directory:
+        parts = urllib.parse.urlsplit (remote_path)
+        repo = urllib.parse.parse_qs (parts.query).get ('repo', [parts.path])[0]
+        directory = os.path.basename (os.path.normpath (repo))
+
+    os.makedirs (directory)
+    cwd = os.getcwd ()
+    os.chdir (directory)
+    try:
+        base.init ()
+        if not remote_path.startswith (URL_SCHEMES) and not depth and not filter_:
+            # Sharing the files means fetch finds it already has everything
+            data.link_objects (remote_path)
+        fetch (remote_path, depth, filter_)
+
+        branches = sorted (os.path.relpath (refname, LOCAL_REFS_BASE)
+                           for refname, _ in data.iter_refs (LOCAL_REFS_BASE))
+        if branches:
+            branch = 'main' if 'main' in branches else branches[0]
+            data.update_ref (f'refs/heads/{branch}',
+                             data.get_ref (f'{LOCAL_REFS_BASE}{branch}'))
+            base.checkout (branch)
+    finally:
+        os.chdir (cwd)
+    return directory
+
+#fetches the objects a partial clone is missing, skipping any the remote doesn't have
+@trace.traced
+def fetch_promised (remote_path, oids):
+    if remote_path.startswith (URL_SCHEMES):
+        asyncio.run (_fetch_promised_from_server (remote_path, oids))
+        return
+    remote_git_dir = f'{remote_path}/.megit'
+    oids = [oid for oid in oids if data.object_exists (oid, remote_git_dir)]
+    # Single objects only, a whole pack could bring commits without their trees
+    data.fetch_objects (oids, remote_path, whole_packs=False)
+
+async def _fetch_promised_from_server (url, oids):
+    connection = await _Connection.open (url)
+    async with connection:
+        # In batches, so a request stays well under the server's frame size limit
+        for i in range (0, len (oids), GET_OBJECTS_BATCH):
+            reply = await connection.request ('get-objects', oids=oids[i:i + GET_OBJECTS_BATCH])
+            if reply['objects']:
+                await connection.receive_pack ()
+
+@trace.traced
 def push (remote_path, refname):
+    local_ref = data.get_ref (refname).value
+    assert local_ref
+    if remote_path.startswith (URL_SCHEMES):
+        with trace.span ('remote.push_to_server'):
+            asyncio.run (_push_to_server (remote_path, refname, local_ref))
+        return
+
     # Get refs data
     remote_refs = _get_remote_refs (remote_path)
     remote_ref = remote_refs.get (refname)
-    local_ref = data.get_ref (refname).value
-    assert local_ref
 
     # Don't allow force push
     assert not remote_ref or base.is_ancestor_of (local_ref, remote_ref)
 
-    # Compute which objects the server doesn't have
-    known_remote_refs = filter (data.object_exists, remote_refs.values ())
-    remote_objects = set (base.iter_objects_in_commits (known_remote_refs))
-    local_objects = set (base.iter_objects_in_commits ({local_ref}))
-    objects_to_push = local_objects - remote_objects
+    # Walk down from our tip until the commits the server already has
+    remote_git_dir = f'{remote_path}/.megit'
+    objects_to_push = list (base.iter_missing_objects (
+        [local_ref], lambda oid: data.object_exists (oid, remote_git_dir)))
 
-    # Push missing objects
-    for oid in objects_to_push:
-        data.push_object (oid, remote_path)
+    # Push missing objects, the ref only moves once all of them are there
+    if objects_to_push:
+        data.push_objects (objects_to_push, remote_path)
 
     # Update server ref to our value
     with data.change_git_dir (remote_path):
         data.update_ref (refname,
                          data.RefValue (symbolic=False, value=local_ref))
+        if len (data.get_commit_graph ()):
+            base.update_commit_graph ([local_ref]) #keeps an existing graph current
+
+async def _push_to_server (url, refname, local_ref):
+    connection = await _Connection.open (url)
+    async with connection:
+        remote_refs = (await connection.request ('ls-refs'))['refs']
+        remote_ref = remote_refs.get (refname)
+
+        # Don't allow force push
+        assert not remote_ref or base.is_ancestor_of (local_ref, remote_ref)
+
+        # The server's refs we know of bound what it is missing
+        exists = base.peer_has ([local_ref], remote_refs.values ())
+        objects_to_push = list (base.iter_missing_objects ([local_ref], exists))
+        # The server checks the ref is still at remote_ref before moving it
+        await connection.request ('push', ref=refname, old=remote_ref, new=local_ref,
+                                  objects=len (objects_to_push), pack=objects_to_push)
 
 def _get_remote_refs (remote_path, prefix=''):
     with data.change_git_dir (remote_path):
         return {refname: ref.value for refname, ref in data.iter_refs (prefix)}
+
+
+#client side of a connection to megit serve, see server.py for the protocol
+class _Connection:
+
+    def __init__ (self, reader, writer, repo):
+        self.reader = reader
+        self.writer = writer
+        self.repo = repo
+
+    @classmethod
+    async def open (cls, url):
+        parts = urllib.parse.urlsplit (url)
+        if parts.scheme == 'megit+unix':
+            reader, writer = await asyncio.open_unix_connection (parts.path)
+            repo = urllib.parse.parse_qs (parts.query).get ('repo', [''])[0]
+        else:
+            reader, writer = await asyncio.open_connection (
+                parts.hostname, parts.port or server.DEFAULT_PORT)
+            repo = parts.path
+        return cls (reader, writer, repo)
+
+    async def __aenter__ (self):
+        return self
+
+    async def __aexit__ (self, *exc_info):
+        self.writer.close ()
+        await self.writer.wait_closed ()
+
+    #sends a request, and the objects in pack as a pack after it, returns the reply
+    async def request (self, command, pack=None, **args):
+        trace.count (f'remote.{command}')
+        await server.write_message (self.writer, {'command': command, 'repo': self.repo, **args})
+        if pack:
+            with tempfile.TemporaryFile () as f:
+                data.write_pack_to (f, pack)
+                trace.count ('remote.pack.sent', f.tell ())
+                f.seek (0)
+                await server.send_file (self.writer, f)
+        reply = await server.read_message (self.reader)
+        if 'error' in reply:
+            raise ValueError (f'{command} failed: {reply["error"]}')
+        return reply
+
+    async def receive_pack (self):
+        f, tmp_path = data.new_pack_file ()
+        try:
+            with f:
+                await server.receive_file (self.reader, f)
+                trace.count ('remote.pack.received', f.tell ())
+        except BaseException:
+            os.remove (tmp_path)
+            raise
+        data.install_pack (tmp_path)
@@ -0,0 +1,235 @@
+#megit serve: hosts the repositories under a directory over TCP or a unix socket
+import os
+import json
+import struct
+import signal
+import asyncio
+import tempfile
+import functools
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from . import base
+from . import data
+
+DEFAULT_PORT = 9418
+CHUNK_SIZE = 64 * 1024 #packs are streamed in frames of this size
+MAX_FRAME = 16 * 1024 * 1024
+
+#  Everything sent either way is a frame: 4 byte big-endian length, then that many bytes.
+#  A request is a json frame {"command": ..., "repo": path under the served directory, ...}
+#  and gets one json frame back, {"error": message} if it failed:
+#    ls-refs {prefix}                 -> {refs: {ref: oid}}
+#    fetch {wants, haves, depth, shallow, filter}
+#                                     -> {objects: n, shallow: [oid]}, then the pack when n > 0
+#    get-objects {oids}               -> {objects: n}, then a pack of the ones we have
+#    push {ref, old, new, objects}    -> {ok: true}, the pack follows the request when objects > 0
+#  A pack is sent as frames of raw bytes ended by an empty frame.
+#  A connection can carry any number of requests, one after the other.
+
+_LENGTH = struct.Struct ('>I')
+
+async def read_frame (reader):
+    length, = _LENGTH.unpack (await reader.readexactly (_LENGTH.size))
+    assert length <= MAX_FRAME, 'Frame too big'
+    return await reader.readexactly (length)
+
+async def write_frame (writer, payload):
+    writer.write (_LENGTH.pack (len (payload)) + payload)
+    await writer.drain ()
+
+async def read_message (reader):
+    return json.loads (await read_frame (reader))
+
+async def write_message (writer, message):
+    await write_frame (writer, json.dumps (message).encode ())
+
+async def send_file (writer, f):
+    while True:
+        chunk = f.read (CHUNK_SIZE)
+        await write_frame (writer, chunk)
+        if not chunk:
+            return
+
+async def receive_file (reader, f):
+    while True:
+        chunk = await read_frame (reader)
+        if not chunk:
+            return
+        f.write (chunk)
+
+
+class Server:
+
+    def __init__ (self, root, pool):
+        self.root = os.path.abspath (root)
+        # data works on one global git dir, so repository work runs in worker processes which
+        # each have their own. Requests to the same repository still run one at a time
+        self.pool = pool
+        self._locks = defaultdict (asyncio.Lock) #repository path -> its lock
+
+    #runs func(*args) inside the repository in a worker process, the event loop keeps
+    #serving the other clients (reading and writing their frames) in the meantime
+    async def _run (self, repo, func, *args):
+        async with self._locks[repo]:
+            loop = asyncio.get_running_loop ()
+            return await loop.run_in_executor (self.pool, functools.partial (_in_repo, repo, func, *args))
+
+    def _repo_path (self, path):
+        repo = os.path.normpath (os.path.join (self.root, path.lstrip ('/')))
+        if (os.path.commonpath ([repo, self.root]) != self.root or
+                not os.path.isdir (f'{repo}/.megit')):
+            raise ValueError (f'No repository at {path}')
+        return repo
+
+    async def handle (self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_message (reader)
+                    assert isinstance (request, dict), 'A request must be a json object'
+                except asyncio.IncompleteReadError:
+                    return #client is done
+                except (ValueError, AssertionError) as e:
+                    # Not json, or a frame over MAX_FRAME: we can't tell where the next request
+                    # starts, so answer and hang up
+                    await write_message (writer, {'error': f'Bad request: {e}'})
+                    return
+                handler = getattr (self, f'_{str (request.get ("command", "")).replace ("-", "_")}', None)
+                try:
+                    if handler is None:
+                        raise ValueError (f'Unknown command {request.get ("command")}')
+                    await handler (request, reader, writer)
+                except (ValueError, AssertionError, KeyError, TypeError, FileNotFoundError) as e:
+                    await write_message (writer, {'error': str (e) or type (e).__name__})
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    # A bug rather than a bad request, keep the traceback for whoever runs the server
+                    traceback.print_exc ()
+                    await write_message (writer, {'error': f'Internal error: {type (e).__name__}: {e}'})
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close ()
+
+    async def _ls_refs (self, request, reader, writer):
+        repo = self._repo_path (request['repo'])
+        refs = await self._run (repo, _ls_refs, request.get ('prefix', ''))
+        await write_message (writer, {'refs': refs})
+
+    async def _fetch (self, request, reader, writer):
+        repo = self._repo_path (request['repo'])
+        with tempfile.NamedTemporaryFile () as f:
+            count, cut = await self._run (repo, _write_fetch_pack, f.name, request['wants'], request['haves'],
+                                          request.get ('depth'), request.get ('shallow', []),
+                                          request.get ('filter'))
+            await write_message (writer, {'objects': count, 'shallow': cut})
+            if count:
+                f.seek (0)
+                await send_file (writer, f)
+
+    async def _get_objects (self, request, reader, writer):
+        repo = self._repo_path (request['repo'])
+        with tempfile.NamedTemporaryFile () as f:
+            count = await self._run (repo, _write_objects_pack, f.name, request['oids'])
+            await write_message (writer, {'objects': count})
+            if count:
+                f.seek (0)
+                await send_file (writer, f)
+
+    async def _push (self, request, reader, writer):
+        try:
+            repo = self._repo_path (request['repo'])
+        except ValueError:
+            if request.get ('objects'):
+                await receive_file (reader, _Discard ()) #keep the connection in step
+            raise
+        tmp_path = None
+        if request.get ('objects'):
+            tmp_path = await self._run (repo, _new_pack_path)
+            try:
+                with open (tmp_path, 'wb') as f:
+                    await receive_file (reader, f)
+            except BaseException:
+                os.remove (tmp_path)
+                raise
+        await self._run (repo, _update_pushed_ref, tmp_path,
+                         request['ref'], request.get ('old'), request['new'])
+        await write_message (writer, {'ok': True})
+
+
+class _Discard:
+
+    def write (self, chunk):
+        pass
+
+
+def _in_repo (repo, func, *args):
+    with data.change_git_dir (repo):
+        # Other processes may have changed the repository since the last request
+        data.drop_caches ()
+        return func (*args)
+
+def _ls_refs (prefix):
+    return {refname: ref.value for refname, ref in data.iter_refs (prefix)}
+
+#the pack writers get the path of the server's temporary file, open files stay in the server
+#process
+
+#writes what a client that has the commits haves needs for wants, returns the object count
+#and the commits where the history the client ends up with is cut
+def _write_fetch_pack (path, wants, haves, depth, shallow, filter_):
+    assert filter_ in (None, 'blob:none'), f'Unknown filter {filter_}'
+    for oid in wants:
+        assert data.object_exists (oid), f'Unknown object {oid}'
+    # Deepening walks every commit within depth, the ones the client has among them are
+    # only known if the negotiation starts from all of them
+    tips = sorted (base.get_commits_within (wants, depth)) if depth else wants
+    exists = base.peer_has (tips, haves, shallow)
+    objects = list (base.iter_missing_objects (wants, exists, depth, blobs=filter_ is None))
+    cut = base.get_shallow_cut (wants, depth, objects)
+    with open (path, 'wb') as f:
+        return data.write_pack_to (f, objects), sorted (cut)
+
+def _write_objects_pack (path, oids):
+    with open (path, 'wb') as f:
+        return data.write_pack_to (f, [oid for oid in oids if data.object_exists (oid)])
+
+def _new_pack_path ():
+    f, tmp_path = data.new_pack_file ()
+    f.close ()
+    return tmp_path
+
+def _update_pushed_ref (tmp_path, ref, old, new):
+    if tmp_path:
+        data.install_pack (tmp_path)
+    assert ref.startswith ('refs/heads/') and '..' not in ref.split ('/'), f'Cannot push to {ref}'
+    assert data.object_exists (new), f'Missing pushed commit {new}'
+    current = data.get_ref (ref).value
+    # Only move the ref if nobody else moved it since the client looked
+    assert current == old, f'{ref} has changed, fetch first'
+    assert not current or base.is_ancestor_of (new, current), f'{ref} is not a fast-forward'
+    data.update_ref (ref, data.RefValue (symbolic=False, value=new))
+    base.update_commit_graph ([new])
+
+async def _serve (root, host, port, unix_path):
+    with ProcessPoolExecutor () as pool:
+        server = Server (root, pool)
+        if unix_path:
+            listener = await asyncio.start_unix_server (server.handle, unix_path)
+        else:
+            listener = await asyncio.start_server (server.handle, host, port)
+        async with listener:
+            await listener.serve_forever ()
+
+def serve (root, host='localhost', port=DEFAULT_PORT, unix_path=None):
+    # Stopped by SIGTERM the same way as by ctrl-c, so the worker processes get shut down
+    # instead of outliving the server
+    signal.signal (signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run (_serve (root, host, port, unix_path))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+#tracing: timed spans around the phases of a command and counters for the work done in them
+#turned on by MEGIT_TRACE (or megit --trace / --trace-json). MEGIT_TRACE=1 prints a summary
+#to stderr when the command ends, MEGIT_TRACE=file.json (or any path) writes Chrome
+#trace-event json to the file instead (open it in chrome://tracing or ui.perfetto.dev).
+#when tracing is off span() hands back one shared do-nothing context manager and count()
+#returns straight away, so the calls can stay in place
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import functools
+import threading
+from collections import defaultdict
+
+_enabled = False
+_output = None #'summary' or the path of the json file
+_start_ns = 0
+_events = [] #finished spans: (name, start ns, duration ns, thread id, depth)
+_counters = defaultdict (lambda: [0, 0]) #name -> [count, bytes]
+_lock = threading.Lock ()
+_local = threading.local () #depth of the open spans in each thread
+
+def enable (output='summary'):
+    global _enabled, _output, _start_ns
+    if _enabled:
+        return
+    _enabled, _output, _start_ns = True, output, time.perf_counter_ns ()
+    atexit.register (report)
+
+
+class _NullSpan:
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan ()
+
+
+class _Span:
+
+    def __init__ (self, name):
+        self.name = name
+
+    def __enter__ (self):
+        self.depth = getattr (_local, 'depth', 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter_ns ()
+        return self
+
+    def __exit__ (self, *exc_info):
+        end = time.perf_counter_ns ()
+        _local.depth = self.depth
+        with _lock:
+            _events.append ((self.name, self.start, end - self.start,
+                             threading.get_ident (), self.depth))
+        return False
+
+
+#with trace.span ('phase'): times the block
+def span (name):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span (name)
+
+#decorator timing every call of the function as a span named after it. The span of a
+#generator covers all of its iteration, time spent by the caller between items included
+def traced (func):
+    name = f'{func.__module__.rpartition (".")[2]}.{func.__name__}'
+    if inspect.isgeneratorfunction (func):
+        @functools.wraps (func)
+        def wrapper (*args, **kwargs):
+            if not _enabled:
+                return func (*args, **kwargs)
+            return _traced_generator (name, func (*args, **kwargs))
+    else:
+        @functools.wraps (func)
+        def wrapper (*args, **kwargs):
+            if not _enabled:
+                return func (*args, **kwargs)
+            with _Span (name):
+                return func (*args, **kwargs)
+    return wrapper
+
+def _traced_generator (name, generator):
+    with _Span (name):
+        yield from generator
+
+#counts one event of the kind name, and size bytes moved by it
+def count (name, size=0):
+    if not _enabled:
+        return
+    with _lock:
+        counter = _counters[name]
+        counter[0] += 1
+        counter[1] += size
+
+def report ():
+    if not _enabled:
+        return
+    if _output == 'summary':
+        _print_summary (sys.stderr)
+    else:
+        with open (_output, 'w') as f:
+            json.dump (_chrome_trace (), f)
+
+#spans with the same name at the same depth are added up, listed in order of first start
+def _print_summary (out):
+    totals = {} #(depth, name) -> [calls, total ns, first start]
+    for name, start, duration, _, depth in _events:
+        total = totals.setdefault ((depth, name), [0, 0, start])
+        total[0] += 1
+        total[1] += duration
+        total[2] = min (total[2], start)
+    print ('megit trace:', file=out)
+    print (f'  {"span":<40} {"calls":>7} {"total ms":>10}', file=out)
+    for (depth, name), (calls, total, _) in sorted (totals.items (), key=lambda item: item[1][2]):
+        label = '  ' * depth + name
+        print (f'  {label:<40} {calls:>7} {total / 1e6:>10.2f}', file=out)
+    if _counters:
+        print (f'  {"counter":<40} {"count":>7} {"bytes":>10}', file=out)
+        for name, (n, size) in sorted (_counters.items ()):
+            print (f'  {name:<40} {n:>7} {size:>10}', file=out)
+
+def _chrome_trace ():
+    pid = os.getpid ()
+    events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+               'ts': (start - _start_ns) / 1000, 'dur': duration / 1000}
+              for name, start, duration, tid, _ in _events]
+    end = (time.perf_counter_ns () - _start_ns) / 1000
+    for name, (n, size) in sorted (_counters.items ()):
+        events.append ({'name': name, 'ph': 'C', 'pid': pid, 'tid': 0, 'ts': end,
+                        'args': {'count': n, 'bytes': size}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+#MEGIT_TRACE unset, empty, 0, false, no or off leaves tracing off. A value naming a file
+#(it has a path separator or ends in .json) writes the json there, any other value prints
+#the summary
+def enable_from_env ():
+    value = os.environ.get ('MEGIT_TRACE', '').strip ()
+    if value.lower () in ('', '0', 'false', 'no', 'off'):
+        return
+    if '/' in value or os.sep in value or value.lower ().endswith ('.json'):
+        enable (value)
+    else:
+        enable ()
+
+enable_from_env ()
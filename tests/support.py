@@ -0,0 +1,71 @@
+#helpers shared by the tests: throwaway directories, damaging files, and working inside a
+#repository the way a megit command started there would
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from megit import base
+from megit import data
+
+
+class TempDirTest (unittest.TestCase):
+
+    def setUp (self):
+        self.dir = tempfile.mkdtemp (prefix='megit-test-')
+        self.addCleanup (shutil.rmtree, self.dir)
+        cwd = os.getcwd ()
+        self.addCleanup (os.chdir, cwd)
+
+
+def flip_last_byte (path):
+    os.chmod (path, 0o644) #packs are installed read-only
+    with open (path, 'r+b') as f:
+        f.seek (-1, os.SEEK_END)
+        last = f.read (1)
+        f.seek (-1, os.SEEK_END)
+        f.write (bytes ([last[0] ^ 0xff]))
+
+def truncate (path, size):
+    os.chmod (path, 0o644)
+    with open (path, 'r+b') as f:
+        f.truncate (size)
+
+#works in the repository at path like a megit command started there would
+@contextlib.contextmanager
+def in_repo (path):
+    cwd = os.getcwd ()
+    os.chdir (path)
+    try:
+        # Caches are keyed by git dir, and every repository's is ./.megit here
+        data.drop_caches ()
+        with data.change_git_dir ('.'), contextlib.redirect_stdout (io.StringIO ()):
+            yield
+    finally:
+        data.drop_caches ()
+        os.chdir (cwd)
+
+#makes an empty repository at path
+def init_repo (path):
+    os.makedirs (path)
+    with in_repo (path):
+        base.init ()
+    return path
+
+def write_file (path, content):
+    os.makedirs (os.path.dirname (path) or '.', exist_ok=True)
+    with open (path, 'w') as f:
+        f.write (content)
+
+def read_file (path):
+    with open (path) as f:
+        return f.read ()
+
+#writes the files, adds them and commits, returns the commit oid
+def commit_files (files, message='commit'):
+    for path, content in files.items ():
+        write_file (path, content)
+    base.add (list (files))
+    return base.commit (message)
@@ -0,0 +1,79 @@
+#abbreviated oids: resolved when only one object starts with them, loose or packed, and an
+#ambiguous one is reported as such, by get_oid and on the command line
+import io
+import sys
+import hashlib
+import unittest
+import contextlib
+from unittest import mock
+
+from megit import base
+from megit import cli
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, commit_files
+
+
+#two blob contents whose oids share their first n hex digits
+def _colliding_blobs (n):
+    seen = {}
+    i = 0
+    while True:
+        content = b'blob %d\n' % i
+        prefix = hashlib.sha1 (b'blob\x00' + content).hexdigest ()[:n] #as hash_object does
+        if prefix in seen:
+            return seen[prefix], content
+        seen[prefix] = content
+        i += 1
+
+
+class AbbrevTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+        self.first, self.second = _colliding_blobs (base.MIN_ABBREV)
+
+    def _check (self):
+        a, b = data.hash_object (self.first), data.hash_object (self.second)
+        prefix = a[:base.MIN_ABBREV]
+        self.assertEqual (b[:base.MIN_ABBREV], prefix)
+        common = len (prefix)
+        while a[common] == b[common]:
+            common += 1
+
+        self.assertEqual (base.get_oid (a[:common + 1]), a)
+        self.assertEqual (base.get_oid (b[:common + 1].upper ()), b)
+        self.assertEqual (base.get_oid (a), a)
+        with self.assertRaisesRegex (ValueError, 'ambiguous'):
+            base.get_oid (prefix)
+        with self.assertRaisesRegex (ValueError, 'not a valid'):
+            base.get_oid (a[:base.MIN_ABBREV - 1])
+        return prefix
+
+    def test_loose (self):
+        with in_repo (self.repo):
+            self._check ()
+
+    def test_packed (self):
+        with in_repo (self.repo):
+            commit = commit_files ({'a.txt': 'a\n'})
+            data.hash_object (self.first)
+            data.hash_object (self.second)
+            data.repack ()
+            self.assertEqual (list (data._iter_loose_objects ()), [])
+            self._check ()
+            self.assertEqual (base.get_oid (commit[:12]), commit)
+
+    def test_ambiguous_on_the_command_line (self):
+        with in_repo (self.repo):
+            prefix = self._check ()
+            stderr = io.StringIO ()
+            with mock.patch.object (sys, 'argv', ['megit', 'cat-file', prefix]), \
+                    contextlib.redirect_stderr (stderr), self.assertRaises (SystemExit):
+                cli.main ()
+            self.assertIn (f'short object ID {prefix} is ambiguous', stderr.getvalue ())
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,90 @@
+#write-tree and the index's cache-tree: unchanged directories are reused, and a file that
+#took the place of a directory (or the other way around) makes a tree that checks out
+import os
+import shutil
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, write_file, read_file, commit_files
+
+
+def _tree_of (commit):
+    return base.get_tree (base.get_commit (commit).tree)
+
+
+class CacheTreeTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def test_only_changed_directories_are_rebuilt (self):
+        with in_repo (self.repo):
+            commit_files ({'a/x': 'x\n', 'b/y': 'y\n', 'b/c/z': 'z\n', 'top': 't\n'})
+            with data.get_index () as index:
+                kept = dict (index.trees)
+            self.assertEqual (set (kept), {'', 'a', 'b', 'b/c'})
+
+            write_file ('b/c/z', 'changed\n')
+            base.add (['b/c/z'])
+            with data.get_index () as index:
+                self.assertEqual (set (index.trees), {'a'})
+                self.assertEqual (index.trees['a'], kept['a'])
+
+            oid = base.write_tree ()
+            with data.get_index () as index:
+                self.assertEqual (index.trees['a'], kept['a'])
+                self.assertNotEqual (index.trees['b'], kept['b'])
+                # Built from nothing, the tree is the same
+                index.trees.clear ()
+            self.assertEqual (base.write_tree (), oid)
+
+    def test_stat_only_change_keeps_the_trees (self):
+        with in_repo (self.repo):
+            commit_files ({'a/x': 'x\n'})
+            os.utime ('a/x', (0, 0))
+            base.add (['a/x'])
+            with data.get_index () as index:
+                self.assertEqual (set (index.trees), {'', 'a'})
+
+    def test_directory_replaced_by_file (self):
+        with in_repo (self.repo):
+            first = commit_files ({'a/x': 'x\n', 'a/d/y': 'y\n', 'b': 'b\n'})
+            shutil.rmtree ('a')
+            write_file ('a', 'now a file\n')
+            base.add (['.'])
+            second = base.commit ('a is a file')
+            self.assertEqual (set (_tree_of (second)), {'a', 'b'})
+
+            base.checkout (first)
+            self.assertEqual (read_file ('a/x'), 'x\n')
+            base.checkout (second)
+            self.assertEqual (read_file ('a'), 'now a file\n')
+
+    def test_file_replaced_by_directory (self):
+        with in_repo (self.repo):
+            first = commit_files ({'a': 'a file\n', 'b': 'b\n'})
+            os.remove ('a')
+            write_file ('a/x', 'x\n')
+            base.add (['a/x'])
+            second = base.commit ('a is a directory')
+            self.assertEqual (set (_tree_of (second)), {'a/x', 'b'})
+
+            base.checkout (first)
+            self.assertEqual (read_file ('a'), 'a file\n')
+            base.checkout (second)
+            self.assertEqual (read_file ('a/x'), 'x\n')
+
+    def test_file_and_directory_of_the_same_name_are_rejected (self):
+        with in_repo (self.repo):
+            commit_files ({'a/x': 'x\n'})
+            with data.get_index () as index:
+                index['a'] = index['a/x']
+            with self.assertRaisesRegex (AssertionError, 'both a file and a directory'):
+                base.write_tree ()
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,79 @@
+#checkout: only the files that differ between the working tree and the target are written or
+#removed, and the index ends up matching the target with its cache-tree filled
+import os
+import time
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, write_file, read_file
+
+
+def _age (path, seconds=60):
+    then = time.time () - seconds
+    os.utime (path, (then, then))
+
+#writes the files, ages them out of the racy window so the stat cache trusts them, and commits
+def _commit_old_files (files, message='commit'):
+    for path, content in files.items ():
+        write_file (path, content)
+        _age (path)
+    base.add (list (files))
+    return base.commit (message)
+
+
+class CheckoutTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+        with in_repo (self.repo):
+            self.first = _commit_old_files ({'same.txt': 's\n', 'dir/same.txt': 's\n',
+                                             'changed.txt': '1\n', 'gone/only.txt': 'g\n'})
+            # add never stages a deletion
+            os.remove ('gone/only.txt')
+            os.rmdir ('gone')
+            with data.get_index () as index:
+                del index['gone/only.txt']
+            self.second = _commit_old_files ({'changed.txt': '2\n', 'new/dir/new.txt': 'n\n'})
+
+    def test_only_changed_files_are_written (self):
+        with in_repo (self.repo):
+            before = {path: os.stat (path).st_mtime_ns for path in ('same.txt', 'dir/same.txt')}
+            base.checkout (self.first)
+            self.assertEqual (read_file ('changed.txt'), '1\n')
+            self.assertEqual (read_file ('gone/only.txt'), 'g\n')
+            self.assertFalse (os.path.exists ('new'))
+            self.assertEqual ({path: os.stat (path).st_mtime_ns for path in before}, before)
+
+            base.checkout (self.second)
+            self.assertEqual (read_file ('changed.txt'), '2\n')
+            self.assertEqual (read_file ('new/dir/new.txt'), 'n\n')
+            self.assertFalse (os.path.exists ('gone'))
+            self.assertEqual ({path: os.stat (path).st_mtime_ns for path in before}, before)
+
+    def test_index_matches_the_target (self):
+        with in_repo (self.repo):
+            base.checkout (self.first)
+            tree_oid = base.get_commit (self.first).tree
+            with data.get_index () as index:
+                self.assertEqual ({path: entry.oid for path, entry in index.items ()},
+                                  base.get_tree (tree_oid))
+                self.assertEqual (index.trees[''], tree_oid)
+            # The cache-tree is right, writing the tree reads nothing new
+            self.assertEqual (base.write_tree (), tree_oid)
+
+    def test_branch_checkout_moves_HEAD (self):
+        with in_repo (self.repo):
+            base.create_branch ('old', self.first)
+            base.checkout ('old')
+            HEAD = data.get_ref ('HEAD', deref=False)
+            self.assertEqual ((HEAD.symbolic, HEAD.value), (True, 'refs/heads/old'))
+            base.checkout (self.second)
+            HEAD = data.get_ref ('HEAD', deref=False)
+            self.assertEqual ((HEAD.symbolic, HEAD.value), (False, self.second))
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,103 @@
+#commit-graph layers: write then read back, layering, and what happens to a damaged file
+import os
+import hashlib
+import unittest
+
+from megit import base
+from megit import data
+from megit import graph
+
+from support import TempDirTest, flip_last_byte, truncate, in_repo, init_repo, commit_files
+
+
+class CommitGraphTest (TempDirTest):
+
+    #a history with a root, a merge of three parents and a linear tail
+    def setUp (self):
+        super ().setUp ()
+        self.graph_dir = f'{self.dir}/commit-graphs'
+        oid = lambda n: hashlib.sha1 (b'%d' % n).hexdigest ()
+        self.commits = {oid (0): (oid (100), [])}
+        for n in (1, 2, 3):
+            self.commits[oid (n)] = (oid (100 + n), [oid (0)])
+        self.commits[oid (4)] = (oid (104), [oid (1), oid (2), oid (3)])
+        for n in range (5, 12):
+            self.commits[oid (n)] = (oid (100 + n), [oid (n - 1)])
+        self.tip = oid (11)
+
+    def _read_commit (self, oid):
+        return self.commits[oid]
+
+    def _check (self, commit_graph):
+        self.assertEqual (len (commit_graph), len (self.commits))
+        for oid, (tree, parents) in self.commits.items ():
+            pos = commit_graph.lookup (oid)
+            self.assertIsNotNone (pos)
+            self.assertEqual (commit_graph.oid (pos), oid)
+            self.assertEqual (commit_graph.tree (pos), tree)
+            self.assertEqual (commit_graph.parent_oids (pos), parents)
+            generation = 1 + max ((commit_graph.generation (commit_graph.lookup (p)) for p in parents),
+                                  default=0)
+            self.assertEqual (commit_graph.generation (pos), generation)
+        self.assertIsNone (commit_graph.lookup ('f' * 40))
+
+    def test_round_trip (self):
+        self.assertTrue (graph.update (self.graph_dir, [self.tip], self._read_commit))
+        self._check (graph.CommitGraph (self.graph_dir))
+
+    def test_round_trip_layers (self):
+        # Written in two goes, the last two commits are too few to be merged into the first layer
+        tip = hashlib.sha1 (b'9').hexdigest ()
+        self.assertTrue (graph.update (self.graph_dir, [tip], self._read_commit))
+        self.assertTrue (graph.update (self.graph_dir, [self.tip], self._read_commit))
+        commit_graph = graph.CommitGraph (self.graph_dir)
+        self.assertEqual (len (commit_graph.chain), 2)
+        self._check (commit_graph)
+
+    def _layer_path (self):
+        graph.update (self.graph_dir, [self.tip], self._read_commit)
+        name, = graph.CommitGraph (self.graph_dir).chain
+        return f'{self.graph_dir}/graph-{name}.graph'
+
+    def test_corrupt_trailer (self):
+        flip_last_byte (self._layer_path ())
+        commit_graph = graph.CommitGraph (self.graph_dir) #not hashed on open
+        with self.assertRaisesRegex (AssertionError, 'Corrupt commit-graph'):
+            commit_graph.verify ()
+
+    def test_truncated (self):
+        path = self._layer_path ()
+        size = os.path.getsize (path)
+        for cut in (size - 1, size - 30, 100, 0):
+            truncate (path, cut)
+            with self.assertRaises (AssertionError):
+                graph.CommitGraph (self.graph_dir)
+
+
+class RepositoryGraphTest (TempDirTest):
+
+    def test_walks_agree_with_and_without_graph (self):
+        repo = init_repo (f'{self.dir}/repo')
+        with in_repo (repo):
+            first = commit_files ({'a.txt': 'a\n'})
+            base.create_branch ('side', first)
+            second = commit_files ({'a.txt': 'b\n'})
+            base.checkout ('side')
+            side = commit_files ({'b.txt': 'side\n'})
+            base.checkout ('main')
+            base.merge (side)
+            merge = base.commit ('merge')
+            without = list (base.iter_commits_and_parents ({merge}))
+
+            base.update_commit_graph ([merge])
+            data.drop_caches ()
+            self.assertEqual (len (data.get_commit_graph ()), 4)
+            self.assertEqual (list (base.iter_commits_and_parents ({merge})), without)
+            self.assertEqual (base._get_parents (merge), [second, side])
+            self.assertEqual ([base._generation (oid) for oid in (first, second, side, merge)],
+                              [1, 2, 2, 3])
+            self.assertEqual (data.fsck (), [])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,148 @@
+#diffs: the edit script is minimal (up to MAX_EDIT_COST), hunks apply back to the new side,
+#and simple cases print what diff -u does
+import os
+import random
+import shutil
+import unittest
+import subprocess
+
+from megit import data
+from megit import diff
+
+from support import TempDirTest, in_repo, init_repo
+
+
+#length of the longest common subsequence, the lines a minimal script keeps
+def _lcs (a, b):
+    row = [0] * (len (b) + 1)
+    for x in a:
+        diagonal = 0
+        for j, y in enumerate (b):
+            diagonal, row[j + 1] = row[j + 1], diagonal + 1 if x == y else max (row[j + 1], row[j])
+    return row[-1]
+
+#applies a unified diff to the lines of a
+def _apply (a, patch):
+    lines = patch.splitlines (keepends=True)[2:]
+    out = []
+    pos = 0
+    k = 0
+    while k < len (lines):
+        header = lines[k].split (b' ')
+        start = int (header[1][1:].split (b',')[0])
+        count = int (header[1].split (b',')[1]) if b',' in header[1] else 1
+        # An empty range names the line before it
+        start = start if count == 0 else start - 1
+        out.extend (a[pos:start])
+        pos = start
+        k += 1
+        while k < len (lines) and not lines[k].startswith (b'@@'):
+            tag, line = lines[k][:1], lines[k][1:]
+            k += 1
+            if k < len (lines) and lines[k] == b'\\ No newline at end of file\n':
+                line = line[:-1]
+                k += 1
+            if tag in (b' ', b'-'):
+                assert a[pos] == line, (a[pos], line)
+                pos += 1
+            if tag in (b' ', b'+'):
+                out.append (line)
+    return out + a[pos:]
+
+def _random_edit (rng, lines, edits):
+    lines = list (lines)
+    for _ in range (edits):
+        at = rng.randrange (0, len (lines) + 1)
+        cut = rng.randrange (0, 4)
+        lines[at:at + cut] = [b'%d\n' % rng.randrange (20) for _ in range (rng.randrange (0, 4))]
+    return lines
+
+
+class OpcodesTest (unittest.TestCase):
+
+    def test_minimal (self):
+        rng = random.Random (0)
+        for _ in range (300):
+            a = [b'%d\n' % rng.randrange (8) for _ in range (rng.randrange (0, 40))]
+            b = _random_edit (rng, a, rng.randrange (0, 8))
+            kept = sum (i2 - i1 for tag, i1, i2, _, _ in diff._opcodes (a, b) if tag == 'equal')
+            self.assertEqual (kept, _lcs (a, b), (a, b))
+
+    def test_opcodes_cover_both_sides (self):
+        rng = random.Random (1)
+        for _ in range (100):
+            a = [b'%d\n' % rng.randrange (5) for _ in range (rng.randrange (0, 30))]
+            b = _random_edit (rng, a, 5)
+            opcodes = diff._opcodes (a, b)
+            self.assertEqual (sum ((a[i1:i2] for _, i1, i2, _, _ in opcodes), []), a)
+            self.assertEqual (sum ((b[j1:j2] for _, _, _, j1, j2 in opcodes), []), b)
+            for tag, i1, i2, j1, j2 in opcodes:
+                if tag == 'equal':
+                    self.assertEqual (a[i1:i2], b[j1:j2])
+
+    def test_past_the_cost_limit_still_a_valid_script (self):
+        rng = random.Random (2)
+        a = [b'%d\n' % rng.randrange (1000) for _ in range (3000)]
+        b = [b'%d\n' % rng.randrange (1000) for _ in range (3000)]
+        opcodes = diff._opcodes (a, b)
+        self.assertEqual (sum ((b[j1:j2] for _, _, _, j1, j2 in opcodes), []), b)
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                self.assertEqual (a[i1:i2], b[j1:j2])
+
+
+class DiffBlobsTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def _diff (self, c_from, c_to, path='f.txt'):
+        o_from = data.hash_object (c_from) if c_from is not None else None
+        o_to = data.hash_object (c_to) if c_to is not None else None
+        return b''.join (diff.iter_diff_blobs (o_from, o_to, path))
+
+    def test_applies (self):
+        rng = random.Random (3)
+        with in_repo (self.repo):
+            for _ in range (100):
+                a = [b'line %d\n' % rng.randrange (30) for _ in range (rng.randrange (0, 60))]
+                b = _random_edit (rng, a, rng.randrange (1, 6))
+                patch = self._diff (b''.join (a), b''.join (b))
+                self.assertEqual (_apply (a, patch), b)
+
+    def test_no_newline_at_end (self):
+        with in_repo (self.repo):
+            patch = self._diff (b'a\nb', b'a\nc')
+            self.assertEqual (patch, b'--- a/f.txt\n+++ b/f.txt\n@@ -1,2 +1,2 @@\n a\n'
+                                     b'-b\n\\ No newline at end of file\n+c\n\\ No newline at end of file\n')
+            self.assertEqual (_apply ([b'a\n', b'b'], patch), [b'a\n', b'c'])
+
+    def test_new_deleted_and_unchanged (self):
+        with in_repo (self.repo):
+            self.assertEqual (self._diff (None, b'x\n'), b'--- a/f.txt\n+++ b/f.txt\n@@ -0,0 +1 @@\n+x\n')
+            self.assertEqual (self._diff (b'x\n', None), b'--- a/f.txt\n+++ b/f.txt\n@@ -1 +0,0 @@\n-x\n')
+            self.assertEqual (self._diff (b'x\n', b'x\n'), b'')
+
+    def test_binary (self):
+        with in_repo (self.repo):
+            self.assertEqual (self._diff (b'a\x00', b'b\x00', 'bin'), b'Binary files a/bin and b/bin differ\n')
+
+    @unittest.skipUnless (shutil.which ('diff'), 'needs GNU diff')
+    def test_same_as_diff_u (self):
+        a = b''.join (b'int f%d (void)\n{\n    return %d;\n}\n\n' % (i, i) for i in range (20))
+        b = a.replace (b'return 3;', b'return -3;').replace (b'int f12', b'static int f12') + b'/* end */\n'
+        with open (f'{self.dir}/a', 'wb') as f:
+            f.write (a)
+        with open (f'{self.dir}/b', 'wb') as f:
+            f.write (b)
+        expected = subprocess.run (['diff', '-u', '--show-c-function', 'a', 'b'], cwd=self.dir,
+                                   capture_output=True).stdout
+        with in_repo (self.repo):
+            patch = self._diff (a, b)
+        # The headers have dates in them
+        self.assertEqual (patch.split (b'\n', 2)[2], expected.split (b'\n', 2)[2])
+
+
+if __name__ == '__main__':
+    unittest.main ()
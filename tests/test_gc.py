@@ -0,0 +1,86 @@
+#gc: what is packed, what is pruned, what is left for the grace period, and the bytes it reports
+import os
+import time
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, commit_files
+
+DAY = 86400
+
+
+def _age (path, seconds):
+    then = time.time () - seconds
+    os.utime (path, (then, then))
+
+#path -> size of every object file and pack
+def _object_files ():
+    files = {}
+    for dirpath, _, names in os.walk (f'{data.GIT_DIR}/objects'):
+        for name in names:
+            path = f'{dirpath}/{name}'
+            files[path] = os.stat (path).st_size
+    return files
+
+
+class GcTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def test_packs_reachable_and_prunes_old_garbage (self):
+        with in_repo (self.repo):
+            commit = commit_files ({'a.txt': 'a\n', 'dir/b.txt': 'b\n'})
+            old = data.hash_object (b'old garbage')
+            new = data.hash_object (b'new garbage')
+            _age (data._object_path (old), 2 * DAY)
+
+            before = _object_files ()
+            packed, pruned, reclaimed = base.gc (grace=DAY)
+            after = _object_files ()
+
+            self.assertEqual ((packed, pruned), (5, 1)) #commit, two trees, two blobs
+            self.assertEqual (reclaimed, sum (size for path, size in before.items () if path not in after))
+            self.assertFalse (data.object_exists (old))
+            self.assertTrue (data.object_exists (new)) #may be about to be referenced
+            self.assertEqual (data.get_object (commit, 'commit')[:5], b'tree ')
+            self.assertEqual (list (data._iter_loose_objects ()), [new])
+            self.assertEqual ([name for name in os.listdir (f'{data.GIT_DIR}/objects') if len (name) == 2],
+                              [new[:2]])
+            self.assertEqual (data.fsck (), [])
+
+    def test_old_packs_are_replaced (self):
+        with in_repo (self.repo):
+            commit_files ({'a.txt': 'a\n'})
+            data.repack ()
+            second = commit_files ({'a.txt': 'changed\n'})
+            old_pack, = [p.path for p in data._get_packs ()]
+            for ext in ('pack', 'idx'):
+                _age (f'{old_pack}.{ext}', 2 * DAY)
+
+            before = _object_files ()
+            packed, pruned, reclaimed = base.gc (grace=DAY)
+            after = _object_files ()
+
+            self.assertEqual ((packed, pruned), (6, 0)) #two commits, trees and blobs
+            self.assertNotIn (f'{old_pack}.pack', after)
+            self.assertEqual (reclaimed, sum (size for path, size in before.items () if path not in after))
+            self.assertEqual (base.get_commit (second).message, 'commit')
+
+    def test_hard_linked_objects_are_not_counted (self):
+        with in_repo (self.repo):
+            garbage = data.hash_object (b'garbage')
+            path = data._object_path (garbage)
+            _age (path, 2 * DAY)
+            os.link (path, f'{self.dir}/link')
+
+            packed, pruned, reclaimed = base.gc (grace=DAY)
+            self.assertEqual ((packed, pruned, reclaimed), (0, 1, 0))
+            self.assertFalse (data.object_exists (garbage))
+
+
+if __name__ == '__main__':
+    unittest.main ()
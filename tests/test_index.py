@@ -0,0 +1,85 @@
+#the binary index: write then read back, damaged files, and only writing it when it changed
+import os
+import mmap
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, flip_last_byte, truncate, in_repo, init_repo, write_file
+
+
+class IndexTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.path = f'{self.dir}/.megit/index'
+        index = data.Index ()
+        self.entries = {}
+        for i, path in enumerate (['a.txt', 'dir/b.txt', 'dir/sub/c.txt', 'dir/ü.txt', 'z']):
+            entry = data.IndexEntry (oid=f'{i:040x}', mtime=1_700_000_000_000_000_000 + i,
+                                     size=i * 10, ino=1000 + i, mode=0o100644)
+            index[path] = entry
+            self.entries[path] = entry
+        index.trees = {'': 'a' * 40, 'dir': 'b' * 40}
+        os.makedirs (f'{self.dir}/.megit')
+        with data.change_git_dir (self.dir): #the temporary file goes in the git dir
+            index.write (self.path)
+
+    def _load (self):
+        with open (self.path, 'rb') as f:
+            return data.Index (mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ))
+
+    def test_round_trip (self):
+        index = self._load ()
+        try:
+            self.assertEqual (dict (index.items ()), self.entries)
+            self.assertEqual (len (index), len (self.entries))
+            self.assertEqual (index['dir/sub/c.txt'], self.entries['dir/sub/c.txt'])
+            self.assertNotIn ('dir', index)
+            self.assertEqual (index.trees, {'': 'a' * 40, 'dir': 'b' * 40})
+        finally:
+            index.close ()
+
+    def test_corrupt_trailer (self):
+        flip_last_byte (self.path)
+        index = self._load () #not hashed on open
+        try:
+            with self.assertRaisesRegex (AssertionError, 'Corrupt index'):
+                index.verify ()
+        finally:
+            index.close ()
+
+    def test_truncated (self):
+        size = os.path.getsize (self.path)
+        for cut in (size - 1, size - 21, size // 2, 10):
+            truncate (self.path, cut)
+            with self.assertRaisesRegex (AssertionError, 'Corrupt index'):
+                self._load ()
+
+
+class IndexWriteTest (TempDirTest):
+
+    def test_only_written_when_modified (self):
+        repo = init_repo (f'{self.dir}/repo')
+        with in_repo (repo):
+            write_file ('a.txt', 'a\n')
+            write_file ('dir/b.txt', 'b\n')
+            base.add (['.'])
+            before = os.stat ('.megit/index')
+            base.get_working_tree ()
+            with data.get_index () as index:
+                self.assertEqual (sorted (index), ['a.txt', 'dir/b.txt'])
+            after = os.stat ('.megit/index')
+            self.assertEqual ((after.st_ino, after.st_mtime_ns), (before.st_ino, before.st_mtime_ns))
+
+            write_file ('a.txt', 'changed\n')
+            base.add (['a.txt'])
+            self.assertNotEqual (os.stat ('.megit/index').st_ino, before.st_ino) #replaced
+            with data.get_index () as index:
+                self.assertEqual (index['a.txt'].oid, data.hash_object (b'changed\n', write=False))
+            self.assertEqual (data.fsck (), [])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,126 @@
+#three-way merge: line merging against diff3 -m, the paths decided from the oids alone, and
+#merge on whole branches
+import shutil
+import unittest
+import subprocess
+
+from megit import base
+from megit import data
+from megit import diff
+
+from support import TempDirTest, in_repo, init_repo, read_file, commit_files
+
+
+def _lines (text):
+    return diff._split_lines (text.encode ())
+
+
+class MergeLinesTest (TempDirTest):
+
+    BASE = ''.join (f'line {i}\n' for i in range (20))
+
+    def _merge (self, HEAD, other):
+        lines, conflicted = diff._merge_lines (_lines (self.BASE), _lines (HEAD), _lines (other))
+        return b''.join (lines).decode (), conflicted
+
+    def test_changes_on_both_sides (self):
+        HEAD = self.BASE.replace ('line 2\n', 'line two\n')
+        other = self.BASE.replace ('line 15\n', '').replace ('line 17\n', 'line 17\nadded\n')
+        merged, conflicted = self._merge (HEAD, other)
+        self.assertFalse (conflicted)
+        self.assertEqual (merged, HEAD.replace ('line 15\n', '').replace ('line 17\n', 'line 17\nadded\n'))
+
+    def test_same_change_on_both_sides (self):
+        HEAD = self.BASE.replace ('line 5\n', 'five\n')
+        self.assertEqual (self._merge (HEAD, HEAD), (HEAD, False))
+
+    def test_one_side_unchanged (self):
+        other = self.BASE.replace ('line 5\n', 'five\n')
+        self.assertEqual (self._merge (self.BASE, other), (other, False))
+        self.assertEqual (self._merge (other, self.BASE), (other, False))
+
+    def test_conflict (self):
+        HEAD = self.BASE.replace ('line 5\n', 'ours\n')
+        other = self.BASE.replace ('line 5\n', 'theirs\n').replace ('line 6\n', 'theirs too\n')
+        merged, conflicted = self._merge (HEAD, other)
+        self.assertTrue (conflicted)
+        self.assertIn ('<<<<<<< HEAD\nours\nline 6\n||||||| BASE\nline 5\nline 6\n'
+                       '=======\ntheirs\ntheirs too\n>>>>>>> MERGE_HEAD\n', merged)
+        self.assertTrue (merged.startswith (''.join (f'line {i}\n' for i in range (5))))
+        self.assertTrue (merged.endswith (''.join (f'line {i}\n' for i in range (7, 20))))
+
+    @unittest.skipUnless (shutil.which ('diff3'), 'needs diff3')
+    def test_same_as_diff3 (self):
+        cases = [
+            (self.BASE.replace ('line 2\n', 'x\n'), self.BASE.replace ('line 12\n', 'y\n')),
+            (self.BASE.replace ('line 2\n', 'x\n'), self.BASE.replace ('line 2\n', 'y\n')),
+            (self.BASE.replace ('line 2\n', 'x\n'), self.BASE.replace ('line 3\n', '')),
+            (self.BASE + 'end\n', self.BASE.replace ('line 0\n', '')),
+        ]
+        for HEAD, other in cases:
+            for name, text in (('HEAD', HEAD), ('BASE', self.BASE), ('MERGE_HEAD', other)):
+                with open (f'{self.dir}/{name}', 'w') as f:
+                    f.write (text)
+            expected = subprocess.run (['diff3', '-m', 'HEAD', 'BASE', 'MERGE_HEAD'], cwd=self.dir,
+                                       capture_output=True, text=True)
+            merged, conflicted = self._merge (HEAD, other)
+            self.assertEqual (merged, expected.stdout)
+            self.assertEqual (conflicted, expected.returncode == 1)
+
+
+class MergeTreeChangesTest (unittest.TestCase):
+
+    def test_decided_from_the_oids (self):
+        # None of these objects exist, a path changed on one side only must not be read
+        o_base, o_HEAD, o_other = 'b' * 40, 'c' * 40, 'd' * 40
+        merged = diff.merge_tree_changes ([
+            ('same.txt', o_base, o_HEAD, o_HEAD),
+            ('ours.txt', o_base, o_HEAD, o_base),
+            ('theirs.txt', o_base, o_base, o_other),
+            ('added.txt', None, None, o_other),
+            ('deleted.txt', o_base, o_base, None),
+            ('we_deleted.txt', o_base, None, o_base),
+        ])
+        self.assertEqual (merged.tree, {'theirs.txt': o_other, 'added.txt': o_other, 'deleted.txt': None})
+        self.assertEqual (merged.conflicts, [])
+
+
+class MergeTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def test_merge_branches (self):
+        with in_repo (self.repo):
+            start = commit_files ({'a.txt': 'a\n' * 10, 'both.txt': '1\n2\n3\n', 'keep.txt': 'k\n'})
+            base.create_branch ('other', start)
+            ours = commit_files ({'a.txt': 'ours\n' + 'a\n' * 9, 'both.txt': '1\nours\n3\n'})
+            base.checkout ('other')
+            theirs = commit_files ({'a.txt': 'a\n' * 9 + 'theirs\n', 'both.txt': '1\ntheirs\n3\n',
+                                    'new.txt': 'new\n'})
+            base.checkout ('main')
+
+            base.merge (theirs)
+            self.assertEqual (data.get_ref ('MERGE_HEAD').value, theirs)
+            self.assertEqual (read_file ('a.txt'), 'ours\n' + 'a\n' * 8 + 'theirs\n')
+            self.assertEqual (read_file ('new.txt'), 'new\n')
+            self.assertIn ('<<<<<<< HEAD\nours\n', read_file ('both.txt'))
+            merge = base.commit ('merge')
+            self.assertEqual (base.get_commit (merge).parents, [ours, theirs])
+            self.assertEqual (base.get_merge_base (ours, theirs), start)
+
+    def test_fast_forward (self):
+        with in_repo (self.repo):
+            start = commit_files ({'a.txt': 'a\n'})
+            later = commit_files ({'a.txt': 'b\n'})
+            base.reset (start)
+            base.checkout (start)
+            base.merge (later)
+            self.assertEqual (data.get_ref ('HEAD').value, later)
+            self.assertIsNone (data.get_ref ('MERGE_HEAD').value)
+            self.assertEqual (read_file ('a.txt'), 'b\n')
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,94 @@
+#merge-base and ancestry on random histories, checked against the ancestor sets, with and
+#without a commit-graph to cut the walks short
+import random
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo
+
+
+def _make_commit (tree, parents, message):
+    commit = f'tree {tree}\n' + ''.join (f'parent {parent}\n' for parent in parents) + f'\n{message}\n'
+    return data.hash_object (commit.encode (), 'commit')
+
+#a history of n commits where each has one or two random earlier parents
+def _random_history (rng, n):
+    tree = data.hash_object (b'', 'tree')
+    commits = [_make_commit (tree, [], 'root')]
+    for i in range (1, n):
+        # Mostly near the tip, so there are long lines of history as well as old merges
+        parents = {commits[max (0, i - 1 - int (rng.expovariate (0.3)))]}
+        if rng.random () < 0.3:
+            parents.add (rng.choice (commits))
+        commits.append (_make_commit (tree, sorted (parents), f'commit {i}'))
+    return commits
+
+def _ancestors (oid):
+    return set (base.iter_commits_and_parents ({oid}))
+
+#common ancestors that are not an ancestor of another common ancestor
+def _expected_merge_bases (oid1, oid2):
+    common = _ancestors (oid1) & _ancestors (oid2)
+    return {oid for oid in common
+            if not any (other != oid and oid in _ancestors (other) for other in common)}
+
+
+class MergeBaseTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def _check (self, commits, rng):
+        for _ in range (150):
+            one, two = rng.choice (commits), rng.choice (commits)
+            self.assertEqual (set (base.get_merge_bases (one, two)), _expected_merge_bases (one, two))
+            self.assertEqual (base.is_ancestor_of (one, two), two in _ancestors (one))
+
+    def test_random_histories (self):
+        rng = random.Random (0)
+        with in_repo (self.repo):
+            commits = _random_history (rng, 80)
+            self._check (commits, rng)
+
+            base.update_commit_graph (commits[-1:])
+            data.drop_caches ()
+            self.assertGreater (len (data.get_commit_graph ()), 0)
+            self._check (commits, rng)
+
+            # Commits newer than the graph are walked without generations
+            commits.extend (_random_history (rng, 1)) #an unrelated root
+            tree = data.hash_object (b'', 'tree')
+            for i in range (20):
+                parents = sorted ({commits[-1], rng.choice (commits)})
+                commits.append (_make_commit (tree, parents, f'after the graph {i}'))
+            self._check (commits, rng)
+
+    def test_criss_cross (self):
+        with in_repo (self.repo):
+            tree = data.hash_object (b'', 'tree')
+            root = _make_commit (tree, [], 'root')
+            a = _make_commit (tree, [root], 'a')
+            b = _make_commit (tree, [root], 'b')
+            # Each side merges the other, both are best common ancestors of the next pair
+            a2 = _make_commit (tree, [a, b], 'a2')
+            b2 = _make_commit (tree, [b, a], 'b2')
+            self.assertEqual (set (base.get_merge_bases (a2, b2)), {a, b})
+            self.assertEqual (base.get_merge_bases (a2, a2), [a2])
+            self.assertEqual (base.get_merge_bases (a2, a), [a])
+            self.assertIn (base.get_merge_base (a2, b2), (a, b))
+
+    def test_unrelated (self):
+        with in_repo (self.repo):
+            tree = data.hash_object (b'', 'tree')
+            one = _make_commit (tree, [], 'one')
+            two = _make_commit (tree, [], 'two')
+            self.assertEqual (base.get_merge_bases (one, two), [])
+            self.assertIsNone (base.get_merge_base (one, two))
+            self.assertFalse (base.is_ancestor_of (one, two))
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,87 @@
+#have/want negotiation: a fetch sends only what is not below the client's haves, whatever
+#haves the server doesn't know are ignored, and a directory remote copies only what is missing
+import unittest
+
+from megit import base
+from megit import data
+from megit import pack
+from megit import remote
+from megit import server
+
+from support import TempDirTest, in_repo, init_repo, commit_files
+
+
+class NegotiationTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.origin = init_repo (f'{self.dir}/origin')
+        with in_repo (self.origin):
+            self.files = {f'dir{i % 3}/file{i}.txt': f'line {i}\n' for i in range (12)}
+            self.first = commit_files (self.files, 'first')
+            self.second = commit_files ({'dir1/file1.txt': 'changed\n'}, 'second')
+
+    #the objects the server would send a client with haves
+    def _fetch_pack (self, wants, haves, depth=None, shallow=(), filter_=None):
+        path = f'{self.dir}/tmp_fetch_pack'
+        with in_repo (self.origin):
+            count, cut = server._write_fetch_pack (path, wants, haves, depth, shallow, filter_)
+        objects = set (pack.Pack (pack.index_pack (path))) if count else set ()
+        self.assertEqual (len (objects), count)
+        return objects, cut
+
+    def test_only_what_is_above_the_haves (self):
+        objects, cut = self._fetch_pack ([self.second], [self.first])
+        with in_repo (self.origin):
+            tree = base.get_commit (self.second).tree
+            changed = {self.second, tree, base.get_tree (tree)['dir1/file1.txt'],
+                       *(oid for type_, oid, name in base._iter_tree_entries (tree) if name == 'dir1')}
+        self.assertEqual (objects, changed)
+        self.assertEqual (cut, [])
+
+    def test_no_haves_sends_everything (self):
+        objects, _ = self._fetch_pack ([self.second], [])
+        with in_repo (self.origin):
+            self.assertEqual (objects, set (base.iter_objects_in_commits ({self.second})))
+
+    def test_unknown_haves_are_ignored (self):
+        other = init_repo (f'{self.dir}/other')
+        with in_repo (other):
+            unknown = commit_files ({'x.txt': 'x\n'})
+        self.assertEqual (self._fetch_pack ([self.second], [unknown, self.first]),
+                          self._fetch_pack ([self.second], [self.first]))
+
+    def test_have_everything (self):
+        self.assertEqual (self._fetch_pack ([self.first], [self.second]), (set (), []))
+
+    def test_blobless (self):
+        objects, _ = self._fetch_pack ([self.second], [], filter_='blob:none')
+        with in_repo (self.origin):
+            self.assertEqual ({data._split_object (oid)[0] for oid in objects}, {'commit', 'tree'})
+            self.assertIn (base.get_commit (self.second).tree, objects)
+
+    def test_directory_fetch_copies_only_missing (self):
+        clone = init_repo (f'{self.dir}/clone')
+        with in_repo (clone):
+            remote.fetch (self.origin)
+            self.assertEqual (data.get_ref ('refs/remote/main').value, self.second)
+        with in_repo (self.origin):
+            third = commit_files ({'dir2/file2.txt': 'changed too\n'}, 'third')
+        with in_repo (clone):
+            before = self._objects ()
+            remote.fetch (self.origin)
+            self.assertEqual (data.get_ref ('refs/remote/main').value, third)
+            new = self._objects () - before
+        self.assertIn (third, new)
+        self.assertEqual (len (new), 4) #commit, root tree, dir2 and the blob
+
+    #every object in the current repository, loose or packed
+    def _objects (self):
+        objects = set (data._iter_loose_objects ())
+        for p in data._get_packs (reload=True):
+            objects.update (p)
+        return objects
+
+
+if __name__ == '__main__':
+    unittest.main ()
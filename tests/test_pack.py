@@ -0,0 +1,134 @@
+#packs and their idx: write then read back, deltas, and what happens to a damaged file
+import os
+import zlib
+import random
+import shutil
+import hashlib
+import unittest
+
+from megit import data
+from megit import pack
+
+from support import TempDirTest, flip_last_byte, truncate, in_repo, init_repo, commit_files
+
+
+def _oid (type_, content):
+    return hashlib.sha1 (type_.encode () + b'\x00' + content).hexdigest ()
+
+
+class PackTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        rng = random.Random (0)
+        text = b''.join (b'line %d %032x\n' % (i, rng.getrandbits (128)) for i in range (200))
+        self.objects = {}
+        for type_, content in [('blob', text),
+                               ('blob', text.replace (b'line 7 ', b'line seven ')), #a delta of the first
+                               ('blob', text[:1000]),
+                               ('blob', b'small'),
+                               ('blob', b''),
+                               ('tree', b'blob %s a.txt\n' % _oid ('blob', text).encode ()),
+                               ('commit', b'tree 0000\n\nmessage\n')]:
+            self.objects[_oid (type_, content)] = (type_, content)
+        self.pack_dir = f'{self.dir}/pack'
+        self.path = pack.write_pack (self.pack_dir, sorted (self.objects), self.objects.__getitem__)
+
+    def test_round_trip (self):
+        p = pack.Pack (self.path)
+        self.assertEqual (len (p), len (self.objects))
+        self.assertEqual (sorted (p), sorted (self.objects))
+        for oid, obj in self.objects.items ():
+            self.assertIn (oid, p)
+            self.assertEqual (p.read (oid), obj)
+        self.assertIsNone (p.read ('0' * 40))
+        p.verify ()
+
+    def test_deltas_are_used (self):
+        with open (f'{self.path}.pack', 'rb') as f:
+            size = len (f.read ())
+        compressed = [len (zlib.compress (content)) for _, content in self.objects.values ()]
+        # The two versions of the text take about the room of one, the second is a small delta
+        self.assertLess (size, sum (compressed) - max (compressed) // 2)
+
+    def test_find_prefix (self):
+        p = pack.Pack (self.path)
+        for oid in self.objects:
+            self.assertEqual (p.find_prefix (oid[:6]), [oid])
+
+    def test_index_pack_of_a_copy (self):
+        os.makedirs (f'{self.dir}/other')
+        tmp_path = f'{self.dir}/other/tmp_pack_copy'
+        shutil.copyfile (f'{self.path}.pack', tmp_path)
+        path = pack.index_pack (tmp_path)
+        self.assertEqual (os.path.basename (path), os.path.basename (self.path))
+        with open (f'{path}.idx', 'rb') as f, open (f'{self.path}.idx', 'rb') as g:
+            self.assertEqual (f.read (), g.read ())
+
+    def test_index_pack_corrupt_trailer (self):
+        tmp_path = f'{self.dir}/tmp_pack_copy'
+        shutil.copyfile (f'{self.path}.pack', tmp_path)
+        flip_last_byte (tmp_path)
+        with self.assertRaisesRegex (AssertionError, 'Corrupt pack'):
+            pack.index_pack (tmp_path)
+
+    def test_index_pack_truncated (self):
+        size = os.path.getsize (f'{self.path}.pack')
+        for cut in (0, 8, 40, size // 2, size - 1):
+            tmp_path = f'{self.dir}/tmp_pack_{cut}'
+            shutil.copyfile (f'{self.path}.pack', tmp_path)
+            truncate (tmp_path, cut)
+            with self.assertRaises (AssertionError):
+                pack.index_pack (tmp_path)
+
+    def test_idx_corrupt_trailer (self):
+        flip_last_byte (f'{self.path}.idx')
+        p = pack.Pack (self.path) #not hashed on open
+        with self.assertRaisesRegex (AssertionError, 'Corrupt pack index'):
+            p.verify ()
+
+    def test_idx_truncated (self):
+        size = os.path.getsize (f'{self.path}.idx')
+        for cut in (size - 1, size - 20, 100, 4, 0):
+            truncate (f'{self.path}.idx', cut)
+            with self.assertRaises (AssertionError):
+                pack.Pack (self.path)
+
+    def test_pack_truncated (self):
+        truncate (f'{self.path}.pack', os.path.getsize (f'{self.path}.pack') - 10)
+        p = pack.Pack (self.path)
+        with self.assertRaisesRegex (AssertionError, 'does not match its index'):
+            p.read (next (iter (self.objects)))
+
+    def test_delta_round_trip (self):
+        rng = random.Random (1)
+        for _ in range (200):
+            base = rng.randbytes (rng.randrange (0, 3000))
+            target = bytearray (base)
+            for _ in range (rng.randrange (0, 6)):
+                at = rng.randrange (0, len (target) + 1)
+                target[at:at + rng.randrange (0, 50)] = rng.randbytes (rng.randrange (0, 50))
+            target = bytes (target)
+            self.assertEqual (pack.apply_delta (base, pack.create_delta (base, target)), target)
+
+
+class RepackTest (TempDirTest):
+
+    def test_repack_then_fsck (self):
+        repo = init_repo (f'{self.dir}/repo')
+        with in_repo (repo):
+            commit = commit_files ({'a.txt': 'a\n' * 100, 'dir/b.txt': 'b\n'})
+            self.assertEqual (data.repack (), 5) #commit, two trees, two blobs
+            self.assertEqual (list (data._iter_loose_objects ()), [])
+            self.assertEqual (data.get_object (commit, 'commit')[:5], b'tree ')
+            self.assertEqual (data.fsck (), [])
+
+            pack_path, = [p.path for p in data._get_packs ()]
+            flip_last_byte (f'{pack_path}.pack')
+            problems = data.fsck ()
+            self.assertEqual (len (problems), 1)
+            self.assertIn ('pack', problems[0])
+
+
+if __name__ == '__main__':
+    unittest.main ()
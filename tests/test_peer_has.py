@@ -0,0 +1,75 @@
+#peer_has: which of the objects reachable from some tips a peer that has some commits already has
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, commit_files
+
+
+class PeerHasTest (TempDirTest):
+
+    # c1 - c2 - c3 ---- m - c4
+    #   \              /
+    #    s1 - s2 -----
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+        with in_repo (self.repo):
+            c = self.commits = {}
+            c['c1'] = commit_files ({'a.txt': '1\n', 'dir/b.txt': 'b\n'})
+            c['c2'] = commit_files ({'a.txt': '2\n'})
+            c['c3'] = commit_files ({'a.txt': '3\n'})
+            base.reset (c['c1'])
+            c['s1'] = commit_files ({'side.txt': '1\n'})
+            c['s2'] = commit_files ({'side.txt': '2\n'})
+            base.reset (c['c3'])
+            data.update_ref ('MERGE_HEAD', data.RefValue (symbolic=False, value=c['s2']))
+            c['m'] = commit_files ({'a.txt': 'merged\n'})
+            c['c4'] = commit_files ({'a.txt': '4\n'})
+
+    def _oids (self, names):
+        return [self.commits[name] for name in names]
+
+    #what a peer that has haves would be sent for tips
+    def _missing (self, tips, haves, shallow=()):
+        exists = base.peer_has (self._oids (tips), self._oids (haves), self._oids (shallow))
+        return set (base.iter_missing_objects (self._oids (tips), exists))
+
+    def test_sends_only_what_is_not_below_the_haves (self):
+        with in_repo (self.repo):
+            for haves in (['c2'], ['s1'], ['c3', 's2'], ['m'], ['c4'], ['c1'], []):
+                expected = set (base.iter_objects_in_commits (self._oids (['c4']))) - \
+                    set (base.iter_objects_in_commits (self._oids (haves)))
+                self.assertEqual (self._missing (['c4'], haves), expected, haves)
+
+    def test_has_the_trees_new_commits_sit_on (self):
+        with in_repo (self.repo):
+            c = self.commits
+            exists = base.peer_has ([c['c3']], [c['c2']])
+            tree = base.get_commit (c['c2']).tree
+            self.assertTrue (exists (tree))
+            for oid in base.get_tree (tree).values ():
+                self.assertTrue (exists (oid))
+            self.assertFalse (exists (base.get_commit (c['c3']).tree))
+            self.assertFalse (exists (base.get_tree (base.get_commit (c['c3']).tree)['a.txt']))
+
+    def test_unknown_haves_are_ignored (self):
+        with in_repo (self.repo):
+            exists = base.peer_has ([self.commits['c2']], ['0' * 40])
+            self.assertFalse (exists (self.commits['c1']))
+
+    def test_nothing_below_the_shallow_commits (self):
+        with in_repo (self.repo):
+            c = self.commits
+            # The side branch leads down to c1, which is below c3 but cut off from a peer
+            # whose history stops at c3
+            self.assertNotIn (c['c1'], self._missing (['c4'], ['c3']))
+            missing = self._missing (['c4'], ['c3'], shallow=['c3'])
+            self.assertIn (c['c1'], missing)
+            self.assertNotIn (c['c3'], missing)
+
+
+
+if __name__ == '__main__':
+    unittest.main ()
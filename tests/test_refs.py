@@ -0,0 +1,84 @@
+#refs: packed-refs, loose refs winning over packed ones, deletes from both, and the per-process
+#cache of what was read
+import os
+import unittest
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, read_file, commit_files
+
+
+class RefsTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+        with in_repo (self.repo):
+            self.first = commit_files ({'a.txt': 'a\n'})
+            self.second = commit_files ({'a.txt': 'b\n'})
+            base.create_branch ('side', self.first)
+            base.create_tag ('v1', self.first)
+
+    def _refs (self):
+        return {name: ref.value for name, ref in data.iter_refs ()}
+
+    def test_pack_refs (self):
+        with in_repo (self.repo):
+            before = self._refs ()
+            self.assertEqual (data.pack_refs (), 3) #main, side, v1
+            self.assertEqual (read_file (f'{data.GIT_DIR}/packed-refs'),
+                              f'{self.second} refs/heads/main\n{self.first} refs/heads/side\n'
+                              f'{self.first} refs/tags/v1\n')
+            self.assertFalse (os.path.exists (f'{data.GIT_DIR}/refs/heads/main'))
+            # HEAD is symbolic and stays loose
+            self.assertTrue (data.get_ref ('HEAD', deref=False).symbolic)
+            self.assertEqual (self._refs (), before)
+            data.drop_caches ()
+            self.assertEqual (self._refs (), before)
+            self.assertEqual (base.get_oid ('side'), self.first)
+            self.assertEqual (data.pack_refs (), 0)
+
+    def test_loose_ref_wins (self):
+        with in_repo (self.repo):
+            data.pack_refs ()
+            base.create_branch ('side', self.second)
+            self.assertEqual (data.get_ref ('refs/heads/side').value, self.second)
+            data.drop_caches ()
+            self.assertEqual (data.get_ref ('refs/heads/side').value, self.second)
+            self.assertEqual (list (self._refs ()).count ('refs/heads/side'), 1)
+            # Commits on a packed branch go to a loose ref
+            commit = commit_files ({'a.txt': 'c\n'})
+            data.drop_caches ()
+            self.assertEqual (data.get_ref ('HEAD').value, commit)
+
+    def test_delete_packed_and_loose (self):
+        with in_repo (self.repo):
+            data.pack_refs ()
+            base.create_branch ('side', self.second)
+            data.delete_ref ('refs/heads/side')
+            self.assertIsNone (data.get_ref ('refs/heads/side').value)
+            data.drop_caches ()
+            self.assertIsNone (data.get_ref ('refs/heads/side').value)
+            self.assertNotIn ('refs/heads/side', read_file (f'{data.GIT_DIR}/packed-refs'))
+            self.assertNotIn ('refs/heads/side', self._refs ())
+
+    def test_reads_are_cached (self):
+        with in_repo (self.repo):
+            self.assertEqual (data.get_ref ('refs/heads/side').value, self.first)
+            # Not expected to change under us mid-command, what was read is kept
+            with open (f'{data.GIT_DIR}/refs/heads/side', 'w') as f:
+                f.write (self.second)
+            self.assertEqual (data.get_ref ('refs/heads/side').value, self.first)
+            data.drop_caches ()
+            self.assertEqual (data.get_ref ('refs/heads/side').value, self.second)
+
+    def test_same_ref_under_another_spelling (self):
+        with in_repo (self.repo):
+            base.create_branch ('side', self.second)
+            self.assertEqual (data.get_ref ('refs/heads//side').value, self.second)
+            self.assertEqual (data.get_ref ('refs/heads/./side').value, self.second)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,150 @@
+#clone, fetch and push against a megit serve running on a unix socket
+import os
+import sys
+import json
+import time
+import asyncio
+import unittest
+import subprocess
+
+from megit import base
+from megit import data
+from megit import remote
+from megit import server
+
+from support import TempDirTest, in_repo, read_file, commit_files
+
+ROOT = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+
+
+@unittest.skipUnless (hasattr (os, 'fork'), 'needs unix sockets')
+class ServerTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        os.chdir (self.dir)
+
+        self.origin = f'{self.dir}/served/origin'
+        os.makedirs (self.origin)
+        with in_repo (self.origin):
+            base.init ()
+            self.files = {f'dir{i % 3}/file{i}.txt': f'line {i}\n' * (i + 1) for i in range (20)}
+            commit_files (self.files, 'first')
+            self.first = commit_files ({'dir0/file0.txt': 'changed\n'}, 'second')
+        self.files['dir0/file0.txt'] = 'changed\n'
+
+        self.socket_path = socket_path = f'{self.dir}/socket'
+        env = dict (os.environ, PYTHONPATH=ROOT)
+        self.server = subprocess.Popen (
+            [sys.executable, '-c', 'from megit.cli import main; main ()',
+             'serve', f'{self.dir}/served', '--unix', socket_path], env=env)
+        self.addCleanup (self._stop_server)
+        deadline = time.time () + 10
+        while not os.path.exists (socket_path):
+            self.assertIsNone (self.server.poll (), 'server exited')
+            self.assertLess (time.time (), deadline, 'server did not start')
+            time.sleep (0.05)
+        self.url = f'megit+unix://{socket_path}?repo=origin'
+
+    def _stop_server (self):
+        self.server.terminate ()
+        self.server.wait (10)
+
+    def _clone (self, directory='clone', **kwargs):
+        with in_repo (self.dir):
+            remote.clone (self.url, directory, **kwargs)
+        return f'{self.dir}/{directory}'
+
+    def _check_files (self, repo, files):
+        for path, content in files.items ():
+            self.assertEqual (read_file (f'{repo}/{path}'), content, path)
+
+    def test_clone (self):
+        clone = self._clone ()
+        self._check_files (clone, self.files)
+        with in_repo (clone):
+            self.assertEqual (data.get_ref ('refs/heads/main').value, self.first)
+            self.assertEqual (data.get_ref ('refs/remote/main').value, self.first)
+
+    def test_fetch (self):
+        clone = self._clone ()
+        with in_repo (self.origin):
+            new = commit_files ({'dir1/new.txt': 'new\n'}, 'third')
+        with in_repo (clone):
+            remote.fetch (self.url)
+            self.assertEqual (data.get_ref ('refs/remote/main').value, new)
+            self.assertEqual (base.get_commit (new).parents, [self.first])
+            base.merge (new)
+        self._check_files (clone, {'dir1/new.txt': 'new\n'})
+
+    def test_push (self):
+        clone = self._clone ()
+        with in_repo (clone):
+            new = commit_files ({'dir2/pushed.txt': 'pushed\n'}, 'from the clone')
+            remote.push (self.url, 'refs/heads/main')
+        with in_repo (self.origin):
+            self.assertEqual (data.get_ref ('refs/heads/main').value, new)
+            self.assertEqual (base.get_commit (new).parents, [self.first])
+            tree = base.get_tree (base.get_commit (new).tree)
+            self.assertEqual (data.get_object (tree['dir2/pushed.txt']), b'pushed\n')
+
+    def test_push_not_fast_forward (self):
+        clone = self._clone ()
+        with in_repo (self.origin):
+            moved = commit_files ({'dir1/origin.txt': 'origin\n'}, 'on the server')
+        with in_repo (clone):
+            commit_files ({'dir2/clone.txt': 'clone\n'}, 'in the clone')
+            with self.assertRaises ((AssertionError, ValueError)):
+                remote.push (self.url, 'refs/heads/main')
+        with in_repo (self.origin):
+            self.assertEqual (data.get_ref ('refs/heads/main').value, moved)
+
+    def test_partial_clone (self):
+        # One oid per get-objects request, so the batching is exercised too
+        batch = remote.GET_OBJECTS_BATCH
+        remote.GET_OBJECTS_BATCH = 1
+        self.addCleanup (setattr, remote, 'GET_OBJECTS_BATCH', batch)
+        clone = self._clone (filter_='blob:none')
+        self._check_files (clone, self.files)
+
+    def test_unknown_repository (self):
+        with in_repo (self.dir):
+            with self.assertRaisesRegex (ValueError, 'No repository'):
+                remote.clone (self.url.replace ('repo=origin', 'repo=missing'), 'clone')
+
+    #sends raw frames and returns the reply, or None when the server hung up without one
+    def _exchange (self, *frames):
+        async def exchange ():
+            reader, writer = await asyncio.open_unix_connection (self.socket_path)
+            try:
+                for frame in frames:
+                    writer.write (frame)
+                await writer.drain ()
+                try:
+                    return await server.read_message (reader)
+                except asyncio.IncompleteReadError:
+                    return None
+            finally:
+                writer.close ()
+        return asyncio.run (exchange ())
+
+    def _frame (self, payload):
+        return server._LENGTH.pack (len (payload)) + payload
+
+    def test_malformed_requests_get_an_error (self):
+        self.assertIn ('Bad request', self._exchange (self._frame (b'{not json'))['error'])
+        self.assertIn ('Bad request', self._exchange (self._frame (b'[1, 2]'))['error'])
+        # Only the length is sent, the server refuses before reading any of it
+        too_big = server._LENGTH.pack (server.MAX_FRAME + 1)
+        self.assertIn ('Bad request', self._exchange (too_big)['error'])
+        reply = self._exchange (self._frame (json.dumps ({'command': 'nope', 'repo': 'origin'}).encode ()))
+        self.assertIn ('Unknown command', reply['error'])
+        reply = self._exchange (self._frame (json.dumps ({'command': 'ls-refs'}).encode ()))
+        self.assertIn ('repo', reply['error'])
+        # And the server is still serving
+        self.assertEqual (self._exchange (self._frame (json.dumps (
+            {'command': 'ls-refs', 'repo': 'origin'}).encode ()))['refs']['refs/heads/main'], self.first)
+
+
+if __name__ == '__main__':
+    unittest.main ()
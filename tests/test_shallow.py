@@ -0,0 +1,81 @@
+#shallow clones and fetches: only depth commits of history come over, the cut is recorded in
+#the shallow file, and later fetches deepen it or add to it
+import unittest
+
+from megit import base
+from megit import data
+from megit import remote
+from megit import server
+
+from support import TempDirTest, in_repo, init_repo, read_file, commit_files
+
+
+class ShallowTest (TempDirTest):
+
+    def setUp (self):
+        super ().setUp ()
+        self.origin = init_repo (f'{self.dir}/origin')
+        with in_repo (self.origin):
+            self.commits = [commit_files ({'a.txt': f'{i}\n', f'file{i}.txt': f'{i}\n'}, f'commit {i}')
+                            for i in range (6)]
+
+    def _clone (self, depth):
+        with in_repo (self.dir):
+            remote.clone (self.origin, 'clone', depth=depth)
+        return f'{self.dir}/clone'
+
+    def _history (self):
+        return list (base.iter_commits_and_parents ({data.get_ref ('refs/remote/main').value}))
+
+    def test_clone_with_depth (self):
+        clone = self._clone (2)
+        self.assertEqual (read_file (f'{clone}/a.txt'), '5\n')
+        with in_repo (clone):
+            self.assertEqual (self._history (), self.commits[:3:-1])
+            self.assertEqual (data.get_shallow (), {self.commits[4]})
+            self.assertFalse (data.object_exists (self.commits[3]))
+            # Everything that is there is whole
+            for oid in base.iter_objects_in_commits ({self.commits[5]}):
+                self.assertTrue (data.object_exists (oid), oid)
+
+    def test_deepen (self):
+        clone = self._clone (2)
+        with in_repo (clone):
+            remote.fetch (self.origin, depth=4)
+            self.assertEqual (self._history (), self.commits[:1:-1])
+            self.assertEqual (data.get_shallow (), {self.commits[2]})
+
+            remote.fetch (self.origin, depth=10)
+            self.assertEqual (self._history (), self.commits[::-1])
+            self.assertEqual (data.get_shallow (), set ())
+
+    def test_fetch_onto_a_shallow_clone (self):
+        clone = self._clone (1)
+        with in_repo (self.origin):
+            new = commit_files ({'a.txt': 'new\n'}, 'new')
+        with in_repo (clone):
+            remote.fetch (self.origin)
+            self.assertEqual (self._history (), [new, self.commits[5]])
+            self.assertEqual (data.get_shallow (), {self.commits[5]})
+
+    def test_gc_in_a_shallow_clone (self):
+        clone = self._clone (2)
+        with in_repo (clone):
+            base.gc (grace=0)
+            self.assertEqual (self._history (), self.commits[:3:-1])
+            self.assertEqual (data.fsck (), [])
+
+    def test_server_cut (self):
+        path = f'{self.dir}/tmp_fetch_pack'
+        with in_repo (self.origin):
+            count, cut = server._write_fetch_pack (path, [self.commits[5]], [], 3, [], None)
+            self.assertEqual (cut, [self.commits[3]])
+            # Deepening a client that is shallow at commits[3] sends only what is below it
+            count, cut = server._write_fetch_pack (path, [self.commits[5]], [self.commits[5]], 5,
+                                                   [self.commits[3]], None)
+            self.assertEqual (cut, [self.commits[1]])
+            self.assertEqual (count, 7) #commits 2 and 1, their trees and three blobs
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,83 @@
+#the index's stat data: a file whose stat matches what add saw is not read again, anything
+#else is, and files changed too recently to trust their mtime always are
+import os
+import time
+import unittest
+from unittest import mock
+
+from megit import base
+from megit import data
+
+from support import TempDirTest, in_repo, init_repo, write_file
+
+
+def _age (path, seconds=60):
+    then = time.time () - seconds
+    os.utime (path, (then, then))
+
+
+class StatCacheTest (TempDirTest):
+
+    FILES = {'a.txt': 'a\n', 'dir/b.txt': 'b\n', 'dir/sub/c.txt': 'c\n'}
+
+    def setUp (self):
+        super ().setUp ()
+        self.repo = init_repo (f'{self.dir}/repo')
+
+    def _add_old_files (self):
+        for path, content in self.FILES.items ():
+            write_file (path, content)
+            _age (path)
+        base.add (list (self.FILES))
+
+    #get_working_tree's result, and the paths it had to hash for it
+    def _working_tree (self):
+        with mock.patch.object (data, 'hash_file', wraps=data.hash_file) as hash_file:
+            tree = base.get_working_tree ()
+        return tree, sorted (call.args[0] for call in hash_file.call_args_list)
+
+    def test_unchanged_files_are_not_hashed (self):
+        with in_repo (self.repo):
+            self._add_old_files ()
+            tree, hashed = self._working_tree ()
+            self.assertEqual (hashed, [])
+            self.assertEqual (tree, {path: data.hash_object (content.encode (), write=False)
+                                     for path, content in self.FILES.items ()})
+
+    def test_changed_and_new_files_are_hashed (self):
+        with in_repo (self.repo):
+            self._add_old_files ()
+            write_file ('dir/b.txt', 'changed\n')
+            write_file ('new.txt', 'new\n')
+            tree, hashed = self._working_tree ()
+            self.assertEqual (hashed, ['dir/b.txt', 'new.txt'])
+            self.assertEqual (tree['dir/b.txt'], data.hash_object (b'changed\n', write=False))
+            self.assertIn ('new.txt', tree)
+
+    def test_touched_file_is_hashed_once (self):
+        with in_repo (self.repo):
+            self._add_old_files ()
+            _age ('a.txt', 30) #same content, other mtime
+            self.assertEqual (self._working_tree ()[1], ['a.txt'])
+            # The stat data was refreshed
+            self.assertEqual (self._working_tree ()[1], [])
+
+    def test_racy_files_are_always_hashed (self):
+        with in_repo (self.repo):
+            write_file ('a.txt', 'a\n') #just written, within the racy window
+            base.add (['a.txt'])
+            with data.get_index () as index:
+                self.assertEqual (index['a.txt'].mtime, 0)
+            self.assertEqual (self._working_tree ()[1], ['a.txt'])
+            self.assertEqual (self._working_tree ()[1], ['a.txt'])
+
+    def test_add_skips_unchanged_files (self):
+        with in_repo (self.repo):
+            self._add_old_files ()
+            with mock.patch.object (data, 'hash_file', wraps=data.hash_file) as hash_file:
+                base.add (['.'])
+            self.assertEqual (hash_file.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main ()